@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Encode the RGBA rasters of the frames of an animation (e.g., those of an
+Agg canvas, see raster_composite_toronto.canvas_rgba()) into a GIF or an MP4
+file, one frame at a time.
+
+Unlike the writers of matplotlib.animation, which savefig() the whole figure
+for each frame, these writers take the rasters already drawn, so the frames
+can be drawn incrementally (blitting only the artists which change).
+
+The GIFs are encoded with Pillow, if it is installed, and otherwise with
+ffmpeg, which also encodes the MP4s (H.264). The ffmpeg program is the one
+in the rcParams 'animation.ffmpeg_path' of matplotlib.
+"""
+
+import os
+import subprocess
+
+import matplotlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None    # (the GIFs are encoded with ffmpeg)
+
+
+# The formats of the animations, per extension of their file names
+ANIMATION_FORMATS = {'.gif': 'gif', '.mp4': 'mp4'}
+
+
+class PillowGifWriter(object):
+
+    """Encode the frames of an animation into a GIF with Pillow.
+
+    Fields:
+
+       fname: the GIF file to write
+
+       fps: the frames per second of the animation
+
+       _frames: the frames added, as palette images (a GIF is written at
+                once, when it is closed)
+    """
+
+    def __init__(self, fname, fps):
+
+        self.fname = fname
+        self.fps = fps
+        self._frames = []
+
+    def add_frame(self, rgba):
+        """Add the frame with the uint8 raster 'rgba' (height, width, 4)."""
+
+        image = Image.fromarray(rgba[:, :, :3].copy(), 'RGB')
+        self._frames.append(image.convert('P', palette=Image.ADAPTIVE))
+
+    def close(self):
+        """Write the GIF with the frames added, looping forever."""
+
+        if not self._frames:
+            raise ValueError('The animation %s has no frames' % self.fname)
+        tmp_fname = '%s.%d.tmp' % (self.fname, os.getpid())
+        self._frames[0].save(tmp_fname, format='GIF', save_all=True,
+                             append_images=self._frames[1:], loop=0,
+                             duration=int(round(1000.0 / self.fps)))
+        os.rename(tmp_fname, self.fname)
+        self._frames = []
+
+
+class FFMpegWriter(object):
+
+    """Encode the frames of an animation into a GIF or an MP4 with ffmpeg,
+    piping it their raw rasters.
+
+    Fields:
+
+       fname: the GIF or MP4 file to write
+
+       fps: the frames per second of the animation
+
+       fmt: the format of the animation, 'gif' or 'mp4'
+
+       _tmp_fname: the file where ffmpeg writes, renamed to 'fname' when
+                   the animation is complete
+
+       _proc: the ffmpeg process, started with the first frame (when the
+              size of the frames is known)
+    """
+
+    def __init__(self, fname, fps, fmt):
+
+        self.fname = fname
+        self.fps = fps
+        self.fmt = fmt
+        self._tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+        self._proc = None
+
+    def _start(self, height, width):
+        """Start ffmpeg for frames of 'height' x 'width' pixels."""
+
+        command = [matplotlib.rcParams['animation.ffmpeg_path'],
+                   '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                   '-s', '%dx%d' % (width, height), '-r', str(self.fps),
+                   '-i', 'pipe:0']
+        if self.fmt == 'mp4':
+            # (H.264 in yuv420p needs an even width and height)
+            command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white',
+                        '-vcodec', 'libx264', '-pix_fmt', 'yuv420p',
+                        '-f', 'mp4']
+        else:
+            # (a palette generated from the frames themselves)
+            command += ['-vf',
+                        'split[a][b];[a]palettegen[p];[b][p]paletteuse',
+                        '-loop', '0', '-f', 'gif']
+        command.append(self._tmp_fname)
+        try:
+            self._proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except OSError as an_exc:
+            raise RuntimeError('Could not run ffmpeg (%s) to encode the '
+                               'animation %s: %s' %
+                               (command[0], self.fname, an_exc))
+
+    def add_frame(self, rgba):
+        """Add the frame with the uint8 raster 'rgba' (height, width, 4)."""
+
+        if self._proc is None:
+            self._start(rgba.shape[0], rgba.shape[1])
+        self._proc.stdin.write(rgba.tobytes())
+
+    def close(self):
+        """Finish the encoding of the animation."""
+
+        if self._proc is None:
+            raise ValueError('The animation %s has no frames' % self.fname)
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            raise RuntimeError('ffmpeg failed to encode the animation %s '
+                               '(exit status %d)' %
+                               (self.fname, self._proc.returncode))
+        self._proc = None
+        os.rename(self._tmp_fname, self.fname)
+
+
+def animation_writer(fname, fps):
+    """Return the writer of the animation 'fname' (a '.gif' or '.mp4' file)
+    at 'fps' frames per second, with the methods add_frame(rgba) and
+    close().
+
+    Raises ValueError if the extension of 'fname' isn't of a known format.
+    """
+
+    extension = os.path.splitext(fname)[1].lower()
+    fmt = ANIMATION_FORMATS.get(extension)
+    if fmt is None:
+        raise ValueError("Unknown format of animation '%s' (the known "
+                         "extensions are %s)" %
+                         (fname, ', '.join(sorted(ANIMATION_FORMATS))))
+    if fmt == 'gif' and Image is not None:
+        return PillowGifWriter(fname, fps)
+    return FFMpegWriter(fname, fps, fmt)
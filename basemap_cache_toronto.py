@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=protected-access
+
+"""A factory of the Basemap of Toronto, so that the high-resolution GSHHS
+coastline is read and clipped to the bounding box of Toronto only once per
+set of parameters (resolution, area_thresh, ...), instead of once per panel
+of each figure.
+
+Each Basemap built is memoized in this process and also pickled under
+'./cache_dir/basemap', so later runs don't need to build it either. Every
+call returns a shallow copy of the memoized Basemap attached to the axis
+requested: the copies share the (read-only) coastline data, but each one
+has its own shapefiles read into it and its own axis.
+
+The programs which project the Shapefiles but don't draw the map (e.g.,
+the benchmark) can use instead the projection of toronto_projection(), built
+by pyproj alone, without Basemap.
+"""
+
+import copy
+import os
+import pickle
+
+import numpy as np
+
+from cache_dir_toronto import cache_subdir, cache_key, atomic_write
+
+
+BASEMAP_CACHE_SUBDIR = 'basemap'
+
+# These are the latitudes of the City of Toronto.
+# (Fiona can be better to find them, e.g., from the 'icitw_wgs84' Shapefile.)
+
+TORONTO_BOUNDING_BOX = dict(llcrnrlon=-79.75,
+                            llcrnrlat=43.40,
+                            urcrnrlon=-79.10,
+                            urcrnrlat=43.95)
+
+# The Basemaps already built in this process, indexed by their cache key
+_BASEMAPS = dict()
+
+
+def _build_basemap(basemap_params):
+    """Build the Basemap with the parameters 'basemap_params', or load it
+    from its pickle in the cache if it was built before.
+    """
+
+    # imported here since Basemap takes long to import, and the programs
+    # which import this module don't always draw a map (e.g., the ETL)
+    from mpl_toolkits.basemap import Basemap
+    import mpl_toolkits.basemap
+
+    key = cache_key([], (sorted(basemap_params.items()),
+                         mpl_toolkits.basemap.__version__))
+    to_map = _BASEMAPS.get(key)
+    if to_map is not None:
+        return to_map
+
+    cache_fname = os.path.join(cache_subdir(BASEMAP_CACHE_SUBDIR),
+                               key + '.pickle')
+    try:
+        with open(cache_fname, 'rb') as in_file:
+            to_map = pickle.load(in_file)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        to_map = Basemap(**basemap_params)
+        atomic_write(cache_fname,
+                     pickle.dumps(to_map, pickle.HIGHEST_PROTOCOL))
+
+    _BASEMAPS[key] = to_map
+    return to_map
+
+
+def toronto_basemap(axis=None, resolution='h', area_thresh=0.1,
+                    ellps='WGS84'):
+    """Return a Basemap with the bounding box of Toronto, attached to the
+    axis 'axis'.
+
+    :param axis: where to draw the map (None for the current axis)
+    :param resolution: the resolution of the coastline, as in Basemap
+    :param area_thresh: the minimum area of coastline features, as in
+                        Basemap
+    :param ellps: the ellipsoid of the projection
+    :returns: Basemap with Toronto
+    """
+
+    basemap_params = dict(TORONTO_BOUNDING_BOX, ellps=ellps,
+                          resolution=resolution, area_thresh=area_thresh)
+
+    to_map = copy.copy(_build_basemap(basemap_params))
+    to_map.ax = axis
+    # the state that Basemap keeps per axis mustn't be shared with the
+    # memoized instance
+    if hasattr(to_map, '_initialized_axes'):
+        to_map._initialized_axes = set()
+    return to_map
+
+
+class TorontoProjection(object):
+
+    """A projection of the map of Toronto by pyproj, with the interface of a
+    Basemap which the geometry of the Shapefiles needs: it is called as
+    to_map(lons, lats) to project them, with the lower left corner of the
+    map at (0, 0), and it has the corners of the map.
+
+    Fields:
+
+       projparams: the parameters of the projection, as in pyproj.Proj
+
+       llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat: the corners of the map,
+                                                   in degrees
+
+       llcrnrx, llcrnry, urcrnrx, urcrnry: the corners of the map, projected
+
+       _proj: the pyproj.Proj of the projection
+
+       _origin: the projection (x, y) of the lower left corner of the map
+    """
+
+    def __init__(self, projparams, llcrnrlon, llcrnrlat, urcrnrlon,
+                 urcrnrlat):
+
+        # imported here since only the programs which don't use Basemap
+        # need it
+        try:
+            import pyproj
+        except ImportError:
+            from mpl_toolkits.basemap import pyproj     # the one in Basemap
+
+        self.projparams = dict(projparams)
+        self.llcrnrlon = llcrnrlon
+        self.llcrnrlat = llcrnrlat
+        self.urcrnrlon = urcrnrlon
+        self.urcrnrlat = urcrnrlat
+        self._proj = pyproj.Proj(**self.projparams)
+
+        x_coords, y_coords = self._proj([llcrnrlon, urcrnrlon],
+                                        [llcrnrlat, urcrnrlat])
+        self._origin = (x_coords[0], y_coords[0])
+        self.llcrnrx = self.llcrnry = 0.0
+        self.urcrnrx = x_coords[1] - x_coords[0]
+        self.urcrnry = y_coords[1] - y_coords[0]
+
+    def __call__(self, lons, lats, inverse=False):
+        """Return the projection (x, y) of the longitudes 'lons' and the
+        latitudes 'lats', or the longitudes and latitudes of the projected
+        (x, y) = (lons, lats) if 'inverse'.
+        """
+
+        if inverse:
+            return self._proj(np.asarray(lons) + self._origin[0],
+                              np.asarray(lats) + self._origin[1],
+                              inverse=True)
+        x_coords, y_coords = self._proj(lons, lats)
+        return (np.asarray(x_coords) - self._origin[0],
+                np.asarray(y_coords) - self._origin[1])
+
+
+def toronto_projection(ellps='WGS84'):
+    """Return the TorontoProjection of the bounding box of Toronto: an
+    equidistant cylindrical projection (as the one of the Basemaps, but in
+    meters), with its true scale at the latitude of the center of the map.
+
+    :param ellps: the ellipsoid of the projection
+    """
+
+    center_lat = (TORONTO_BOUNDING_BOX['llcrnrlat'] +
+                  TORONTO_BOUNDING_BOX['urcrnrlat']) / 2.0
+    return TorontoProjection(dict(proj='eqc', ellps=ellps, lat_ts=center_lat),
+                             **TORONTO_BOUNDING_BOX)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+# pylint: disable=protected-access
+
+"""Benchmark the stages of the visualizations of Toronto on synthetic inputs
+of a configurable size (see synthetic_inputs_toronto), so that it runs
+offline, without the Open Data of the City of Toronto:
+
+ . the ETL of the budget workbook, and its reload from the ETL cache;
+ . the read and the reprojection of a Shapefile, and its reload from the
+   geometry cache;
+ . the simplification of its geometry to the output pixel size;
+ . the construction of the collection of its polygons;
+ . the normalization of its values into face colors, and their
+   classification by natural breaks;
+ . the drawing of the collection and the saving of the figure, with its
+   polygons drawn as paths or filled by scanlines into a raster;
+ . the response to a move of the cursor over the interactive map (the hit
+   test of the polygon under it, and the blit of its highlight).
+
+Each stage is timed separately, several times, and the timings are written
+into a JSON report (with the parameters of the inputs, the versions of the
+libraries and the git commit), which can be compared with the report of
+another commit. The inputs and the caches are in a scratch directory, so
+the caches of the visualizations are not touched.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+import numpy as np
+
+from basemap_cache_toronto import toronto_projection
+import classify_values_toronto
+from classify_values_toronto import classify_breaks
+import geometry_cache_toronto
+from geometry_cache_toronto import load_layer_geometry
+from interactive_picking_toronto import MapInspector
+from patch_layers_toronto import layer_collection
+from raster_composite_toronto import new_agg_figure
+from simplify_geometry_toronto import pixel_tolerance, simplify_layer
+from spatial_index_toronto import ring_bounds
+from synthetic_inputs_toronto import write_budget_workbook, \
+    write_subwards_shapefile
+
+
+# Increase this version whenever the stages or the format of the report
+# change, so that reports of different versions aren't compared
+BENCHMARK_REPORT_VERSION = 1
+
+BENCHMARK_REPORT_FNAME = 'benchmark_report.json'
+
+# The default size of the synthetic inputs: as the real CVA sub-wards and
+# budget workbook, and the size of the figure saved
+DEFAULT_NUM_FEATURES = 600
+DEFAULT_VERTICES_PER_RING = 200
+DEFAULT_NUM_WARDS = 44
+DEFAULT_NUM_ROWS = 2000
+DEFAULT_REPEAT = 3
+BENCHMARK_FIGURE_SIZE_INCHES = (9, 7)
+BENCHMARK_DPI = 150
+
+# A stage is reported as a regression when it is this much slower
+REGRESSION_RATIO = 1.10
+
+# The number of moves of the cursor over the map whose responses are timed
+BENCHMARK_HOVER_MOVES = 50
+
+SUBWARDS_SHAPEFILE = 'synthetic_subwards'
+BUDGET_WORKBOOK = 'synthetic_budget.xlsx'
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Discard what is printed to the standard output (the ETL prints a line
+    per ward)."""
+
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _time_stage(stage, repeat, setup=None):
+    """Run 'stage' (a function without arguments) 'repeat' times, each one
+    after 'setup' if it is given, and return its timings.
+
+    :returns: a dictionary with the list of the timings in seconds, and
+              their minimum, median and mean
+    """
+
+    timings = []
+    for dummy in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        stage()
+        timings.append(timeit.default_timer() - start)
+
+    return dict(timings=timings, min=min(timings),
+                median=float(np.median(timings)),
+                mean=float(np.mean(timings)))
+
+
+def _git_commit():
+    """Return the git commit of this source tree, or None if unknown."""
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _benchmark_stages(params, repeat):
+    """Generate the synthetic inputs in the current directory, and time each
+    stage on them.
+
+    :returns: a dictionary indexed by the name of each stage, with its
+              timings
+    """
+
+    # imported here because the ETL is in the script of the budget (which
+    # imports neither matplotlib nor Basemap)
+    from plot_excel_budget_toronto_neighborhoods import \
+        TorontoBudgetForecastPerCityWard
+
+    write_budget_workbook(BUDGET_WORKBOOK, params['num_rows'],
+                          params['num_wards'])
+    write_subwards_shapefile(SUBWARDS_SHAPEFILE, params['num_features'],
+                             params['vertices_per_ring'],
+                             params['num_wards'])
+
+    stages = dict()
+
+    def etl():
+        """The ETL of the budget workbook."""
+        with _quiet():
+            TorontoBudgetForecastPerCityWard().etl_excel_spreadsheet(
+                BUDGET_WORKBOOK)
+
+    def etl_cached():
+        """The load of the results of the ETL from its cache."""
+        with _quiet():
+            TorontoBudgetForecastPerCityWard().etl_excel_spreadsheet_cached(
+                BUDGET_WORKBOOK)
+
+    stages['etl_excel_spreadsheet'] = _time_stage(etl, repeat)
+    etl_cached()   # fill the ETL cache
+    stages['etl_excel_spreadsheet_cached'] = _time_stage(etl_cached, repeat)
+
+    # the projection of the map by pyproj, without Basemap: the coastline
+    # doesn't change the geometry of the Shapefiles, and reading it isn't a
+    # stage of the benchmark
+    to_map = toronto_projection()
+    layer = load_layer_geometry(to_map, SUBWARDS_SHAPEFILE, 'subwards')
+    cache_fname = os.path.join(
+        'cache_dir', geometry_cache_toronto.GEOMETRY_CACHE_SUBDIR,
+        layer.source_key + geometry_cache_toronto.GEOMETRY_FILE_EXTENSION)
+
+    def forget_layer():
+        """Forget the layer loaded in this process."""
+        geometry_cache_toronto._LOADED_LAYERS.clear()
+
+    def forget_cached_layer():
+        """Forget the layer, also in the geometry cache."""
+        forget_layer()
+        if os.path.exists(cache_fname):
+            os.remove(cache_fname)
+
+    def load_layer():
+        """The load of the layer."""
+        load_layer_geometry(to_map, SUBWARDS_SHAPEFILE, 'subwards')
+
+    stages['readshapefile'] = _time_stage(load_layer, repeat,
+                                          setup=forget_cached_layer)
+    stages['geometry_cache_load'] = _time_stage(load_layer, repeat,
+                                                setup=forget_layer)
+
+    tolerance = pixel_tolerance(to_map, params['dpi'],
+                                BENCHMARK_FIGURE_SIZE_INCHES[0])
+    stages['simplify_layer'] = _time_stage(
+        lambda: simplify_layer(layer, tolerance), repeat)
+
+    values = layer.attributes['avgtaximpa'].astype(np.float64)
+    cmap = plt.get_cmap('Reds')
+
+    def color_normalization():
+        """The face colors of the polygons from their values."""
+        norm = Normalize(values.min(), values.max())
+        return cmap(norm(values))
+
+    stages['color_normalization'] = _time_stage(color_normalization, repeat)
+    stages['jenks_classification'] = _time_stage(
+        lambda: classify_breaks(values, scheme='jenks'), repeat,
+        setup=classify_values_toronto._BREAKS_MEMO.clear)
+    facecolors = color_normalization()
+
+    stages['patch_construction'] = _time_stage(
+        lambda: layer_collection(layer, facecolors=facecolors,
+                                 match_original=True), repeat)
+
+    def savefig(raster=False):
+        """The drawing of the collection into a figure, saved as PNG (with
+        its faces filled by scanlines if 'raster').
+        """
+        fig = new_agg_figure(BENCHMARK_FIGURE_SIZE_INCHES, params['dpi'])
+        axis = fig.add_subplot(111)
+        axis.add_collection(layer_collection(layer, facecolors=facecolors,
+                                             match_original=True,
+                                             raster=raster))
+        axis.set_xlim(to_map.llcrnrx, to_map.urcrnrx)
+        axis.set_ylim(to_map.llcrnry, to_map.urcrnry)
+        fig.savefig(io.BytesIO(), format='png', dpi=params['dpi'])
+
+    stages['savefig'] = _time_stage(savefig, repeat)
+    stages['savefig_scanline'] = _time_stage(lambda: savefig(raster=True),
+                                             repeat)
+
+    # the responses to the cursor moving over the map, each one timed apart
+    fig = new_agg_figure(BENCHMARK_FIGURE_SIZE_INCHES, params['dpi'])
+    axis = fig.add_subplot(111)
+    axis.add_collection(layer_collection(layer, facecolors=facecolors,
+                                         match_original=True))
+    axis.set_xlim(to_map.llcrnrx, to_map.urcrnrx)
+    axis.set_ylim(to_map.llcrnry, to_map.urcrnry)
+    inspector = MapInspector(fig)
+    inspector.add_layer(axis, 'subwards', layer)
+    inspector.connect()
+    fig.canvas.draw()
+    # (each move is to the center of another polygon, so each response
+    # draws the highlight and the tooltip of a new feature)
+    bounds = ring_bounds(layer)[np.random.RandomState(0).randint(
+        len(layer), size=BENCHMARK_HOVER_MOVES)]
+    moves = iter(((bounds[:, :2] + bounds[:, 2:]) / 2.0).tolist())
+
+    def hover():
+        """The hit test and the blit of the overlay for a move."""
+        inspector.hover(axis, *next(moves))
+
+    stages['hover_response'] = _time_stage(hover, BENCHMARK_HOVER_MOVES)
+    return stages
+
+
+def run_benchmark(num_features=DEFAULT_NUM_FEATURES,
+                  vertices_per_ring=DEFAULT_VERTICES_PER_RING,
+                  num_wards=DEFAULT_NUM_WARDS, num_rows=DEFAULT_NUM_ROWS,
+                  dpi=BENCHMARK_DPI, repeat=DEFAULT_REPEAT, work_dir=None):
+    """Run the benchmark on synthetic inputs of the size given.
+
+    :param num_features: the number of polygons of the Shapefile
+    :param vertices_per_ring: the number of vertices of each polygon
+    :param num_wards: the number of wards
+    :param num_rows: the number of rows of the budget workbook
+    :param dpi: the resolution of the figure saved
+    :param repeat: how many times each stage is timed
+    :param work_dir: the directory where to generate the inputs and the
+                     caches (a temporary one, removed at the end, if None)
+    :returns: the report of the benchmark, a dictionary
+    """
+
+    params = dict(num_features=num_features,
+                  vertices_per_ring=vertices_per_ring, num_wards=num_wards,
+                  num_rows=num_rows, dpi=dpi, repeat=repeat)
+
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = work_dir = tempfile.mkdtemp(prefix='TO_benchmark_')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    # the caches are in './cache_dir', so they are in the scratch directory
+    # while the benchmark runs there
+    prev_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        stages = _benchmark_stages(params, repeat)
+    finally:
+        os.chdir(prev_dir)
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return dict(version=BENCHMARK_REPORT_VERSION,
+                created=datetime.datetime.utcnow().isoformat() + 'Z',
+                git_commit=_git_commit(),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                matplotlib=matplotlib.__version__,
+                platform=platform.platform(),
+                params=params,
+                stages=stages)
+
+
+def compare_reports(old_report, new_report):
+    """Compare the minimum timing of each stage in two benchmark reports.
+
+    :returns: the list of (stage, old_seconds, new_seconds, ratio) of the
+              stages in both reports, sorted by stage
+    """
+
+    if old_report.get('version') != new_report.get('version'):
+        raise ValueError('Benchmark reports of different versions: %s, %s' %
+                         (old_report.get('version'),
+                          new_report.get('version')))
+    if old_report.get('params') != new_report.get('params'):
+        raise ValueError('Benchmark reports with different parameters')
+
+    comparison = []
+    for stage in sorted(set(old_report['stages']) &
+                        set(new_report['stages'])):
+        old_seconds = old_report['stages'][stage]['min']
+        new_seconds = new_report['stages'][stage]['min']
+        comparison.append((stage, old_seconds, new_seconds,
+                           new_seconds / old_seconds if old_seconds else
+                           float('inf')))
+    return comparison
+
+
+def main(argv=None, prog=None):
+    """Main function on the program.
+
+    :param argv: the command-line arguments (None for those of the program)
+    :param prog: the name of the program in its usage (None for the name of
+                 its script)
+    """
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Benchmark the stages of the visualizations of Toronto '
+                    'on synthetic inputs')
+    parser.add_argument('--features', type=int, default=DEFAULT_NUM_FEATURES,
+                        help='number of polygons of the synthetic Shapefile '
+                             '(default: %(default)s)')
+    parser.add_argument('--vertices', type=int,
+                        default=DEFAULT_VERTICES_PER_RING,
+                        help='number of vertices of each polygon '
+                             '(default: %(default)s)')
+    parser.add_argument('--wards', type=int, default=DEFAULT_NUM_WARDS,
+                        help='number of wards (default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=DEFAULT_NUM_ROWS,
+                        help='number of rows of the synthetic budget '
+                             'workbook (default: %(default)s)')
+    parser.add_argument('--dpi', type=int, default=BENCHMARK_DPI,
+                        help='resolution of the figure saved (default: '
+                             '%(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='times each stage is timed (default: '
+                             '%(default)s)')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory where to keep the synthetic inputs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output', default=BENCHMARK_REPORT_FNAME,
+                        help='JSON report to write (default: %(default)s)')
+    parser.add_argument('--compare', metavar='OLD_REPORT', default=None,
+                        help='JSON report of another run to compare with')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(num_features=args.features,
+                           vertices_per_ring=args.vertices,
+                           num_wards=args.wards, num_rows=args.rows,
+                           dpi=args.dpi, repeat=args.repeat,
+                           work_dir=args.work_dir)
+    with open(args.output, 'w') as out_file:
+        json.dump(report, out_file, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+
+    for stage in sorted(report['stages']):
+        print('%-30s %10.4f s' % (stage, report['stages'][stage]['min']))
+
+    if args.compare:
+        with open(args.compare) as in_file:
+            old_report = json.load(in_file)
+        print('\n%-30s %10s %10s %8s' % ('stage', 'old (s)', 'new (s)',
+                                         'ratio'))
+        for stage, old_seconds, new_seconds, ratio in \
+                compare_reports(old_report, report):
+            print('%-30s %10.4f %10.4f %8.2f%s' %
+                  (stage, old_seconds, new_seconds, ratio,
+                   '  <- slower' if ratio > REGRESSION_RATIO else ''))
+
+
+if __name__ == '__main__':
+    main()
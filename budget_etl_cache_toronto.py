@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""A content-addressed cache of the results of the ETL on the Excel
+spreadsheet with the budgets of the City of Toronto per ward (the budgets per
+ward and per year, and the validation report of the ETL), so that the
+spreadsheet is not parsed again while it doesn't change.
+
+The results are saved as a '.npz' file under './cache_dir/budget_etl',
+keyed by the SHA-1 of the spreadsheet and by BUDGET_ETL_VERSION, which must
+be increased whenever the ETL changes its results. The cache directory is
+kept bounded by evicting the entries least recently used, or not used in a
+while.
+"""
+
+import os
+
+from cache_dir_toronto import cache_subdir, cache_key, evict_cache_entries
+
+
+BUDGET_ETL_CACHE_SUBDIR = 'budget_etl'
+
+# Increase this version whenever the ETL changes its results
+BUDGET_ETL_VERSION = 2
+
+# The limits of the size of the cache directory and of the age of its
+# entries (the age since the entry was last used)
+BUDGET_ETL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+BUDGET_ETL_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+
+
+def budget_etl_cache_fname(excel_spreadsh_fname, first_year=None):
+    """Return the path of the cache entry with the results of the ETL on the
+    Excel spreadsheet 'excel_spreadsh_fname' (for its current content),
+    with the budget year 'first_year' of its first budget column if the
+    spreadsheet has no header row with the budget years (None for the
+    default one).
+    """
+
+    params = ('budget_etl', BUDGET_ETL_VERSION)
+    if first_year is not None:
+        params += (first_year,)
+    key = cache_key([excel_spreadsh_fname], params)
+    return os.path.join(cache_subdir(BUDGET_ETL_CACHE_SUBDIR), key + '.npz')
+
+
+def invalidate_budget_etl_cache(excel_spreadsh_fname=None):
+    """Remove the cached ETL results of the Excel spreadsheet
+    'excel_spreadsh_fname', or all the cached ETL results if it is None.
+
+    :returns: the number of cache entries removed
+    """
+
+    if excel_spreadsh_fname is not None:
+        cache_fnames = [budget_etl_cache_fname(excel_spreadsh_fname)]
+    else:
+        cache_dir = cache_subdir(BUDGET_ETL_CACHE_SUBDIR)
+        cache_fnames = [os.path.join(cache_dir, fname)
+                        for fname in os.listdir(cache_dir)]
+
+    num_removed = 0
+    for cache_fname in cache_fnames:
+        try:
+            os.remove(cache_fname)
+            num_removed += 1
+        except OSError:
+            pass
+    return num_removed
+
+
+def evict_budget_etl_cache(max_total_bytes=BUDGET_ETL_CACHE_MAX_BYTES,
+                           max_age_seconds=BUDGET_ETL_CACHE_MAX_AGE_SECONDS):
+    """Evict the cached ETL results not used in the last 'max_age_seconds',
+    and then the least recently used ones until the cache takes at most
+    'max_total_bytes'.
+
+    :returns: the list of the files evicted
+    """
+
+    return evict_cache_entries(BUDGET_ETL_CACHE_SUBDIR,
+                               max_total_bytes=max_total_bytes,
+                               max_age_seconds=max_age_seconds)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""The budgets of the projects and sub-projects of each ward in the Capital
+Budget & Plan of the City of Toronto, which the ETL of the budget
+spreadsheet keeps besides the budget totals per ward, so that the projects
+can be queried (e.g., the top projects of ward 20 in 2018) and mapped
+without parsing the spreadsheet again.
+
+The projects are a columnar table: an array per column (the ward, the
+project and the sub-project of each row, these two as codes into the sorted
+lists of their names, and the matrix row x year of their budgets), with
+the rows of each ward together, and with indexes built once with the table:
+the offsets of the rows of each ward, the rows of each project (sorted by
+project, with their offsets), the column of each budget year, and the
+budgets of all the projects of each ward per year. A query is then a slice
+or a gather of the rows of a ward or of a project, instead of a scan.
+
+The totals are reconciled for all the rows at once, with a tolerance
+(the totals in the spreadsheet are rounded, and the addition of floats
+depends on its order): the explicit total of each row against the addition
+of its budgets year by year, and the budgets of all the projects of each
+ward against its row of budget totals.
+"""
+
+import numpy as np
+
+
+# The tolerances of the reconciliation of the totals: the relative one, and
+# the absolute one (half the unit of the budgets, which the spreadsheet
+# rounds)
+TOTAL_RELATIVE_TOLERANCE = 1e-9
+TOTAL_ABSOLUTE_TOLERANCE = 0.5
+
+# The number of projects returned by top_projects() by default
+DEFAULT_NUM_TOP_PROJECTS = 10
+
+
+def totals_agree(explicit_totals, calculated_totals,
+                 rtol=TOTAL_RELATIVE_TOLERANCE,
+                 atol=TOTAL_ABSOLUTE_TOLERANCE):
+    """Return a bool array with whether each explicit total (e.g., in the
+    spreadsheet) agrees with its calculated total, within the relative
+    tolerance 'rtol' and the absolute tolerance 'atol'.
+    """
+
+    return np.isclose(explicit_totals, calculated_totals, rtol=rtol,
+                      atol=atol)
+
+
+def _name_codes(names):
+    """Return the tuple (sorted list of the distinct names, int64 array with
+    the index of each name of 'names' in that list).
+    """
+
+    if not len(names):
+        return [], np.zeros(0, dtype=np.int64)
+    distinct_names, codes = np.unique(np.array(names, dtype='U'),
+                                      return_inverse=True)
+    return distinct_names.tolist(), codes.astype(np.int64)
+
+
+class BudgetProjectTable(object):
+
+    """The budgets per year of the projects and sub-projects of the wards,
+    as a columnar table.
+
+    Fields (the row columns have an element per row of the table, with the
+    rows of each ward together, in increasing order of ward, and in the
+    order of the spreadsheet within a ward):
+
+       years: the list of the budget years (the columns of 'budgets')
+
+       project_names: the list of the names of the projects, sorted
+
+       sub_project_names: the list of the names of the sub-projects, sorted
+                          (u'' for a project without sub-projects)
+
+       row_wards: an int64 array with the ward number of each row
+
+       row_projects: an int64 array with the index in 'project_names' of
+                     the project of each row
+
+       row_sub_projects: an int64 array with the index in
+                         'sub_project_names' of the sub-project of each row
+
+       budgets: a float64 array of shape (num_rows, num_years), whose value
+                [i, j] is the budget of row i in the year 'years[j]'
+
+       totals: a float64 array with the explicit total of each row in the
+               spreadsheet
+
+       ward_numbers: an int64 array with the ward numbers which have
+                     projects, in increasing order
+
+       ward_offsets: an int64 array of num_wards + 1 elements, so that the
+                     rows of ward 'ward_numbers[i]' are
+                     ward_offsets[i]:ward_offsets[i + 1]
+
+       ward_budgets: a float64 array of shape (num_wards, num_years), whose
+                     value [i, j] is the budget of all the projects of ward
+                     'ward_numbers[i]' in the year 'years[j]'
+
+       project_rows: an int64 array with the rows sorted (stably) by
+                     project, so that the rows of 'project_names[i]' are
+                     project_rows[project_offsets[i]:project_offsets[i + 1]]
+
+       project_offsets: an int64 array of num_projects + 1 elements with
+                        the offsets of the rows of each project in
+                        'project_rows'
+
+       _year_columns: a dictionary indexed by budget year, with its column
+                      in 'budgets'
+    """
+
+    def __init__(self, years=(), project_names=(), sub_project_names=(),
+                 row_wards=(), row_projects=(), row_sub_projects=(),
+                 budgets=None, totals=()):
+
+        self.years = list(years)
+        self.project_names = list(project_names)
+        self.sub_project_names = list(sub_project_names)
+
+        row_wards = np.asarray(row_wards, dtype=np.int64)
+        if budgets is None:
+            budgets = np.zeros((len(row_wards), len(self.years)))
+        # (the rows of each ward together, in the order of the spreadsheet)
+        order = np.argsort(row_wards, kind='mergesort')
+        self.row_wards = row_wards[order]
+        self.row_projects = np.asarray(row_projects, dtype=np.int64)[order]
+        self.row_sub_projects = np.asarray(row_sub_projects,
+                                           dtype=np.int64)[order]
+        self.budgets = np.asarray(budgets, dtype=np.float64).reshape(
+            len(row_wards), len(self.years))[order]
+        self.totals = np.asarray(totals, dtype=np.float64)[order]
+
+        self.ward_numbers, ward_starts = np.unique(self.row_wards,
+                                                   return_index=True)
+        self.ward_offsets = np.append(ward_starts,
+                                      len(self.row_wards)).astype(np.int64)
+        self.ward_budgets = np.add.reduceat(self.budgets, ward_starts) \
+            if len(self.row_wards) else \
+            np.zeros((0, len(self.years)))
+
+        self.project_rows = np.argsort(self.row_projects,
+                                       kind='mergesort').astype(np.int64)
+        self.project_offsets = np.searchsorted(
+            self.row_projects[self.project_rows],
+            np.arange(len(self.project_names) + 1)).astype(np.int64)
+
+        self._year_columns = dict((year, year_idx)
+                                  for year_idx, year in enumerate(self.years))
+
+    @classmethod
+    def from_rows(cls, years, row_wards, projects, sub_projects, budgets,
+                  totals):
+        """Build the table of the rows with the ward numbers 'row_wards',
+        the names of the projects 'projects' and of the sub-projects
+        'sub_projects', the budgets per year 'budgets' (of shape (num_rows,
+        num_years)) and the explicit totals 'totals'.
+        """
+
+        project_names, row_projects = _name_codes(projects)
+        sub_project_names, row_sub_projects = _name_codes(sub_projects)
+        return cls(years, project_names, sub_project_names, row_wards,
+                   row_projects, row_sub_projects, budgets, totals)
+
+    def __len__(self):
+        """The number of rows of the table."""
+
+        return len(self.row_wards)
+
+    def rows(self):
+        """Return the tuple (row_wards, projects, sub_projects, budgets,
+        totals) of the rows of the table, with the names of their projects
+        and sub-projects (see from_rows()).
+        """
+
+        return (self.row_wards,
+                [self.project_names[code] for code in self.row_projects],
+                [self.sub_project_names[code]
+                 for code in self.row_sub_projects],
+                self.budgets, self.totals)
+
+    def take(self, rows):
+        """Return the table with only the rows 'rows' (an array of rows) of
+        this table (and the same names of the projects and sub-projects).
+        """
+
+        return BudgetProjectTable(self.years, self.project_names,
+                                  self.sub_project_names,
+                                  self.row_wards[rows],
+                                  self.row_projects[rows],
+                                  self.row_sub_projects[rows],
+                                  self.budgets[rows], self.totals[rows])
+
+    def merged(self, newer_table):
+        """Return the table with the rows of 'newer_table' and the rows of
+        this table of the wards which aren't in 'newer_table' (of the same
+        budget years).
+        """
+
+        if not len(self):
+            return newer_table
+        old_rows = self.take(np.flatnonzero(
+            ~np.isin(self.row_wards, newer_table.ward_numbers))).rows()
+        new_rows = newer_table.rows()
+        return BudgetProjectTable.from_rows(
+            newer_table.years,
+            np.concatenate((old_rows[0], new_rows[0])),
+            old_rows[1] + new_rows[1], old_rows[2] + new_rows[2],
+            np.vstack((old_rows[3], new_rows[3])),
+            np.concatenate((old_rows[4], new_rows[4])))
+
+    def arrays(self, prefix='projects_'):
+        """Return a dictionary with the arrays of the table (e.g., to save
+        them into a '.npz' file), their names starting with 'prefix'.
+        """
+
+        return dict((prefix + name, value) for name, value in (
+            ('years', np.array(self.years, dtype=np.int64)),
+            ('project_names', np.array(self.project_names, dtype='U')),
+            ('sub_project_names', np.array(self.sub_project_names,
+                                           dtype='U')),
+            ('row_wards', self.row_wards),
+            ('row_projects', self.row_projects),
+            ('row_sub_projects', self.row_sub_projects),
+            ('budgets', self.budgets),
+            ('totals', self.totals)))
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='projects_'):
+        """Build the table from the arrays returned by arrays() (e.g., a
+        '.npz' file loaded).
+
+        Raises KeyError if an array is missing.
+        """
+
+        return cls(arrays[prefix + 'years'].tolist(),
+                   arrays[prefix + 'project_names'].tolist(),
+                   arrays[prefix + 'sub_project_names'].tolist(),
+                   arrays[prefix + 'row_wards'],
+                   arrays[prefix + 'row_projects'],
+                   arrays[prefix + 'row_sub_projects'],
+                   arrays[prefix + 'budgets'],
+                   arrays[prefix + 'totals'])
+
+    def ward_rows(self, ward_number):
+        """Return the slice of the rows of the projects of ward
+        'ward_number'.
+
+        Raises KeyError if the ward doesn't have projects.
+        """
+
+        ward_idx = np.searchsorted(self.ward_numbers, ward_number)
+        if ward_idx == len(self.ward_numbers) or \
+           self.ward_numbers[ward_idx] != ward_number:
+            raise KeyError("No projects for ward %s" % ward_number)
+        return slice(self.ward_offsets[ward_idx],
+                     self.ward_offsets[ward_idx + 1])
+
+    def _ward_indices(self, ward_numbers):
+        """Return the tuple (int64 array with the index in 'ward_numbers' of
+        this table of each ward of 'ward_numbers', bool array with whether
+        the ward has projects; the index of a ward without projects is
+        meaningless).
+        """
+
+        ward_numbers = np.asarray(ward_numbers, dtype=np.int64)
+        if not len(self.ward_numbers):
+            return (np.zeros(len(ward_numbers), dtype=np.int64),
+                    np.zeros(len(ward_numbers), dtype=bool))
+        ward_idx = np.minimum(np.searchsorted(self.ward_numbers,
+                                              ward_numbers),
+                              len(self.ward_numbers) - 1)
+        return ward_idx, self.ward_numbers[ward_idx] == ward_numbers
+
+    def project_rows_of(self, project_name):
+        """Return the int64 array with the rows of the project
+        'project_name' (of all its sub-projects, in all the wards).
+
+        Raises KeyError if there is no such project.
+        """
+
+        project_idx = np.searchsorted(self.project_names, project_name)
+        if project_idx == len(self.project_names) or \
+           self.project_names[project_idx] != project_name:
+            raise KeyError("No project named %s" % project_name)
+        return self.project_rows[self.project_offsets[project_idx]:
+                                 self.project_offsets[project_idx + 1]]
+
+    def row_budgets(self, rows, year=None):
+        """Return the float64 array with the budget of the rows 'rows' (a
+        slice or an array of rows) in the budget 'year', or in all the years
+        span if 'year' is None.
+
+        Raises KeyError if the year doesn't have a budget.
+        """
+
+        if year is None:
+            return self.budgets[rows].sum(axis=1)
+        if year not in self._year_columns:
+            raise KeyError("No budget for the year %s" % year)
+        return self.budgets[rows, self._year_columns[year]]
+
+    def top_projects(self, ward_number, year=None,
+                     num_projects=DEFAULT_NUM_TOP_PROJECTS):
+        """Return the projects of ward 'ward_number' with the largest
+        budgets in the budget 'year' (or in all the years span if 'year' is
+        None), at most 'num_projects' of them, as the list of tuples
+        (project name, sub-project name, budget), the largest first (and
+        in the order of the spreadsheet among equal budgets).
+
+        Raises KeyError if the ward doesn't have projects, or the year
+        doesn't have a budget.
+        """
+
+        rows = self.ward_rows(ward_number)
+        budgets = self.row_budgets(rows, year)
+        top = np.argsort(-budgets, kind='mergesort')[:num_projects]
+        return [(self.project_names[project_code],
+                 self.sub_project_names[sub_project_code], budget)
+                for project_code, sub_project_code, budget
+                in zip(self.row_projects[rows][top].tolist(),
+                       self.row_sub_projects[rows][top].tolist(),
+                       budgets[top].tolist())]
+
+    def project_budget_for_wards(self, ward_numbers, project_name,
+                                 year=None):
+        """Return a float64 array with the budget of the project
+        'project_name' (of all its sub-projects) in each ward of
+        'ward_numbers' (e.g., in the order of the polygons of the wards in
+        a shapefile, to map it) in the budget 'year', or in all the years
+        span if 'year' is None (0.0 in the wards without that project).
+
+        Raises KeyError if there is no such project, or the year doesn't
+        have a budget.
+        """
+
+        rows = self.project_rows_of(project_name)
+        per_ward = np.bincount(
+            np.searchsorted(self.ward_numbers, self.row_wards[rows]),
+            weights=self.row_budgets(rows, year),
+            minlength=len(self.ward_numbers))
+
+        ward_idx, found = self._ward_indices(ward_numbers)
+        return np.where(found, per_ward[ward_idx] if len(per_ward) else 0.0,
+                        0.0)
+
+    def ward_budget_matrix(self, ward_numbers):
+        """Return a float64 array of shape (len(ward_numbers), num_years)
+        with the budget of all the projects of each ward of 'ward_numbers'
+        in each budget year (0.0 for the wards without projects).
+        """
+
+        ward_idx, found = self._ward_indices(ward_numbers)
+        budget_matrix = np.zeros((len(found), len(self.years)))
+        budget_matrix[found] = self.ward_budgets[ward_idx[found]]
+        return budget_matrix
+
+    def reconcile_row_totals(self, rtol=TOTAL_RELATIVE_TOLERANCE,
+                             atol=TOTAL_ABSOLUTE_TOLERANCE):
+        """Return a bool array with whether the explicit total of each row
+        agrees with the addition of its budgets year by year, within the
+        tolerances 'rtol' and 'atol'.
+        """
+
+        return totals_agree(self.totals, self.budgets.sum(axis=1), rtol,
+                            atol)
+
+    def reconcile_ward_budgets(self, ward_numbers, budget_matrix,
+                               rtol=TOTAL_RELATIVE_TOLERANCE,
+                               atol=TOTAL_ABSOLUTE_TOLERANCE):
+        """Return a bool array of the shape of 'budget_matrix' with whether
+        the budgets of all the projects of each ward of 'ward_numbers' in
+        each budget year agree with its budget in 'budget_matrix' (the
+        matrix ward x year of the rows with the budget totals of the wards,
+        of the same years), within the tolerances 'rtol' and 'atol'. The
+        wards without projects in this table always agree.
+        """
+
+        dummy, found = self._ward_indices(ward_numbers)
+        agree = totals_agree(budget_matrix,
+                             self.ward_budget_matrix(ward_numbers), rtol,
+                             atol)
+        agree[~found] = True
+        return agree
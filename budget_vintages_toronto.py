@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""Ingest several Capital Budget & Plan workbooks of the City of Toronto, one
+per fiscal vintage (the year in which the 10-year plan was proposed), into a
+single cube of budgets ward x budget year x vintage, to compare how the
+plans for the same wards and years changed from one vintage to the next.
+
+Each workbook is parsed by TorontoBudgetForecastPerCityWard, which takes the
+layout of its columns (the budget years, and the subtotal and total columns
+to skip) from its header row, so the workbooks of different vintages can
+have different layouts. The vintage of a workbook is the year in its file
+name (e.g., 'capital_budget_2017.xlsx'), or else the first budget year of
+its plan; for a workbook without a header row, that year in its file name
+is also the budget year of its first budget column.
+
+The workbooks are parsed in parallel by a pool of worker processes (each one
+with the cache of the ETL, so only the workbooks which changed are parsed
+again), and their budget matrices are merged into the cube at the end.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+from cache_dir_toronto import atomic_save_npz
+from plot_excel_budget_toronto_neighborhoods import \
+    TorontoBudgetForecastPerCityWard
+from stage_profiler_toronto import enable_profiling, save_profile, \
+    profile_stage
+
+
+# The year of the vintage in the file name of a workbook
+_RE_VINTAGE = re.compile(r'(?<![0-9])(?P<year>(19|20)[0-9][0-9])(?![0-9])')
+
+
+def workbook_vintage(excel_spreadsh_fname):
+    """Return the year of the vintage in the file name of the workbook
+    'excel_spreadsh_fname' (the last one, if there are several), or None if
+    it doesn't have any.
+    """
+
+    years = _RE_VINTAGE.findall(os.path.basename(excel_spreadsh_fname))
+    return int(years[-1][0]) if years else None
+
+
+def _etl_workbook(excel_spreadsh_fname):
+    """Do the ETL of the workbook 'excel_spreadsh_fname' in a worker process.
+
+    :returns: the tuple (vintage, years, ward_numbers, budget_matrix,
+              validation_report) with the results of the ETL
+    """
+
+    vintage = workbook_vintage(excel_spreadsh_fname)
+    budget = TorontoBudgetForecastPerCityWard(default_first_year=vintage)
+    with profile_stage('etl_workbook', workbook=excel_spreadsh_fname):
+        budget.etl_excel_spreadsheet_cached(excel_spreadsh_fname)
+    if vintage is None:
+        vintage = budget._years[0] if budget._years else None
+    return (vintage, budget._years, budget._ward_numbers,
+            budget._budget_matrix, budget._validation_report)
+
+
+class TorontoBudgetPlanVintages(object):
+
+    """The budgets per ward of several vintages of the Capital Budget & Plan
+    of the City of Toronto.
+
+    Fields:
+
+       vintages: the list of the vintages, in increasing order
+
+       years: the list of the budget years of all the vintages, in
+              increasing order
+
+       ward_numbers: an int array with the ward numbers of all the
+                     vintages, in increasing order
+
+       budget_cube: a float64 array of shape (num_wards, num_years,
+                    num_vintages), whose value [i, j, k] is the budget of
+                    ward 'ward_numbers[i]' in the year 'years[j]' in the
+                    plan of vintage 'vintages[k]' (NaN if that plan has no
+                    budget for that ward and year)
+
+       validation_reports: a dictionary indexed by vintage, with the list
+                           of messages about the rows of its workbook which
+                           failed the validation of the ETL
+    """
+
+    def __init__(self):
+
+        self.vintages = []
+        self.years = []
+        self.ward_numbers = np.zeros(0, dtype=np.int64)
+        self.budget_cube = np.zeros((0, 0, 0), dtype=np.float64)
+        self.validation_reports = dict()
+
+    def ingest_workbooks(self, excel_spreadsh_fnames, processes=None):
+        """Do the ETL of the workbooks 'excel_spreadsh_fnames', one per
+        vintage, with a pool of 'processes' worker processes (None for as
+        many as CPUs, 1 to do it in this process), and merge their budgets
+        into the 'budget_cube'.
+
+        Raises ValueError if two workbooks are of the same vintage, or if
+        the vintage of a workbook is unknown.
+        """
+
+        if processes == 1 or len(excel_spreadsh_fnames) <= 1:
+            results = [_etl_workbook(fname)
+                       for fname in excel_spreadsh_fnames]
+        else:
+            pool = multiprocessing.Pool(
+                processes=min(len(excel_spreadsh_fnames),
+                              processes or multiprocessing.cpu_count()))
+            try:
+                results = pool.map(_etl_workbook, excel_spreadsh_fnames)
+            finally:
+                pool.close()
+                pool.join()
+
+        vintages = [result[0] for result in results]
+        for fname, vintage in zip(excel_spreadsh_fnames, vintages):
+            if vintage is None:
+                raise ValueError('Unknown vintage of the workbook %s: it '
+                                 'has no budget years' % fname)
+        if len(set(vintages)) != len(vintages):
+            raise ValueError('Several workbooks of the same vintage: %s' %
+                             sorted(vintages))
+
+        with profile_stage('merge_budget_cube'):
+            self._merge_vintages(results)
+
+    def _merge_vintages(self, results):
+        """Merge the results of the ETL of each workbook, the tuples
+        (vintage, years, ward_numbers, budget_matrix, validation_report),
+        into the 'budget_cube'.
+        """
+
+        results = sorted(results, key=lambda result: result[0])
+        self.vintages = [result[0] for result in results]
+        self.years = sorted(set(year for result in results
+                                for year in result[1]))
+        self.ward_numbers = np.unique(np.concatenate(
+            [np.zeros(0, dtype=np.int64)] +
+            [result[2] for result in results])).astype(np.int64)
+        self.validation_reports = dict((result[0], result[4])
+                                       for result in results)
+
+        self.budget_cube = np.full((len(self.ward_numbers), len(self.years),
+                                    len(self.vintages)), np.nan)
+        for vintage_idx, result in enumerate(results):
+            dummy, years, ward_numbers, budget_matrix, dummy = result
+            if not budget_matrix.size:
+                continue
+            rows = np.searchsorted(self.ward_numbers, ward_numbers)
+            columns = np.searchsorted(self.years, years)
+            self.budget_cube[rows[:, np.newaxis], columns[np.newaxis, :],
+                             vintage_idx] = budget_matrix
+
+    def _ward_rows(self, ward_numbers):
+        """Return the rows in the 'budget_cube' of the wards in
+        'ward_numbers'.
+
+        Raises KeyError if a ward isn't in any vintage.
+        """
+
+        ward_numbers = np.asarray(ward_numbers, dtype=np.int64)
+        rows = np.searchsorted(self.ward_numbers, ward_numbers)
+        rows = np.minimum(rows, max(len(self.ward_numbers) - 1, 0))
+        if len(self.ward_numbers) == 0 or \
+           np.any(self.ward_numbers[rows] != ward_numbers):
+            missing = np.setdiff1d(ward_numbers, self.ward_numbers)
+            raise KeyError("No budget for wards %s" % missing.tolist())
+        return rows
+
+    def budget_for_wards(self, ward_numbers, vintage):
+        """Return a float64 array of shape (len(ward_numbers), num_years)
+        with the budget of each ward in 'ward_numbers' for each budget year
+        in the plan of 'vintage' (NaN for the years outside that plan).
+
+        Raises KeyError if a ward or the vintage doesn't have a budget.
+        """
+
+        if vintage not in self.vintages:
+            raise KeyError("No budget plan of vintage %s" % vintage)
+        return self.budget_cube[self._ward_rows(ward_numbers), :,
+                                self.vintages.index(vintage)]
+
+    def plan_revisions(self, ward_numbers, old_vintage, new_vintage):
+        """Return a float64 array of shape (len(ward_numbers), num_years)
+        with how much the plan of 'new_vintage' changed the budget of each
+        ward in 'ward_numbers' for each budget year, with respect to the plan
+        of 'old_vintage' (NaN for the years not in both plans).
+        """
+
+        return self.budget_for_wards(ward_numbers, new_vintage) - \
+            self.budget_for_wards(ward_numbers, old_vintage)
+
+    def city_budget(self):
+        """Return a float64 array of shape (num_years, num_vintages) with
+        the budget of the whole city for each budget year in the plan of each
+        vintage (NaN for the years outside that plan).
+        """
+
+        in_plan = np.any(~np.isnan(self.budget_cube), axis=0)
+        return np.where(in_plan, np.nansum(self.budget_cube, axis=0), np.nan)
+
+    def save(self, npz_fname):
+        """Save the budget cube into the '.npz' file 'npz_fname'."""
+
+        atomic_save_npz(npz_fname,
+                        vintages=np.array(self.vintages, dtype=np.int64),
+                        years=np.array(self.years, dtype=np.int64),
+                        ward_numbers=self.ward_numbers,
+                        budget_cube=self.budget_cube)
+
+    def load(self, npz_fname):
+        """Load the budget cube saved by save() in the '.npz' file
+        'npz_fname' (without the validation reports).
+        """
+
+        with np.load(npz_fname, allow_pickle=False) as npz_file:
+            self.vintages = npz_file['vintages'].tolist()
+            self.years = npz_file['years'].tolist()
+            self.ward_numbers = npz_file['ward_numbers']
+            self.budget_cube = npz_file['budget_cube']
+        self.validation_reports = dict()
+
+
+def print_city_budget(plan_vintages):
+    """Print the budget of the whole city per budget year (the rows) in the
+    plan of each vintage (the columns), in millions.
+    """
+
+    print('%-6s' % 'year' + ''.join('%12d' % vintage
+                                    for vintage in plan_vintages.vintages))
+    city_budget = plan_vintages.city_budget()
+    for year_idx, year in enumerate(plan_vintages.years):
+        print('%-6d' % year +
+              ''.join('%12s' % ('-' if np.isnan(value) else
+                                '%.1f' % (value / 1e6))
+                      for value in city_budget[year_idx]))
+
+
+def main():
+    """Main function on the program.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Ingest several vintages of the Capital Budget & Plan '
+                    'of the City of Toronto into a budget cube')
+    parser.add_argument('workbooks', metavar='WORKBOOK', nargs='+',
+                        help='Excel workbook of the budget per ward of a '
+                             'vintage (with its year in its file name)')
+    parser.add_argument('--output', metavar='NPZ_FNAME',
+                        help='save the budget cube ward x year x vintage '
+                             'into NPZ_FNAME')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes parsing the '
+                             'workbooks (default: as many as CPUs)')
+    parser.add_argument('--profile', metavar='TRACE_FNAME',
+                        help='profile the time and memory of each stage, '
+                             'into a JSON trace of events in TRACE_FNAME')
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling(args.profile)
+    try:
+        plan_vintages = TorontoBudgetPlanVintages()
+        plan_vintages.ingest_workbooks(args.workbooks,
+                                       processes=args.processes)
+        print_city_budget(plan_vintages)
+        if args.output:
+            plan_vintages.save(args.output)
+            print('Budget cube saved into %s' % args.output)
+    finally:
+        save_profile()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""A build graph of the outputs of the visualizations of Toronto (the
+rasters of the panels, the images, the budget maps, ...), so that when one
+of their inputs changes (the budget spreadsheet, or one of the Shapefiles)
+only the outputs which depend on it are regenerated.
+
+Each target of the graph has a key, derived from the SHA-1 of its input
+files, from its parameters (the colormap, the bounding box, the DPI, ...)
+and from the keys of the targets it depends on. The key with which each
+target was last built is recorded in a manifest under './cache_dir/build',
+and a target is stale if its key changed since then or if any of its output
+files is missing. Building the graph builds only its stale targets, in
+order of their dependencies, and the stale targets which don't depend on
+each other are built in parallel by a pool of worker processes.
+"""
+
+import json
+import multiprocessing
+import os
+
+from cache_dir_toronto import cache_subdir, cache_key, atomic_write
+
+
+BUILD_CACHE_SUBDIR = 'build'
+
+
+def _run_build(build_call):
+    """Run the build of a target (in a worker process).
+
+    :param build_call: the tuple (build, args) with the function which
+                       builds the target, and its arguments
+    """
+
+    build, args = build_call
+    return build(*args)
+
+
+class BuildGraph(object):
+
+    """A graph of build targets.
+
+    Fields:
+
+       _targets: a dictionary indexed by the name of each target, with its
+                 build function and arguments, input files, parameters,
+                 dependencies and output files
+
+       _keys: the keys of the targets, as they are computed
+
+       _manifest_fname: the manifest with the key with which each target was
+                        last built
+
+       _manifest: the content of that manifest, a dictionary indexed by the
+                  name of each target
+    """
+
+    def __init__(self, graph_name):
+
+        self._targets = dict()
+        self._keys = dict()
+        self._manifest_fname = os.path.join(cache_subdir(BUILD_CACHE_SUBDIR),
+                                            graph_name + '.json')
+        try:
+            with open(self._manifest_fname) as in_file:
+                self._manifest = json.load(in_file)
+        except (IOError, OSError, ValueError):
+            self._manifest = dict()
+
+    def add_target(self, name, build, args=(), input_files=(), params=(),
+                   deps=(), outputs=()):
+        """Add the target 'name' to the graph.
+
+        :param name: the name of the target
+        :param build: the function which builds the target, a module-level
+                      function (it can be run in a worker process)
+        :param args: the arguments of 'build'
+        :param input_files: the files which the target reads
+        :param params: the parameters of the target (with a stable repr())
+        :param deps: the names of the targets which this one depends on
+                     (they must have been added to the graph before)
+        :param outputs: the files which the target writes
+        """
+
+        for dep in deps:
+            if dep not in self._targets:
+                raise KeyError('Unknown dependency %r of target %r' %
+                               (dep, name))
+        self._targets[name] = dict(build=build, args=tuple(args),
+                                   input_files=list(input_files),
+                                   params=params, deps=list(deps),
+                                   outputs=list(outputs))
+
+    def target_key(self, name):
+        """Return the key of the target 'name', from its input files, its
+        parameters and the keys of its dependencies.
+        """
+
+        key = self._keys.get(name)
+        if key is None:
+            target = self._targets[name]
+            key = cache_key(target['input_files'],
+                            (name, target['params'],
+                             [self.target_key(dep)
+                              for dep in target['deps']]))
+            self._keys[name] = key
+        return key
+
+    def is_stale(self, name):
+        """Return whether the target 'name' has to be built again."""
+
+        if self._manifest.get(name) != self.target_key(name):
+            return True
+        return not all(os.path.exists(output)
+                       for output in self._targets[name]['outputs'])
+
+    def stale_targets(self):
+        """Return the names of the stale targets, in build order."""
+
+        return [name for level in self._levels() for name in level
+                if self.is_stale(name)]
+
+    def _levels(self):
+        """Return the targets grouped by their depth in the graph: each
+        target depends only on targets of the previous levels.
+        """
+
+        depths = dict()
+
+        def depth(name):
+            """The length of the longest chain of dependencies of 'name'."""
+            if name not in depths:
+                depths[name] = 1 + max([depth(dep) for dep
+                                        in self._targets[name]['deps']] or
+                                       [-1])
+            return depths[name]
+
+        levels = []
+        for name in sorted(self._targets):
+            target_depth = depth(name)
+            while len(levels) <= target_depth:
+                levels.append([])
+            levels[target_depth].append(name)
+        return levels
+
+    def build(self, processes=None):
+        """Build the stale targets of the graph, in order of their
+        dependencies, with a pool of 'processes' worker processes (None for
+        as many as CPUs, 1 to build them in this process).
+
+        :returns: the names of the targets built
+        """
+
+        built = []
+        for level in self._levels():
+            stale = [name for name in level if self.is_stale(name)]
+            if not stale:
+                continue
+
+            build_calls = [(self._targets[name]['build'],
+                            self._targets[name]['args']) for name in stale]
+            if processes == 1 or len(stale) == 1:
+                for build_call in build_calls:
+                    _run_build(build_call)
+            else:
+                pool = multiprocessing.Pool(
+                    processes=min(len(stale), processes or
+                                  multiprocessing.cpu_count()))
+                try:
+                    pool.map(_run_build, build_calls)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for name in stale:
+                self._manifest[name] = self.target_key(name)
+            self._save_manifest()
+            built.extend(stale)
+
+        return built
+
+    def _save_manifest(self):
+        """Save the key with which each target was last built."""
+
+        atomic_write(self._manifest_fname,
+                     json.dumps(self._manifest, indent=1, sort_keys=True,
+                                separators=(',', ': ')))
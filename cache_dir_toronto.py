@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""Helpers for the on-disk caches of this project (the geometry of the ESRI
+Shapefiles of the City of Toronto, etc), which are saved under the directory
+'./cache_dir'.
+
+The entries in these caches are keyed by the SHA-1 digest of the content of
+their source files (and of any other parameter which changes their result),
+so a cache entry becomes unreachable (stale) as soon as its source file
+changes, without needing to compare timestamps.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+CACHE_ROOT_DIR = './cache_dir'
+
+# The digest of a file is memoized in this JSON index by (path, size, mtime),
+# so that the big shapefiles aren't re-hashed on every run if they haven't
+# been modified
+_DIGEST_INDEX_FNAME = 'file_digests.json'
+
+
+def cache_subdir(subdir_name, cache_root_dir=CACHE_ROOT_DIR):
+    """Return the path to the sub-directory 'subdir_name' of the cache,
+    creating it if it doesn't exist yet.
+    """
+
+    path = os.path.join(cache_root_dir, subdir_name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another process can have created it meanwhile
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def _load_digest_index(cache_root_dir):
+    """Load the JSON index with the memoized digests of files."""
+
+    index_fname = os.path.join(cache_root_dir, _DIGEST_INDEX_FNAME)
+    try:
+        with open(index_fname, 'r') as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def _save_digest_index(digest_index, cache_root_dir):
+    """Save the JSON index with the memoized digests of files."""
+
+    cache_subdir('', cache_root_dir)
+    index_fname = os.path.join(cache_root_dir, _DIGEST_INDEX_FNAME)
+    atomic_write(index_fname, json.dumps(digest_index, sort_keys=True))
+
+
+def file_digest(fname, cache_root_dir=CACHE_ROOT_DIR):
+    """Return the hexadecimal SHA-1 digest of the content of file 'fname'.
+
+    The digest is memoized by the (absolute-path, size, mtime) of the file.
+    """
+
+    fstat = os.stat(fname)
+    abs_fname = os.path.abspath(fname)
+    stat_key = "%d:%r" % (fstat.st_size, fstat.st_mtime)
+
+    digest_index = _load_digest_index(cache_root_dir)
+    memoized = digest_index.get(abs_fname)
+    if memoized and memoized[0] == stat_key:
+        return memoized[1]
+
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 20), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+
+    digest_index[abs_fname] = [stat_key, digest]
+    try:
+        _save_digest_index(digest_index, cache_root_dir)
+    except (IOError, OSError):
+        pass   # the memo is only an optimization
+    return digest
+
+
+def cache_key(fnames, params=(), cache_root_dir=CACHE_ROOT_DIR):
+    """Return a key for a cache entry derived from the files 'fnames' and
+    from the parameters 'params' (which must have a stable repr()).
+
+    Files in 'fnames' which don't exist are ignored (e.g., an optional '.prj'
+    next to a '.shp').
+    """
+
+    sha1 = hashlib.sha1()
+    for fname in fnames:
+        if os.path.exists(fname):
+            sha1.update(os.path.basename(fname).encode('utf-8'))
+            sha1.update(file_digest(fname, cache_root_dir).encode('ascii'))
+    sha1.update(repr(params).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def atomic_write(fname, data):
+    """Write 'data' (a str or bytes) to 'fname' atomically, so that a reader
+    never sees a half-written cache entry.
+    """
+
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    dir_name = os.path.dirname(os.path.abspath(fname))
+    tmp_fd, tmp_fname = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, mode) as out_file:
+            out_file.write(data)
+        os.rename(tmp_fname, fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+
+
+def atomic_save_npz(fname, **arrays):
+    """Save the numpy 'arrays' into the (uncompressed) '.npz' file 'fname'
+    atomically.
+    """
+
+    dir_name = os.path.dirname(os.path.abspath(fname))
+    tmp_fd, tmp_fname = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as out_file:
+            np.savez(out_file, **arrays)
+        os.rename(tmp_fname, fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+
+
+def touch_cache_entry(fname):
+    """Mark the cache entry 'fname' as just used (its mtime is the time of
+    its last use, for the eviction of the least recently used entries).
+    """
+
+    try:
+        os.utime(fname, None)
+    except OSError:
+        pass
+
+
+def evict_cache_entries(subdir_name, max_total_bytes=None,
+                        max_age_seconds=None, cache_root_dir=CACHE_ROOT_DIR):
+    """Evict entries from the sub-directory 'subdir_name' of the cache: first
+    those not used in the last 'max_age_seconds', and then the least recently
+    used ones until the entries left take at most 'max_total_bytes'.
+
+    :returns: the list of the files evicted
+    """
+
+    path = cache_subdir(subdir_name, cache_root_dir)
+    entries = []
+    for fname in os.listdir(path):
+        fname = os.path.join(path, fname)
+        try:
+            fstat = os.stat(fname)
+        except OSError:
+            continue   # evicted meanwhile by another process
+        if os.path.isfile(fname) and not fname.endswith('.tmp'):
+            entries.append((fstat.st_mtime, fstat.st_size, fname))
+    entries.sort()   # least recently used first
+
+    now = time.time()
+    total_bytes = sum(size for dummy, size, dummy in entries)
+    evicted = []
+    for mtime, size, fname in entries:
+        too_old = max_age_seconds is not None and \
+            now - mtime > max_age_seconds
+        too_big = max_total_bytes is not None and \
+            total_bytes > max_total_bytes
+        if not too_old and not too_big:
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        total_bytes -= size
+        evicted.append(fname)
+    return evicted
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""Classification of the values of a choropleth map (the tax impact of the
+CVA sub-wards, the budget of the wards, ...) into a few classes, each one
+drawn with its own colour: by equal intervals, by quantiles, or by the
+natural breaks of Jenks, which minimize the sum of the squared deviations of
+the values from the mean of their class.
+
+The natural breaks are found by dynamic programming over the distinct values
+sorted, computing the deviations of all the candidate classes at once from
+the prefix sums of the values (there is no loop per value in Python). This
+is exact while there are at most 'max_exact_values' distinct values; with
+more (e.g., in the layers with a polygon per parcel), the distinct values are
+grouped into 'sample_size' runs of consecutive values, and the breaks are
+searched only between these runs: the deviations are still computed exactly
+from all the values, but the breaks can be off by at most a run.
+
+The breaks are memoized by the values and the number of classes, so the
+same classification isn't computed again in the same process (e.g., in the
+frames of an animation, or in the panels which share a layer).
+
+The classes plug into the path from values to colours of matplotlib as a
+norm: as in the BoundaryNorm of matplotlib, each class goes from its lowest
+value up to the lowest value of the next class (excluded), so a BoundaryNorm
+of the breaks maps each value to the colour of its class in a colormap, and
+a colour bar of this norm shows the classes and their breaks.
+"""
+
+import hashlib
+
+import numpy as np
+
+
+CLASSIFICATION_SCHEMES = ('equal_interval', 'quantile', 'jenks')
+
+DEFAULT_NUM_CLASSES = 6
+
+# The maximum number of distinct values for which the natural breaks are
+# exact, and the number of runs of values in which the breaks are searched
+# beyond it
+JENKS_MAX_EXACT_VALUES = 2000
+JENKS_SAMPLE_SIZE = 1000
+
+# The maximum number of cells of the matrix of candidate classes which the
+# dynamic programming computes at once (this bounds its memory)
+_JENKS_CHUNK_CELLS = 1 << 22
+
+# The breaks already computed in this process, indexed by the digest of the
+# values and the parameters of the classification
+_BREAKS_MEMO = dict()
+
+
+def _equal_interval_breaks(values, num_classes):
+    """Return the lowest value of each of 'num_classes' classes of equal
+    width.
+    """
+
+    return np.linspace(values.min(), values.max(), num_classes + 1)[:-1]
+
+
+def _quantile_breaks(values, num_classes):
+    """Return the lowest value of each of 'num_classes' classes with the
+    same number of values.
+    """
+
+    return np.percentile(values, np.linspace(0.0, 100.0, num_classes + 1))[:-1]
+
+
+def _value_runs(values, max_exact_values, sample_size):
+    """Return the runs of consecutive distinct values in which the natural
+    breaks are searched: each distinct value, or 'sample_size' runs of them
+    if there are more than 'max_exact_values'.
+
+    :returns: the tuple (counts, sums, sums_squares, lowest, highest), with
+              the number of values in each run, their sum and the sum of
+              their squares (centered on their mean), and the lowest and
+              highest value in each run
+    """
+
+    distinct, counts = np.unique(values, return_counts=True)
+    counts = counts.astype(np.float64)
+    centered = distinct - np.average(distinct, weights=counts)
+
+    if len(distinct) <= max_exact_values:
+        starts = np.arange(len(distinct))
+    else:
+        starts = np.unique(np.linspace(0, len(distinct), sample_size,
+                                       endpoint=False).astype(np.int64))
+    ends = np.append(starts[1:], len(distinct))
+
+    return (np.add.reduceat(counts, starts),
+            np.add.reduceat(centered * counts, starts),
+            np.add.reduceat(centered * centered * counts, starts),
+            distinct[starts], distinct[ends - 1])
+
+
+def _jenks_breaks(values, num_classes,
+                  max_exact_values=JENKS_MAX_EXACT_VALUES,
+                  sample_size=JENKS_SAMPLE_SIZE):
+    """Return the lowest value of each of the 'num_classes' classes of the
+    natural breaks of 'values' (see the description of the module).
+    """
+
+    counts, sums, sums_squares, lowest, highest = _value_runs(
+        values, max_exact_values, sample_size)
+    num_runs = len(counts)
+    if num_runs <= num_classes:
+        return lowest
+
+    # the prefix sums, so the squared deviation of the runs i..j is
+    # ssd(i, j) = S2[j+1] - S2[i] - (S1[j+1] - S1[i])^2 / (W[j+1] - W[i])
+    prefix_counts = np.append(0.0, np.cumsum(counts))
+    prefix_sums = np.append(0.0, np.cumsum(sums))
+    prefix_squares = np.append(0.0, np.cumsum(sums_squares))
+
+    firsts = np.arange(num_runs)
+    # the minimum deviation of the first j+1 runs in one class
+    cost = prefix_squares[1:] - prefix_sums[1:] ** 2 / prefix_counts[1:]
+    class_starts = np.zeros((num_classes, num_runs), dtype=np.int64)
+
+    chunk = max(1, _JENKS_CHUNK_CELLS // num_runs)
+    for class_idx in range(1, num_classes):
+        # the cost of the previous classes ending just before each run i
+        prev_cost = np.append(np.inf, cost[:-1])
+        prev_cost[:class_idx] = np.inf
+        new_cost = np.empty(num_runs)
+        new_cost.fill(np.inf)
+        for chunk_start in range(class_idx, num_runs, chunk):
+            lasts = np.arange(chunk_start, min(chunk_start + chunk,
+                                               num_runs))[:, np.newaxis]
+            num_values = prefix_counts[lasts + 1] - prefix_counts[firsts]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                deviation = prefix_squares[lasts + 1] - \
+                    prefix_squares[firsts] - \
+                    (prefix_sums[lasts + 1] - prefix_sums[firsts]) ** 2 / \
+                    num_values
+            candidates = np.where(firsts <= lasts, prev_cost + deviation,
+                                  np.inf)
+            best = np.argmin(candidates, axis=1)
+            class_starts[class_idx, lasts[:, 0]] = best
+            new_cost[lasts[:, 0]] = candidates[np.arange(len(best)), best]
+        cost = new_cost
+
+    # follow the first run of each class back from the last run
+    breaks = []
+    last_run = num_runs - 1
+    for class_idx in range(num_classes - 1, 0, -1):
+        first_run = class_starts[class_idx, last_run]
+        breaks.append(lowest[first_run])
+        last_run = first_run - 1
+    breaks.append(lowest[0])
+    return np.array(breaks[::-1])
+
+
+def classify_breaks(values, num_classes=DEFAULT_NUM_CLASSES, scheme='jenks',
+                    max_exact_values=JENKS_MAX_EXACT_VALUES,
+                    sample_size=JENKS_SAMPLE_SIZE):
+    """Return the breaks of the classification of 'values' into
+    'num_classes' classes by 'scheme' (one of CLASSIFICATION_SCHEMES): an
+    increasing float64 array with the lowest value of each class, and the
+    float just above the highest value (the classes exclude their upper
+    break). There can be fewer classes if there are fewer distinct values.
+
+    The breaks are memoized by the values and the parameters.
+
+    Raises ValueError if the scheme is unknown or if there are no values.
+    """
+
+    if scheme not in CLASSIFICATION_SCHEMES:
+        raise ValueError("Unknown classification scheme '%s'" % scheme)
+    values = np.ascontiguousarray(values, dtype=np.float64).ravel()
+    if not len(values):
+        raise ValueError('There are no values to classify')
+
+    key = (hashlib.sha1(values.tobytes()).hexdigest(), num_classes, scheme,
+           max_exact_values, sample_size)
+    breaks = _BREAKS_MEMO.get(key)
+    if breaks is None:
+        if scheme == 'jenks':
+            breaks = _jenks_breaks(values, num_classes, max_exact_values,
+                                   sample_size)
+        elif scheme == 'quantile':
+            breaks = _quantile_breaks(values, num_classes)
+        else:
+            breaks = _equal_interval_breaks(values, num_classes)
+        breaks = np.append(np.unique(breaks),
+                           np.nextafter(values.max(), np.inf))
+        breaks.setflags(write=False)
+        _BREAKS_MEMO[key] = breaks
+    return breaks
+
+
+def class_indexes(values, breaks):
+    """Return the index of the class of each of the 'values' in the
+    classification with 'breaks' (see classify_breaks()).
+    """
+
+    return np.searchsorted(breaks[1:-1], np.asarray(values, dtype=np.float64),
+                           side='right')
+
+
+def classification_norm(values, ncolors, classification=None):
+    """Return the norm for the colours of 'values' among 'ncolors' colours
+    of a colormap: a linear Normalize from the minimum to the maximum if
+    'classification' is None, otherwise a BoundaryNorm with the breaks of
+    the tuple 'classification' (scheme, num_classes).
+    """
+
+    # imported here since the breaks alone don't need matplotlib
+    from matplotlib.colors import BoundaryNorm, Normalize
+
+    values = np.asarray(values, dtype=np.float64)
+    if classification is not None:
+        scheme, num_classes = classification
+        breaks = classify_breaks(values, num_classes, scheme)
+        if len(breaks) > 2:
+            return BoundaryNorm(breaks, ncolors)
+    # (a single class is drawn as a linear Normalize)
+    return Normalize(vmin=values.min(), vmax=values.max())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""A single entry point for the programs of the visualizations of Toronto,
+with a subcommand per task:
+
+    cli_toronto.py etl [WORKBOOK]          the ETL of the budget workbook
+                                           (and the top projects of a ward)
+    cli_toronto.py render budget ...       the budget maps (see
+                                           plot_excel_budget_toronto_...)
+    cli_toronto.py render investment ...   the panels of the investment
+                                           (see visualiz_investm_toronto_...)
+    cli_toronto.py export ...              the vector export of the layers
+                                           (see topojson_export_toronto)
+    cli_toronto.py bench ...               the benchmark of the stages (see
+                                           benchmark_toronto)
+
+This program imports only the standard library when it starts: each
+subcommand imports the modules it needs when it runs, so the ETL (e.g., in
+a cron job) doesn't import matplotlib nor Basemap, which take much longer
+to import than the ETL takes to load its results from the cache.
+
+When there is no display (no DISPLAY nor WAYLAND_DISPLAY in a POSIX system
+other than Mac OS X) and no backend of matplotlib is chosen by MPLBACKEND,
+the subcommands which draw use the Agg backend. With '--startup-time', the
+time from the start of the process until the subcommand starts its work
+(after its imports) is printed to the standard error.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+# The timer when this program started (after the start of the interpreter)
+_START_TIME = timeit.default_timer()
+
+# The budget workbook of the City of Toronto, as downloaded
+BUDGET_SPREADSHEET = 'shp_dir/budget_per_city_ward.xlsx'
+
+# The module of the program of each target of the subcommand 'render', and
+# of the subcommands 'export' and 'bench'
+RENDER_PROGRAMS = {'budget': 'plot_excel_budget_toronto_neighborhoods',
+                   'investment': 'visualiz_investm_toronto_neighborhoods'}
+EXPORT_PROGRAM = 'topojson_export_toronto'
+BENCH_PROGRAM = 'benchmark_toronto'
+
+
+def process_age():
+    """Return the seconds since this process started, from '/proc' in Linux
+    (or since this program started, elsewhere).
+    """
+
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # (the fields after the name of the program, in parentheses)
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return uptime - float(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return timeit.default_timer() - _START_TIME
+
+
+def is_headless():
+    """Return whether there is no display where to show the figures."""
+
+    if sys.platform in ('darwin', 'win32'):
+        return False
+    return not (os.environ.get('DISPLAY') or
+                os.environ.get('WAYLAND_DISPLAY'))
+
+
+def use_agg_if_headless():
+    """Choose the Agg backend of matplotlib if there is no display and no
+    backend was chosen by MPLBACKEND (before pyplot is imported).
+    """
+
+    if is_headless() and not os.environ.get('MPLBACKEND'):
+        import matplotlib
+        matplotlib.use('Agg')
+
+
+class SubcommandStartup(object):
+
+    """The report of the startup time of a subcommand.
+
+    Fields:
+
+       enabled: whether to print the startup time
+
+       _imports_start: the timer when the subcommand started its imports
+    """
+
+    def __init__(self, enabled):
+
+        self.enabled = enabled
+        self._imports_start = timeit.default_timer()
+
+    def ready(self, subcommand):
+        """Print the startup time, when 'subcommand' has done its imports
+        and starts its work.
+        """
+
+        if self.enabled:
+            sys.stderr.write('startup of %s: %.3f s (of which %.3f s '
+                             'importing its modules)\n' %
+                             (subcommand, process_age(),
+                              timeit.default_timer() - self._imports_start))
+
+
+def run_etl(args, startup):
+    """Do the ETL of the budget workbook (or load its results from the
+    cache), and print a summary of it (and the top projects of a ward).
+    """
+
+    from plot_excel_budget_toronto_neighborhoods import \
+        TorontoBudgetForecastPerCityWard
+    from stage_profiler_toronto import enable_profiling, save_profile
+    startup.ready('etl')
+
+    if args.profile:
+        enable_profiling(args.profile)
+    try:
+        budget = TorontoBudgetForecastPerCityWard()
+        if args.no_cache:
+            budget.etl_excel_spreadsheet(args.workbook)
+        else:
+            budget.etl_excel_spreadsheet_cached(args.workbook)
+        if args.output:
+            budget.save_etl_results(args.output)
+    finally:
+        save_profile()
+
+    years = budget._years
+    print('ETL of %s: %d wards, %d budget years%s, %d projects, %d '
+          'invalid rows' %
+          (args.workbook, len(budget._ward_numbers), len(years),
+           ' (%d-%d)' % (years[0], years[-1]) if years else '',
+           len(budget._projects), len(budget._validation_report)))
+
+    if args.top_projects is not None:
+        try:
+            top_projects = budget.top_projects(args.top_projects, args.year,
+                                               args.num_projects)
+        except KeyError as an_exc:
+            sys.exit(an_exc.args[0])
+        print('Top projects of ward %d in %s:' %
+              (args.top_projects,
+               args.year if args.year is not None else 'all the years'))
+        for project_name, sub_project_name, project_budget in top_projects:
+            print('%16.2f  %s%s' % (project_budget, project_name,
+                                    ' / ' + sub_project_name
+                                    if sub_project_name else ''))
+
+
+def run_program(module_name, program_args, prog, startup):
+    """Run the main() of the program in the module 'module_name' with the
+    command-line arguments 'program_args', as the subcommand 'prog' (with
+    the Agg backend if there is no display).
+    """
+
+    use_agg_if_headless()
+    __import__(module_name)
+    startup.ready(prog)
+    sys.modules[module_name].main(program_args, prog=prog)
+
+
+def main(argv=None):
+    """Main function on the program.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='The visualizations of the investment in the '
+                    'neighborhoods of Toronto')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print to the standard error the time until '
+                             'the subcommand starts its work')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    etl_parser = subparsers.add_parser(
+        'etl', help='do the ETL of the budget workbook (without importing '
+                    'matplotlib nor Basemap)')
+    etl_parser.add_argument('workbook', metavar='WORKBOOK', nargs='?',
+                            default=BUDGET_SPREADSHEET,
+                            help='Excel workbook of the budget per ward '
+                                 '(default: %(default)s)')
+    etl_parser.add_argument('--no-cache', action='store_true',
+                            help='do the ETL even if its results are in '
+                                 'the cache')
+    etl_parser.add_argument('--output', metavar='NPZ_FNAME',
+                            help='save the results of the ETL into '
+                                 'NPZ_FNAME')
+    etl_parser.add_argument('--top-projects', metavar='WARD', type=int,
+                            help='print the projects of ward WARD with the '
+                                 'largest budgets')
+    etl_parser.add_argument('--year', type=int,
+                            help='budget year of --top-projects (default: '
+                                 'all the years)')
+    etl_parser.add_argument('--num-projects', type=int, default=10,
+                            help='number of projects printed by '
+                                 '--top-projects (default: %(default)s)')
+    etl_parser.add_argument('--profile', metavar='TRACE_FNAME',
+                            help='profile the time and memory of each '
+                                 'stage, into a JSON trace of events in '
+                                 'TRACE_FNAME')
+
+    # (the options of the programs run by these subcommands, including
+    # '--help', are left for the programs to parse)
+    render_parser = subparsers.add_parser(
+        'render', add_help=False,
+        help='render the budget maps or the investment panels (with the '
+             'options of their programs)')
+    render_parser.add_argument('target', choices=sorted(RENDER_PROGRAMS),
+                               help='what to render')
+    subparsers.add_parser('export', add_help=False,
+                          help='export the layers as TopoJSON or quantized '
+                               'GeoJSON (with the options of %s)' %
+                               EXPORT_PROGRAM)
+    subparsers.add_parser('bench', add_help=False,
+                          help='benchmark the stages on synthetic inputs '
+                               '(with the options of %s)' % BENCH_PROGRAM)
+
+    args, program_args = parser.parse_known_args(argv)
+    if args.command is None:
+        parser.error('a subcommand is needed')
+    if args.command == 'etl' and program_args:
+        parser.error('unrecognized arguments: %s' % ' '.join(program_args))
+
+    startup = SubcommandStartup(args.startup_time)
+    prog = '%s %s' % (parser.prog, args.command)
+    if args.command == 'etl':
+        run_etl(args, startup)
+    elif args.command == 'render':
+        run_program(RENDER_PROGRAMS[args.target], program_args,
+                    '%s %s' % (prog, args.target), startup)
+    elif args.command == 'export':
+        run_program(EXPORT_PROGRAM, program_args, prog, startup)
+    else:
+        run_program(BENCH_PROGRAM, program_args, prog, startup)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""A streaming reader of the rows of an Excel spreadsheet, which yields the
+rows one at a time instead of materializing the whole workbook in memory
+(as xlrd.open_workbook() does), so that the ETL of big Excel workbooks, like
+the multi-year Capital Budget & Plan of the City of Toronto, has a bounded
+memory use.
+
+An '.xlsx' workbook is a ZIP file with an XML document per worksheet: this
+document is parsed incrementally with xml.etree.ElementTree.iterparse(), and
+each row already seen is discarded. Older '.xls' workbooks are read with
+xlrd on demand (only the sheet requested is loaded).
+
+Each row is yielded as a list of cells with the same 'ctype' and 'value'
+that xlrd gives to them (the Cell here for an '.xlsx', xlrd.sheet.Cell for
+an '.xls'), so the code doing the ETL works the same with both kinds of
+workbooks. xlrd is imported only to read an '.xls': the '.xlsx' workbooks
+are read without it.
+"""
+
+import re
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+
+_MAIN_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_RELS_NAMESPACE = \
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PKG_RELS_NAMESPACE = \
+    'http://schemas.openxmlformats.org/package/2006/relationships'
+
+# the column letters of a cell reference, like 'AB' in 'AB12'
+_RE_CELL_COLUMN = re.compile('^(?P<column>[A-Z]+)')
+
+_EMPTY_CELL_VALUE = u''
+
+# the types of the cells, with the same values as the XL_CELL_* of xlrd
+XL_CELL_EMPTY = 0
+XL_CELL_TEXT = 1
+XL_CELL_NUMBER = 2
+XL_CELL_BOOLEAN = 4
+XL_CELL_ERROR = 5
+
+
+class Cell(object):
+    """A cell of an '.xlsx' sheet, as an xlrd.sheet.Cell.
+
+    Fields:
+     . ctype: the type of the cell, one of the XL_CELL_* above
+     . value: the value of the cell, a unicode string for a text cell and a
+              float for a number
+    """
+
+    __slots__ = ('ctype', 'value')
+
+    def __init__(self, ctype, value):
+        self.ctype = ctype
+        self.value = value
+
+    def __repr__(self):
+        return 'Cell(%r, %r)' % (self.ctype, self.value)
+
+
+def _tag(local_name, namespace=_MAIN_NAMESPACE):
+    """Return the qualified tag 'local_name' in the XML 'namespace'."""
+
+    return '{%s}%s' % (namespace, local_name)
+
+
+def _column_index(cell_reference):
+    """Return the 0-based column index of 'cell_reference' (e.g., 'AB12')."""
+
+    column_index = 0
+    for letter in _RE_CELL_COLUMN.match(cell_reference).group('column'):
+        column_index = column_index * 26 + (ord(letter) - ord('A') + 1)
+    return column_index - 1
+
+
+def _empty_cell():
+    """Return an empty Cell."""
+
+    return Cell(XL_CELL_EMPTY, _EMPTY_CELL_VALUE)
+
+
+def _xlsx_sheet_path(xlsx_zip, sheet_index):
+    """Return the path inside the '.xlsx' ZIP of the XML document of the
+    sheet number 'sheet_index' (0-based, in the order of the workbook).
+    """
+
+    workbook = ElementTree.fromstring(xlsx_zip.read('xl/workbook.xml'))
+    sheets = workbook.find(_tag('sheets'))
+    relationship_id = sheets[sheet_index].get(_tag('id', _RELS_NAMESPACE))
+
+    rels = ElementTree.fromstring(
+        xlsx_zip.read('xl/_rels/workbook.xml.rels'))
+    for relationship in rels.iter(_tag('Relationship', _PKG_RELS_NAMESPACE)):
+        if relationship.get('Id') == relationship_id:
+            target = relationship.get('Target')
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return 'xl/' + target
+
+    return 'xl/worksheets/sheet%d.xml' % (sheet_index + 1)
+
+
+def _xlsx_shared_strings(xlsx_zip):
+    """Return the list of shared strings of the '.xlsx' workbook (the text
+    cells refer to them by their index in this list).
+    """
+
+    shared_strings = []
+    if 'xl/sharedStrings.xml' not in xlsx_zip.namelist():
+        return shared_strings
+
+    string_item = _tag('si')
+    text = _tag('t')
+    phonetic_run = _tag('rPh')
+    with xlsx_zip.open('xl/sharedStrings.xml') as in_xml:
+        for dummy, elem in ElementTree.iterparse(in_xml):
+            if elem.tag != string_item:
+                continue
+            # the text of a string item can be split in several rich-text
+            # runs, but the phonetic runs are not part of that text
+            for phonetic in elem.findall(phonetic_run):
+                elem.remove(phonetic)
+            shared_strings.append(u''.join(t_elem.text or u''
+                                           for t_elem in elem.iter(text)))
+            elem.clear()
+    return shared_strings
+
+
+def _xlsx_cell(cell_elem, shared_strings):
+    """Return the Cell for the XML element 'cell_elem' of a sheet."""
+
+    cell_type = cell_elem.get('t', 'n')
+
+    if cell_type == 'inlineStr':
+        return Cell(XL_CELL_TEXT,
+                    u''.join(t_elem.text or u''
+                             for t_elem in cell_elem.iter(_tag('t'))))
+
+    value_elem = cell_elem.find(_tag('v'))
+    if value_elem is None or value_elem.text is None:
+        return _empty_cell()
+    value = value_elem.text
+
+    if cell_type == 's':
+        return Cell(XL_CELL_TEXT, shared_strings[int(value)])
+    if cell_type == 'str':
+        return Cell(XL_CELL_TEXT, value)
+    if cell_type == 'b':
+        return Cell(XL_CELL_BOOLEAN, int(value))
+    if cell_type == 'e':
+        return Cell(XL_CELL_ERROR, value)
+    return Cell(XL_CELL_NUMBER, float(value))
+
+
+def _iter_xlsx_rows(excel_fname, sheet_index):
+    """Yield the rows of the sheet 'sheet_index' of the '.xlsx' workbook
+    'excel_fname', parsing its XML incrementally.
+    """
+
+    with zipfile.ZipFile(excel_fname) as xlsx_zip:
+        shared_strings = _xlsx_shared_strings(xlsx_zip)
+        sheet_path = _xlsx_sheet_path(xlsx_zip, sheet_index)
+
+        num_columns = 0
+        sheet_data = None
+        with xlsx_zip.open(sheet_path) as in_xml:
+            for event, elem in ElementTree.iterparse(in_xml,
+                                                     ('start', 'end')):
+                if event == 'start':
+                    if elem.tag == _tag('sheetData'):
+                        sheet_data = elem
+                    elif elem.tag == _tag('dimension'):
+                        # e.g., 'A1:P310': pad the rows up to column 'P',
+                        # as xlrd does
+                        last_cell = elem.get('ref', 'A1').split(':')[-1]
+                        num_columns = _column_index(last_cell) + 1
+                    continue
+
+                if elem.tag != _tag('row'):
+                    continue
+
+                row = []
+                for cell_elem in elem.iter(_tag('c')):
+                    cell_reference = cell_elem.get('r')
+                    if cell_reference:
+                        column_index = _column_index(cell_reference)
+                        while len(row) < column_index:
+                            row.append(_empty_cell())
+                    row.append(_xlsx_cell(cell_elem, shared_strings))
+                while len(row) < num_columns:
+                    row.append(_empty_cell())
+
+                yield row
+
+                # discard the XML of the rows already seen
+                elem.clear()
+                if sheet_data is not None:
+                    sheet_data.clear()
+
+
+def _iter_xls_rows(excel_fname, sheet_index):
+    """Yield the rows of the sheet 'sheet_index' of the '.xls' workbook
+    'excel_fname', loading only that sheet.
+    """
+
+    # imported here since only the '.xls' workbooks need it
+    import xlrd
+
+    xl_workbook = xlrd.open_workbook(excel_fname, on_demand=True)
+    try:
+        xl_sheet = xl_workbook.sheet_by_index(sheet_index)
+        for curr_row_numb in range(0, xl_sheet.nrows):
+            yield xl_sheet.row(curr_row_numb)
+    finally:
+        xl_workbook.release_resources()
+
+
+def iter_excel_rows(excel_fname, sheet_index=0):
+    """Yield the rows of the sheet number 'sheet_index' of the Excel
+    workbook 'excel_fname' (an '.xlsx' or an '.xls'), one at a time, each
+    row as a list of cells with a 'ctype' (one of the XL_CELL_*) and a
+    'value'.
+    """
+
+    if zipfile.is_zipfile(excel_fname):
+        return _iter_xlsx_rows(excel_fname, sheet_index)
+    return _iter_xls_rows(excel_fname, sheet_index)
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+"""Fetch the datasets of the Open Data of the City of Toronto used by the
+visualizations (the Shapefiles of the City Wards, the Priority Investment
+Neighborhoods, the Business Improvement Areas and the CVA Tax Impact, and
+the Excel spreadsheet with the Capital Budget per Ward) into './shp_dir',
+and unzip them. (The Shapefiles are kept in the coordinate system in which
+they are published: they are reprojected when they are read, see
+reproject_shapefile_toronto.)
+
+All the datasets are fetched concurrently by a pool of threads, and each one
+is unzipped by its thread as soon as it is downloaded, so the unzips also
+run in parallel. The HTTP requests are conditional (If-None-Match and
+If-Modified-Since, with the ETag and the Last-Modified of the last
+download), so a dataset which didn't change upstream isn't downloaded nor
+unzipped again. A download is written into a
+'.part' file, which is resumed with a Range request (If-Range its ETag or
+Last-Modified) if the download is interrupted, and the file downloaded is
+verified against its length and, if it is known, its SHA-256.
+
+What was fetched, with the validators and the SHA-256 of each dataset and
+the files prepared from it, is kept in the manifest 'fetch_manifest.json'
+in './shp_dir', with the datasets which changed in the last run.
+
+With '--mirror BASE_URL' the datasets are fetched from BASE_URL/<file name>
+instead of from the City of Toronto (e.g., from a local stand-in server).
+"""
+
+import argparse
+import datetime
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, quote  # Python 2
+    from httplib import HTTPException
+except ImportError:
+    from urllib.request import Request, urlopen             # Python 3
+    from urllib.error import HTTPError
+    from urllib.parse import quote
+    from http.client import HTTPException
+
+from cache_dir_toronto import atomic_write
+
+
+SHP_DIR = './shp_dir'
+FETCH_MANIFEST_FNAME = 'fetch_manifest.json'
+
+# Increase this version whenever the format of the manifest changes
+FETCH_MANIFEST_VERSION = 1
+
+# The timeout in seconds of each HTTP request, how many times a failed
+# download is retried (resuming it), and the size of the chunks read
+FETCH_TIMEOUT = 60
+FETCH_RETRIES = 3
+FETCH_CHUNK_BYTES = 1 << 16
+
+_OPEN_DATA_FILES_URL = ('http://www1.toronto.ca/City_Of_Toronto/'
+                        'Information_Technology/Open_Data/Data_Sets/Assets/'
+                        'Files/')
+
+# The datasets to fetch. Each one has:
+#    name: the name of the dataset in the manifest
+#    url: where to download it from
+#    fname: the file in SHP_DIR where to save it
+#    members: if it is a ZIP file, the pattern of the names of its members
+#             to extract (into SHP_DIR, without their directories)
+#    sha256: the SHA-256 which the file downloaded must have, if it is known
+DATASETS = (
+    dict(name='city_wards',
+         url=_OPEN_DATA_FILES_URL + 'wards_may2010_wgs84.zip',
+         fname='wards_may2010_wgs84.zip',
+         members='icitw_wgs84.*'),
+    dict(name='priority_investment',
+         url=_OPEN_DATA_FILES_URL + 'priority-invest-neighbourhoods.zip',
+         fname='priority-invest-neighbourhoods.zip'),
+    dict(name='business_improvement',
+         url='http://opendata.toronto.ca/gcc/'
+             'business_improvement_areas_wgs84.zip',
+         fname='business_improvement_areas_wgs84.zip'),
+    dict(name='tax_impact',
+         url=_OPEN_DATA_FILES_URL + 'CVA_Tax_Impact_WGS84_(2011).zip',
+         fname='CVA_Tax_Impact_WGS84_(2011).zip'),
+    # the Capital Budget and Plan per City Ward
+    dict(name='budget',
+         url='http://www1.toronto.ca/City%20Of%20Toronto/'
+             'Information%20&%20Technology/Open%20Data/Data%20Sets/Assets/'
+             'Files/2015%20staff%20recommended%20capital%20projects%20by%20'
+             'ward.xlsx',
+         fname='budget_per_city_ward.xlsx'),
+)
+
+
+class ChecksumError(IOError):
+    """The file downloaded doesn't have the SHA-256 it should have."""
+    pass
+
+
+def file_sha256(fname):
+    """Return the hexadecimal SHA-256 of the content of 'fname'."""
+
+    sha256 = hashlib.sha256()
+    with open(fname, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(FETCH_CHUNK_BYTES), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _http_open(url, headers, timeout):
+    """Send a GET request for 'url' with 'headers', and return its response
+    (a response '304 Not Modified' or '416 Range Not Satisfiable' is returned
+    too, not raised).
+    """
+
+    try:
+        return urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as error:
+        if error.code in (304, 416):
+            return error
+        raise
+
+
+def _load_part_validator(part_fname):
+    """Return the validator (ETag or Last-Modified) of the response whose
+    body is in the partial download 'part_fname', or None.
+    """
+
+    try:
+        with open(part_fname + '.json') as in_file:
+            return json.load(in_file).get('validator')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _remove_part(part_fname):
+    """Remove the partial download 'part_fname', and its validator."""
+
+    for fname in (part_fname, part_fname + '.json'):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def _download_once(dataset, fname, record, timeout):
+    """Download the dataset into 'fname', resuming its partial download if
+    there is one, unless it didn't change since the download in 'record'.
+
+    :returns: None if it didn't change, otherwise the dictionary with the
+              ETag, the Last-Modified, the SHA-256 and the size of the file
+              downloaded, and whether it was resumed
+    """
+
+    part_fname = fname + '.part'
+    part_size = os.path.getsize(part_fname) \
+        if os.path.exists(part_fname) else 0
+    part_validator = _load_part_validator(part_fname)
+
+    headers = {'User-Agent': 'fetch_datasets_toronto'}
+    if part_size and part_validator:
+        headers['Range'] = 'bytes=%d-' % part_size
+        headers['If-Range'] = part_validator
+    elif record is not None:
+        if record.get('etag'):
+            headers['If-None-Match'] = record['etag']
+        if record.get('last_modified'):
+            headers['If-Modified-Since'] = record['last_modified']
+
+    response = _http_open(dataset['url'], headers, timeout)
+    try:
+        status = response.getcode()
+        if status == 304:
+            return None
+        if status == 416:
+            _remove_part(part_fname)
+            raise IOError('Range not satisfiable, restarting the download '
+                          'of %s' % dataset['url'])
+
+        info = response.info()
+        etag = info.get('ETag')
+        last_modified = info.get('Last-Modified')
+        resumed = status == 206
+        if resumed:
+            content_range = info.get('Content-Range', '')
+            if not content_range.startswith('bytes %d-' % part_size):
+                _remove_part(part_fname)
+                raise IOError('Unexpected range %r in the download of %s' %
+                              (content_range, dataset['url']))
+        else:
+            part_size = 0
+
+        # (a resumed download is valid only while its validator is)
+        atomic_write(part_fname + '.json',
+                     json.dumps(dict(validator=etag or last_modified)))
+
+        content_length = info.get('Content-Length')
+        with open(part_fname, 'ab' if resumed else 'wb') as out_file:
+            shutil.copyfileobj(response, out_file, FETCH_CHUNK_BYTES)
+    finally:
+        response.close()
+
+    size = os.path.getsize(part_fname)
+    if content_length is not None and size != part_size + int(content_length):
+        raise IOError('Incomplete download of %s: %d bytes of %d' %
+                      (dataset['url'], size, part_size + int(content_length)))
+
+    sha256 = file_sha256(part_fname)
+    if dataset.get('sha256') and sha256 != dataset['sha256']:
+        _remove_part(part_fname)
+        raise ChecksumError('The SHA-256 of %s is %s, not %s' %
+                            (dataset['url'], sha256, dataset['sha256']))
+
+    os.rename(part_fname, fname)
+    _remove_part(part_fname)
+    return dict(etag=etag, last_modified=last_modified, sha256=sha256,
+                size=size, resumed=resumed)
+
+
+def download_dataset(dataset, fname, record, timeout=FETCH_TIMEOUT,
+                     retries=FETCH_RETRIES):
+    """Download the dataset into 'fname' unless it didn't change since the
+    download in 'record' (its entry in the manifest, or None), retrying
+    (and resuming) a failed download up to 'retries' times.
+
+    :returns: as _download_once()
+    """
+
+    # the validators are sent only if the file is still the one downloaded
+    if record is not None and (not os.path.exists(fname) or
+                               file_sha256(fname) != record.get('sha256')):
+        record = None
+
+    for attempt in range(retries + 1):
+        try:
+            return _download_once(dataset, fname, record, timeout)
+        except HTTPError as error:
+            if error.code < 500 or attempt == retries:
+                raise
+        except (IOError, OSError, HTTPException):
+            if attempt == retries:
+                raise
+
+
+def _extract_members(dataset, shp_dir):
+    """Extract the members of the ZIP file of the dataset into 'shp_dir'
+    (without their directories).
+
+    :returns: the names of the files extracted
+    """
+
+    extracted = []
+    with zipfile.ZipFile(os.path.join(shp_dir, dataset['fname'])) as zip_file:
+        for member in zip_file.infolist():
+            basename = os.path.basename(member.filename)
+            if not basename or not fnmatch.fnmatch(
+                    basename, dataset.get('members', '*')):
+                continue
+            # (written into a temporary file first, so that a reader never
+            # sees a half-written Shapefile)
+            tmp_fd, tmp_fname = tempfile.mkstemp(dir=shp_dir, suffix='.tmp')
+            try:
+                with os.fdopen(tmp_fd, 'wb') as out_file:
+                    with zip_file.open(member) as in_file:
+                        shutil.copyfileobj(in_file, out_file,
+                                           FETCH_CHUNK_BYTES)
+                os.rename(tmp_fname, os.path.join(shp_dir, basename))
+            except:
+                os.remove(tmp_fname)
+                raise
+            extracted.append(basename)
+    return extracted
+
+
+def prepare_dataset(dataset, shp_dir):
+    """Unzip the dataset downloaded into 'shp_dir', if it is a ZIP file.
+
+    :returns: the names of the files prepared from it
+    """
+
+    if not dataset['fname'].lower().endswith('.zip'):
+        return [dataset['fname']]
+    return _extract_members(dataset, shp_dir)
+
+
+def fetch_dataset(dataset, shp_dir, record, timeout=FETCH_TIMEOUT,
+                  retries=FETCH_RETRIES):
+    """Fetch the dataset into 'shp_dir' (in a thread of the pool) and
+    prepare it if it changed since its entry 'record' in the manifest, or if
+    any of the files prepared from it is missing.
+
+    :returns: the tuple (status, record), with the status 'changed',
+              'unchanged' or 'failed: <error>', and the new entry of the
+              dataset in the manifest
+    """
+
+    record = dict(record or {}, url=dataset['url'], fname=dataset['fname'])
+    try:
+        download = download_dataset(dataset,
+                                    os.path.join(shp_dir, dataset['fname']),
+                                    record if 'sha256' in record else None,
+                                    timeout=timeout, retries=retries)
+        changed = download is not None and \
+            download['sha256'] != record.get('sha256')
+        if download is not None:
+            record.update(download)
+            record['downloaded'] = datetime.datetime.utcnow().isoformat() + 'Z'
+
+        outputs = record.get('outputs')
+        if changed or not outputs or not all(
+                os.path.exists(os.path.join(shp_dir, output))
+                for output in outputs):
+            # (forget the outputs until they are prepared again)
+            record['outputs'] = None
+            record['outputs'] = prepare_dataset(dataset, shp_dir)
+            changed = True
+    except (IOError, OSError, HTTPException, zipfile.BadZipfile) as error:
+        return 'failed: %s' % error, record
+
+    return 'changed' if changed else 'unchanged', record
+
+
+def _load_manifest(manifest_fname):
+    """Return the datasets in the manifest 'manifest_fname'."""
+
+    try:
+        with open(manifest_fname) as in_file:
+            manifest = json.load(in_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+    if manifest.get('version') != FETCH_MANIFEST_VERSION:
+        return dict()
+    return manifest.get('datasets', dict())
+
+
+def _fetch_dataset_call(fetch_call):
+    """Fetch a dataset in a thread of the pool (see fetch_dataset())."""
+
+    return fetch_dataset(*fetch_call)
+
+
+def fetch_datasets(datasets=DATASETS, shp_dir=SHP_DIR, mirror=None,
+                   threads=None, force=False, timeout=FETCH_TIMEOUT,
+                   retries=FETCH_RETRIES):
+    """Fetch and prepare concurrently the datasets which changed since they
+    were last fetched, and update the manifest in 'shp_dir'.
+
+    :param datasets: the datasets to fetch (see DATASETS)
+    :param shp_dir: the directory where to fetch them
+    :param mirror: the base URL of a mirror of the datasets, where to fetch
+                   them from instead of from their URLs
+    :param threads: the number of threads fetching (None for one per
+                    dataset)
+    :param force: whether to download them even if they didn't change
+    :param timeout: the timeout in seconds of each HTTP request
+    :param retries: how many times to retry a failed download
+    :returns: a dictionary indexed by the name of each dataset, with its
+              status: 'changed', 'unchanged' or 'failed: <error>'
+    """
+
+    if not os.path.isdir(shp_dir):
+        os.makedirs(shp_dir)
+    manifest_fname = os.path.join(shp_dir, FETCH_MANIFEST_FNAME)
+    records = _load_manifest(manifest_fname)
+
+    if mirror is not None:
+        datasets = [dict(dataset, url=mirror.rstrip('/') + '/' +
+                         quote(dataset['fname'])) for dataset in datasets]
+
+    fetch_calls = [(dataset, shp_dir,
+                    None if force else records.get(dataset['name']),
+                    timeout, retries) for dataset in datasets]
+    pool = ThreadPool(processes=threads or len(fetch_calls) or 1)
+    try:
+        results = pool.map(_fetch_dataset_call, fetch_calls)
+    finally:
+        pool.close()
+        pool.join()
+
+    statuses = dict()
+    for dataset, (status, record) in zip(datasets, results):
+        statuses[dataset['name']] = status
+        records[dataset['name']] = record
+
+    atomic_write(manifest_fname,
+                 json.dumps(dict(version=FETCH_MANIFEST_VERSION,
+                                 datasets=records, last_run=statuses),
+                            indent=1, sort_keys=True,
+                            separators=(',', ': ')))
+    return statuses
+
+
+def main():
+    """Main function on the program.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Fetch the Open Data of the City of Toronto which '
+                    'changed since it was last fetched')
+    parser.add_argument('--shp-dir', default=SHP_DIR,
+                        help='directory where to fetch the datasets '
+                             '(default: %(default)s)')
+    parser.add_argument('--mirror', metavar='BASE_URL', default=None,
+                        help='fetch the datasets from BASE_URL/<file name> '
+                             'instead of from the City of Toronto')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of threads fetching (default: one '
+                             'per dataset)')
+    parser.add_argument('--force', action='store_true',
+                        help='download the datasets even if they did not '
+                             'change')
+    parser.add_argument('--timeout', type=float, default=FETCH_TIMEOUT,
+                        help='timeout in seconds of each HTTP request '
+                             '(default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=FETCH_RETRIES,
+                        help='times to retry (resuming) a failed download '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    start_time = timeit.default_timer()
+    statuses = fetch_datasets(shp_dir=args.shp_dir, mirror=args.mirror,
+                              threads=args.threads, force=args.force,
+                              timeout=args.timeout, retries=args.retries)
+    for name in sorted(statuses):
+        print('%-24s %s' % (name, statuses[name]))
+    print('Fetched in %.1f s' % (timeit.default_timer() - start_time))
+
+    if any(status.startswith('failed') for status in statuses.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
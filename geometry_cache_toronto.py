@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""A persistent, binary cache of the geometry of the ESRI Shapefiles of the
+City of Toronto (City Wards, Priority Investment Neighborhoods, Business
+Improvement Areas and the Current Value Assessment on Tax Impact), so that
+these shapefiles don't need to be parsed and reprojected again (see
+reproject_shapefile_toronto) on every run.
+
+The geometry of a shapefile, already projected by the Basemap of Toronto,
+is kept as a LayerGeometry: a single float64 buffer with all the vertices of
+all the rings, an array with the offsets where each ring starts in that
+buffer, and one typed column per attribute in the DBF of the shapefile.
+
+The LayerGeometry is saved as a '.geom' file under './cache_dir/geometry',
+keyed by the SHA-1 of the shapefile and by the projection parameters of the
+Basemap, so it is re-used for as long as neither of them (nor the
+coordinate system of the shapefile) change. A '.geom' file is a JSON header
+followed by the raw arrays of the layer, each one aligned to 64 bytes, so
+it is loaded by mapping it into memory (read-only) instead of reading it:
+all the panels and all the worker processes which use a layer share the
+same pages of memory (those of the file in the page cache of the system),
+without a copy of its geometry per process.
+"""
+
+import datetime
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from cache_dir_toronto import cache_subdir, cache_key
+from stage_profiler_toronto import profile_stage
+
+
+GEOMETRY_CACHE_SUBDIR = 'geometry'
+
+# Increase this version whenever the format of the '.geom' files changes
+GEOMETRY_CACHE_VERSION = 3
+
+# The extension of the files of the layers in the geometry cache
+GEOMETRY_FILE_EXTENSION = '.geom'
+
+# A '.geom' file starts with this magic string and the length of its JSON
+# header (as a little-endian uint64), and each of its arrays starts at an
+# offset multiple of _ARRAY_ALIGNMENT bytes
+_GEOMETRY_FILE_MAGIC = b'TO_LAYER'
+_GEOMETRY_FILE_PREAMBLE = struct.Struct('<8sQ')
+_ARRAY_ALIGNMENT = 64
+
+# The coordinate system of the Shapefiles in longitudes and latitudes (most
+# of the Shapefiles of the City of Toronto are published in it)
+WGS84_SRS = 'EPSG:4326'
+
+# The files composing an ESRI Shapefile whose content affects the geometry
+_SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj')
+
+# The layers already loaded in this process, indexed by their cache key
+_LOADED_LAYERS = dict()
+
+try:
+    long_type = long          # Python 2
+    text_type = unicode
+except NameError:
+    long_type = int           # Python 3
+    text_type = str
+
+
+class LayerGeometry(object):
+
+    """The geometry and the attributes of all the rings in a shapefile.
+
+    Fields:
+
+       vertices: a float64 array of shape (num_vertices, 2) with the
+                 projected (x, y) coordinates of all the rings, one ring
+                 after the other
+
+       ring_offsets: an int64 array of num_rings + 1 elements, so that the
+                     vertices of ring 'i' are
+                     vertices[ring_offsets[i]:ring_offsets[i + 1]]
+
+       attributes: a dictionary indexed by the name of a field in the
+                   shapefile, whose value is a numpy array with the value
+                   of that field for each ring (as Basemap.readshapefile()
+                   does, a shape with several rings repeats its attributes
+                   in each of its rings)
+
+       source_key: the key of this layer in the geometry cache, or None if
+                   it wasn't loaded through the cache
+    """
+
+    def __init__(self, vertices, ring_offsets, attributes):
+
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.attributes = attributes
+        self.source_key = None
+
+    def __len__(self):
+        return len(self.ring_offsets) - 1
+
+    def ring(self, ring_idx):
+        """Return the vertices of the ring 'ring_idx' (a view, not a copy)."""
+
+        return self.vertices[self.ring_offsets[ring_idx]:
+                             self.ring_offsets[ring_idx + 1]]
+
+    def rings(self):
+        """Return the list of the vertices of each ring (views, not copies),
+        in the same form that Basemap.readshapefile() leaves its shapes.
+        """
+
+        return [self.ring(ring_idx) for ring_idx in range(len(self))]
+
+    def ring_info(self, ring_idx):
+        """Return the attributes of the ring 'ring_idx', as a dictionary in
+        the same form that Basemap.readshapefile() leaves in its '*_info'.
+        """
+
+        return dict((name, values[ring_idx].item())
+                    for name, values in self.attributes.items())
+
+    def info_dicts(self):
+        """Return the list of the attributes of each ring, as dictionaries
+        in the same form that Basemap.readshapefile() leaves its '*_info'.
+        """
+
+        columns = [(name, values.tolist())
+                   for name, values in self.attributes.items()]
+        return [dict((name, values[ring_idx]) for name, values in columns)
+                for ring_idx in range(len(self))]
+
+    def take(self, ring_indices):
+        """Return a new LayerGeometry with only the rings 'ring_indices' of
+        this one (in that order), and their attributes.
+        """
+
+        ring_indices = np.asarray(ring_indices, dtype=np.int64)
+        ring_sizes = np.diff(self.ring_offsets)[ring_indices]
+        ring_offsets = np.zeros(len(ring_indices) + 1, dtype=np.int64)
+        np.cumsum(ring_sizes, out=ring_offsets[1:])
+
+        # the index in 'vertices' of each vertex of the rings taken
+        vertex_indices = np.arange(ring_offsets[-1]) + np.repeat(
+            self.ring_offsets[ring_indices] - ring_offsets[:-1], ring_sizes)
+
+        return LayerGeometry(self.vertices[vertex_indices], ring_offsets,
+                             dict((name, values[ring_indices])
+                                  for name, values in self.attributes.items()))
+
+    @classmethod
+    def from_shapes(cls, shapes, shapes_info):
+        """Build a LayerGeometry from the shapes and their info, as they are
+        left by Basemap.readshapefile().
+        """
+
+        ring_sizes = [len(shape) for shape in shapes]
+        ring_offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+        np.cumsum(ring_sizes, out=ring_offsets[1:])
+
+        if shapes:
+            vertices = np.concatenate([np.asarray(shape, dtype=np.float64)
+                                       .reshape(-1, 2) for shape in shapes])
+        else:
+            vertices = np.zeros((0, 2), dtype=np.float64)
+
+        field_names = set()
+        for info in shapes_info:
+            field_names.update(info.keys())
+
+        attributes = dict()
+        for field_name in field_names:
+            attributes[field_name] = typed_column(
+                [info.get(field_name) for info in shapes_info])
+
+        return cls(vertices, ring_offsets, attributes)
+
+    def save(self, fname):
+        """Save this LayerGeometry into the '.geom' file 'fname'
+        atomically.
+        """
+
+        arrays = [('vertices', self.vertices),
+                  ('ring_offsets', self.ring_offsets)]
+        arrays.extend(('attr_' + name, values)
+                      for name, values in sorted(self.attributes.items()))
+        arrays = [(name, np.ascontiguousarray(values))
+                  for name, values in arrays]
+        for name, values in arrays:
+            if values.dtype.hasobject:
+                raise ValueError("The array '%s' of a LayerGeometry has "
+                                 "Python objects: it can't be saved" % name)
+
+        # the offsets of the arrays are relative to the end of the header
+        array_specs = []
+        offset = 0
+        for name, values in arrays:
+            array_specs.append((name, values.dtype.str, values.shape, offset))
+            offset += -(-values.nbytes // _ARRAY_ALIGNMENT) * _ARRAY_ALIGNMENT
+        header = json.dumps(dict(version=GEOMETRY_CACHE_VERSION,
+                                 arrays=array_specs)).encode('utf-8')
+        # (padded so that the arrays start aligned)
+        header += b' ' * (-(_GEOMETRY_FILE_PREAMBLE.size + len(header)) %
+                          _ARRAY_ALIGNMENT)
+
+        dir_name = os.path.dirname(os.path.abspath(fname))
+        tmp_fd, tmp_fname = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as out_file:
+                out_file.write(_GEOMETRY_FILE_PREAMBLE.pack(
+                    _GEOMETRY_FILE_MAGIC, len(header)))
+                out_file.write(header)
+                for name, values in arrays:
+                    out_file.write(values.tobytes())
+                    out_file.write(b'\0' * (-values.nbytes %
+                                            _ARRAY_ALIGNMENT))
+            os.rename(tmp_fname, fname)
+        except:
+            os.remove(tmp_fname)
+            raise
+
+    @classmethod
+    def load(cls, fname):
+        """Load a LayerGeometry from the '.geom' file 'fname' written by
+        save(), mapping it into memory: its arrays are read-only views on
+        the file. Returns None if the file was written by another version.
+        """
+
+        with open(fname, 'rb') as in_file:
+            magic, header_size = _GEOMETRY_FILE_PREAMBLE.unpack(
+                in_file.read(_GEOMETRY_FILE_PREAMBLE.size))
+            if magic != _GEOMETRY_FILE_MAGIC:
+                return None
+            header = json.loads(in_file.read(header_size).decode('utf-8'))
+        if header.get('version') != GEOMETRY_CACHE_VERSION:
+            return None
+
+        data_offset = _GEOMETRY_FILE_PREAMBLE.size + header_size
+        file_size = os.path.getsize(fname)
+        file_map = np.memmap(fname, dtype=np.uint8, mode='r') \
+            if file_size > data_offset else None
+        arrays = dict()
+        for name, dtype, shape, offset in header['arrays']:
+            dtype = np.dtype(str(dtype))
+            num_bytes = int(np.prod(shape)) * dtype.itemsize
+            if num_bytes == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            start = data_offset + offset
+            # (a plain ndarray view on the memory map, without a copy)
+            arrays[name] = np.asarray(
+                file_map[start:start + num_bytes]).view(dtype).reshape(shape)
+
+        attributes = dict((name[len('attr_'):], values)
+                          for name, values in arrays.items()
+                          if name.startswith('attr_'))
+        return cls(arrays['vertices'], arrays['ring_offsets'], attributes)
+
+
+class RingSequence(object):
+
+    """A read-only sequence with an item per ring of a LayerGeometry, built
+    when it is accessed.
+
+    Fields:
+
+       layer: the LayerGeometry
+
+       ring_item: the function which returns the item of a ring, given its
+                  index (e.g., layer.ring or layer.ring_info)
+    """
+
+    def __init__(self, layer, ring_item):
+
+        self.layer = layer
+        self.ring_item = ring_item
+
+    def __len__(self):
+        return len(self.layer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.ring_item(ring_idx)
+                    for ring_idx in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ring index out of range')
+        return self.ring_item(index)
+
+    def __iter__(self):
+        return (self.ring_item(ring_idx) for ring_idx in range(len(self)))
+
+
+def typed_column(values):
+    """Return a typed numpy array with the 'values' of an attribute: int64
+    or float64 if all of them are numbers, a string array otherwise, with
+    the dates (e.g., of the 'D' fields) in ISO format (a column of Python
+    objects can't be saved without pickling it).
+    """
+
+    if all(isinstance(value, (int, long_type)) and
+           not isinstance(value, bool) for value in values):
+        return np.array(values, dtype=np.int64)
+    if all(isinstance(value, (int, long_type, float)) and
+           not isinstance(value, bool) for value in values):
+        return np.array(values, dtype=np.float64)
+    return np.array([_text_value(value) for value in values], dtype='U')
+
+
+def _text_value(value):
+    """Return the Unicode string of the value 'value' of an attribute."""
+
+    if value is None:
+        return u''
+    if isinstance(value, (datetime.date, datetime.time)):
+        return text_type(value.isoformat())
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return text_type(value)
+
+
+def shapefile_fnames(shapefile):
+    """Return the files of the ESRI Shapefile 'shapefile' (its path without
+    extension) whose content affects its geometry or its attributes.
+    """
+
+    return [shapefile + ext for ext in _SHAPEFILE_EXTENSIONS]
+
+
+def _projection_params(to_map):
+    """Return the parameters of the Basemap 'to_map' which determine the
+    projected coordinates of a shapefile read by it.
+    """
+
+    return (sorted(to_map.projparams.items()),
+            to_map.llcrnrlon, to_map.llcrnrlat,
+            to_map.urcrnrlon, to_map.urcrnrlat)
+
+
+def load_layer_geometry(to_map, shapefile, name, srs=WGS84_SRS):
+    """Return the LayerGeometry of 'shapefile' projected by the Basemap
+    'to_map', from the geometry cache if it is there, otherwise reading and
+    reprojecting the shapefile and saving it into the cache.
+
+    :param to_map: the Basemap which projects the shapefile
+    :param shapefile: the path to the shapefile, without its extension
+    :param name: the name of the layer, as in Basemap.readshapefile()
+    :param srs: the coordinate system of the shapefile (as 'EPSG:<code>')
+    :returns: the LayerGeometry of this shapefile
+    """
+
+    key = cache_key(shapefile_fnames(shapefile),
+                    (GEOMETRY_CACHE_VERSION, _projection_params(to_map),
+                     srs))
+
+    layer = _LOADED_LAYERS.get(key)
+    if layer is not None:
+        return layer
+
+    cache_fname = os.path.join(cache_subdir(GEOMETRY_CACHE_SUBDIR),
+                               key + GEOMETRY_FILE_EXTENSION)
+    with profile_stage('readshapefile', layer=name):
+        if os.path.exists(cache_fname):
+            layer = LayerGeometry.load(cache_fname)
+
+        if layer is None:
+            # imported here since the reprojection builds on this module
+            from reproject_shapefile_toronto import read_layer_geometry
+            layer = read_layer_geometry(to_map, shapefile, srs)
+            layer.save(cache_fname)
+
+    layer.source_key = key
+    _LOADED_LAYERS[key] = layer
+    return layer
+
+
+def readshapefile_cached(to_map, shapefile, name, drawbounds=True,
+                         color='k', linewidth=0.5, tolerance=None,
+                         srs=WGS84_SRS):
+    """A replacement of 'to_map.readshapefile()' which uses the geometry
+    cache, and which can read a shapefile in any coordinate system 'srs'.
+
+    If 'tolerance' is given, the geometry is simplified so that no detail
+    smaller than 'tolerance' (in projected units, e.g., the size of an
+    output pixel) is kept.
+
+    As Basemap.readshapefile() does, it leaves the shapes of the shapefile
+    in the attribute 'name' of the Basemap 'to_map', and their attributes
+    in 'name' + '_info', and it draws the borders of the shapes if
+    'drawbounds'. (These are sequences which build each shape, a view on
+    the vertex buffer of the layer, and each dictionary of attributes only
+    when they are accessed, not lists with a copy of the layer.)
+
+    :returns: the LayerGeometry of this shapefile
+    """
+
+    layer = load_layer_geometry(to_map, shapefile, name, srs=srs)
+    if tolerance is not None:
+        # imported here since the simplification builds on this module
+        from simplify_geometry_toronto import simplify_layer_cached
+        with profile_stage('simplify_layer', layer=name):
+            layer = simplify_layer_cached(layer, tolerance)
+
+    setattr(to_map, name, RingSequence(layer, layer.ring))
+    setattr(to_map, name + '_info', RingSequence(layer, layer.ring_info))
+
+    if drawbounds:
+        # imported here since matplotlib is only needed to draw the layer
+        from matplotlib.collections import LineCollection
+        axis = to_map.ax
+        if axis is None:
+            import matplotlib.pyplot as plt
+            axis = plt.gca()
+        lines = LineCollection(layer.rings(), antialiaseds=(1,))
+        lines.set_color(color)
+        lines.set_linewidth(linewidth)
+        lines.set_label('_nolabel_')
+        with profile_stage('add_collection', layer=name):
+            axis.add_collection(lines)
+        to_map.set_axes_limits(ax=axis)
+
+    return layer
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Interactive inspection of the maps of Toronto shown with plt.show(): a
+tooltip with the attributes of the features under the cursor (the ward and
+its budget, the CVA sub-ward and its tax impact 'avgtaximpa', the Business
+Improvement Area, ...) with their outlines highlighted, and a click prints
+all the attributes of these features.
+
+The features under the cursor are found with the STR tree of the rings of
+each layer (see spatial_index_toronto), testing the cursor only against the
+edges of the few rings whose bounding boxes contain it, all at once with
+numpy, instead of asking each patch of the collection whether it contains
+the cursor (which is linear in the number of features).
+
+The map itself is never drawn again while the cursor moves: the highlight
+and the tooltip are animated artists drawn over a copy of the rendered
+figure (blitting), so a response costs the hit test and the drawing of the
+overlay only, well below a frame at 60 Hz (16 ms) even on the densest
+layers. The time of each response is kept, to check it.
+"""
+
+import collections
+import timeit
+
+import numpy as np
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+from matplotlib.transforms import Bbox
+
+from spatial_index_toronto import layer_index, points_in_rings
+
+
+# The style of the outline of the features under the cursor, and of the
+# tooltip with their attributes (an opaque rectangle, since its copy is
+# moved with the cursor over the map)
+HIGHLIGHT_STYLE = dict(facecolors='none', edgecolors='cyan', linewidths=2.0,
+                       zorder=10)
+TOOLTIP_STYLE = dict(xytext=(12, 12), textcoords='offset points', fontsize=7,
+                     zorder=11,
+                     bbox=dict(boxstyle='square', facecolor='lightyellow'))
+
+# The maximum number of attributes of a feature in the tooltip, when its
+# fields aren't given
+MAX_TOOLTIP_FIELDS = 6
+
+# The target time of a response to the cursor (a frame at 60 Hz), and the
+# number of the last responses whose time is kept
+RESPONSE_TIME_BUDGET = 0.016
+_NUM_RESPONSE_TIMES = 1000
+
+
+def attribute_description(fields=None, max_fields=MAX_TOOLTIP_FIELDS):
+    """Return a function (layer, ring_idx) which describes a feature in a
+    tooltip, by the lines 'field: value' of its attributes 'fields' (those
+    which the layer has), or of its first 'max_fields' attributes if
+    'fields' is None.
+    """
+
+    def describe(layer, ring_idx):
+        """The attributes of the ring 'ring_idx' of 'layer'."""
+
+        names = [name for name in fields if name in layer.attributes] \
+            if fields is not None \
+            else sorted(layer.attributes)[:max_fields]
+        return '\n'.join('%s: %s' % (name,
+                                     layer.attributes[name][ring_idx].item())
+                         for name in names)
+
+    return describe
+
+
+class LayerPicker(object):
+
+    """The hit test of the rings of a layer.
+
+    Fields:
+
+       name: the name of the layer
+
+       layer: the LayerGeometry of the layer, as it is drawn
+
+       describe: the function (layer, ring_idx) which returns the text of
+                 a ring in the tooltip
+
+       _index: the STRtree of the rings of the layer
+    """
+
+    def __init__(self, name, layer, describe=None):
+
+        self.name = name
+        self.layer = layer
+        self.describe = describe or attribute_description()
+        self._index = layer_index(layer)
+
+    def pick(self, x_pos, y_pos):
+        """Return the index of the ring under the point (x_pos, y_pos), the
+        last one drawn (on top) if there are several, or None if there is
+        none.
+        """
+
+        dummy, ring_idx = points_in_rings(self.layer, [(x_pos, y_pos)],
+                                          self._index)
+        return int(ring_idx[-1]) if len(ring_idx) else None
+
+    def ring_path(self, ring_idx):
+        """Return the closed Path of the ring 'ring_idx'."""
+
+        return Path(self.layer.ring(ring_idx), closed=True)
+
+
+class MapInspector(object):
+
+    """The tooltip and the click-to-inspect of the features of the layers
+    drawn in the axes of a figure.
+
+    Fields:
+
+       figure: the figure
+
+       response_times: the time (in seconds) of the last responses to the
+                       cursor, from the event to the blit of the overlay
+
+       _pickers: a dictionary indexed by axis, with the LayerPicker of each
+                 layer drawn in that axis (in the order they are drawn)
+
+       _overlays: a dictionary indexed by axis, with the tuple (highlight,
+                  tooltip) of the animated artists over that axis
+
+       _background: the copy of the rendered figure, without the overlays
+
+       _hovered: the tuple (axis, ring of each layer) under the cursor, or
+                 None if there are no features under it
+
+       _tooltip_raster: the copy of the tooltip of the features under the
+                        cursor, once it has been drawn, to move it with the
+                        cursor without drawing its text again
+
+       _tooltip_anchor: the position of the cursor (in pixels) when the
+                        tooltip was drawn
+
+       _connections: the ids of the callbacks of the canvas
+    """
+
+    def __init__(self, figure):
+
+        self.figure = figure
+        self.response_times = collections.deque(maxlen=_NUM_RESPONSE_TIMES)
+        self._pickers = collections.OrderedDict()
+        self._overlays = dict()
+        self._background = None
+        self._hovered = None
+        self._tooltip_raster = None
+        self._tooltip_anchor = None
+        self._connections = []
+
+    def add_layer(self, axis, name, layer, describe=None):
+        """Make the features of 'layer', drawn in 'axis', inspectable.
+
+        :param axis: the axis where the layer is drawn
+        :param name: the name of the layer, in the tooltip
+        :param layer: the LayerGeometry drawn (e.g., simplified)
+        :param describe: the function (layer, ring_idx) which returns the
+                         text of a feature in the tooltip (by default, its
+                         first attributes)
+        """
+
+        self._pickers.setdefault(axis, []).append(
+            LayerPicker(name, layer, describe))
+        if axis not in self._overlays:
+            highlight = PathCollection([], animated=True, visible=False,
+                                       **HIGHLIGHT_STYLE)
+            axis.add_collection(highlight, autolim=False)
+            tooltip = axis.annotate('', xy=(0, 0), animated=True,
+                                    visible=False, **TOOLTIP_STYLE)
+            self._overlays[axis] = (highlight, tooltip)
+
+    def connect(self):
+        """Connect the inspector to the events of the canvas of the
+        figure.
+        """
+
+        canvas = self.figure.canvas
+        self._connections = [
+            canvas.mpl_connect('draw_event', self._on_draw),
+            canvas.mpl_connect('motion_notify_event', self._on_motion),
+            canvas.mpl_connect('button_press_event', self._on_click)]
+
+    def disconnect(self):
+        """Disconnect the inspector from the events of the canvas."""
+
+        for connection in self._connections:
+            self.figure.canvas.mpl_disconnect(connection)
+        self._connections = []
+
+    def hits(self, axis, x_pos, y_pos):
+        """Return the features of the layers of 'axis' under the point
+        (x_pos, y_pos), as the list of tuples (picker, ring_idx).
+        """
+
+        hits = []
+        for picker in self._pickers.get(axis, ()):
+            ring_idx = picker.pick(x_pos, y_pos)
+            if ring_idx is not None:
+                hits.append((picker, ring_idx))
+        return hits
+
+    def hover(self, axis, x_pos, y_pos):
+        """Respond to the cursor at (x_pos, y_pos) in 'axis' (None if it is
+        outside all the axes): highlight the features under it and show
+        their tooltip, blitting only the overlay.
+        """
+
+        start_time = timeit.default_timer()
+        hits = self.hits(axis, x_pos, y_pos) if axis is not None else []
+        hovered = (axis, tuple(ring_idx for dummy, ring_idx in hits)) \
+            if hits else None
+        if hovered is None and self._hovered is None:
+            return      # (nothing to draw, nor to erase)
+
+        if hovered != self._hovered:
+            for highlight, tooltip in self._overlays.values():
+                highlight.set_visible(False)
+                tooltip.set_visible(False)
+            if hits:
+                highlight, tooltip = self._overlays[axis]
+                highlight.set_paths([picker.ring_path(ring_idx)
+                                     for picker, ring_idx in hits])
+                highlight.set_visible(True)
+                tooltip.set_text('\n\n'.join(
+                    '[%s]\n%s' % (picker.name,
+                                  picker.describe(picker.layer, ring_idx))
+                    for picker, ring_idx in hits))
+                tooltip.set_visible(True)
+            self._hovered = hovered
+            self._tooltip_raster = None
+        if hits:
+            self._overlays[axis][1].xy = (x_pos, y_pos)
+
+        self._blit()
+        self.response_times.append(timeit.default_timer() - start_time)
+
+    def inspect(self, axis, x_pos, y_pos):
+        """Return the attributes of the features of the layers of 'axis'
+        under the point (x_pos, y_pos), as the list of tuples
+        (layer name, attributes).
+        """
+
+        return [(picker.name, picker.layer.ring_info(ring_idx))
+                for picker, ring_idx in self.hits(axis, x_pos, y_pos)]
+
+    def _on_draw(self, dummy_event):
+        """Keep a copy of the figure just rendered, and draw the overlay on
+        it.
+        """
+
+        self._background = self.figure.canvas.copy_from_bbox(
+            self.figure.bbox)
+        self._tooltip_raster = None
+        self._draw_overlay()
+
+    def _on_motion(self, event):
+        """Respond to a move of the cursor."""
+
+        if event.inaxes not in self._pickers:
+            self.hover(None, None, None)
+        else:
+            self.hover(event.inaxes, event.xdata, event.ydata)
+
+    def _on_click(self, event):
+        """Print the attributes of the features under a click."""
+
+        if event.inaxes not in self._pickers:
+            return
+        for name, info in self.inspect(event.inaxes, event.xdata,
+                                       event.ydata):
+            print('%s: %s' % (name, ', '.join('%s=%s' % item for item
+                                              in sorted(info.items()))))
+
+    def _draw_overlay(self):
+        """Draw the highlight and the tooltip of the features under the
+        cursor: the text of the tooltip is drawn only once per feature, and
+        then its copy is moved with the cursor (the text is what takes
+        longest to draw).
+        """
+
+        if self._hovered is None:
+            return
+        highlight, tooltip = self._overlays[self._hovered[0]]
+        highlight.axes.draw_artist(highlight)
+
+        canvas = self.figure.canvas
+        anchor = tooltip.axes.transData.transform([tooltip.xy])[0]
+        if self._tooltip_raster is None:
+            tooltip.axes.draw_artist(tooltip)
+            renderer = canvas.get_renderer()
+            extent = Bbox.union([
+                tooltip.get_window_extent(renderer),
+                tooltip.get_bbox_patch().get_window_extent(renderer)])
+            self._tooltip_raster = canvas.copy_from_bbox(
+                Bbox.intersection(extent.padded(1), self.figure.bbox) or
+                self.figure.bbox)
+            self._tooltip_anchor = anchor
+        else:
+            x_min, y_min, dummy, dummy = self._tooltip_raster.get_extents()
+            canvas.restore_region(
+                self._tooltip_raster,
+                xy=(x_min + anchor[0] - self._tooltip_anchor[0],
+                    y_min - anchor[1] + self._tooltip_anchor[1]))
+
+    def _blit(self):
+        """Draw the overlay over the copy of the rendered figure, and show
+        it.
+        """
+
+        if self._background is None:
+            return      # (the figure hasn't been rendered yet)
+        canvas = self.figure.canvas
+        canvas.restore_region(self._background)
+        self._draw_overlay()
+        canvas.blit(self.figure.bbox)
+
+    def response_time_summary(self):
+        """Return the tuple (number of responses, median time, maximum time,
+        number of responses slower than RESPONSE_TIME_BUDGET) of the last
+        responses to the cursor.
+        """
+
+        if not self.response_times:
+            return 0, 0.0, 0.0, 0
+        times = np.array(self.response_times)
+        return (len(times), float(np.median(times)), float(times.max()),
+                int(np.count_nonzero(times > RESPONSE_TIME_BUDGET)))
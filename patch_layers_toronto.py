@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Build the matplotlib collections of the choropleth layers (the Priority
+Investment Neighborhoods, the Business Improvement Areas, the CVA Tax Impact
+sub-wards, the City Wards colored by budget, ...) directly from the single
+vertex buffer of their LayerGeometry, instead of creating one
+matplotlib.patches.Polygon (and one copy of its vertices) per shape.
+
+The path codes of all the rings are computed at once for the whole vertex
+buffer: a layer drawn with a single color becomes a single compound Path,
+and a layer with one color per feature becomes a PathCollection whose paths
+are views on that same vertex buffer.
+"""
+
+import numpy as np
+from matplotlib.path import Path
+from matplotlib.patches import Polygon
+from matplotlib.collections import PathCollection
+
+from stage_profiler_toronto import profiled_stage
+
+
+def layer_path_codes(layer):
+    """Return the array of path codes for all the vertices of the
+    LayerGeometry 'layer': MOVETO at the first vertex of each ring, CLOSEPOLY
+    at its last vertex (the rings in a shapefile are closed, so their last
+    vertex repeats the first one), and LINETO for the rest.
+    """
+
+    codes = np.empty(len(layer.vertices), dtype=Path.code_type)
+    codes.fill(Path.LINETO)
+
+    ring_starts = layer.ring_offsets[:-1]
+    ring_ends = layer.ring_offsets[1:]
+    non_empty = ring_ends > ring_starts
+    codes[ring_ends[non_empty] - 1] = Path.CLOSEPOLY
+    codes[ring_starts[non_empty]] = Path.MOVETO
+    return codes
+
+
+def layer_compound_path(layer):
+    """Return a single compound Path with all the rings of 'layer'."""
+
+    return Path(layer.vertices, layer_path_codes(layer))
+
+
+def layer_ring_paths(layer):
+    """Return one Path per ring of 'layer', whose vertices and codes are
+    views on the vertex buffer of the layer (not copies).
+    """
+
+    codes = layer_path_codes(layer)
+    offsets = layer.ring_offsets.tolist()
+    return [Path(layer.vertices[start:end], codes[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+@profiled_stage('polygon_conversion')
+def layer_collection(layer, facecolors=None, match_original=False,
+                     raster=False, **kwargs):
+    """Return a PathCollection with the rings of 'layer', to add to an axis
+    with 'axis.add_collection()', as a PatchCollection of one Polygon per
+    ring would be.
+
+    :param layer: the LayerGeometry of the shapefile
+    :param facecolors: an array with one face color per ring of 'layer'; if
+                       it is None, the whole layer is a single compound path
+                       painted with the 'facecolor' in 'kwargs'
+    :param match_original: use the default edge color and line width of a
+                           matplotlib Polygon, as PatchCollection does with
+                           this parameter
+    :param raster: fill the faces of the rings by scanlines into a raster,
+                   when the collection is drawn by Agg (see
+                   scanline_raster_toronto), instead of as paths
+    :param kwargs: other keyword arguments for the PathCollection (as
+                   'edgecolor', 'linewidths', 'zorder', ...)
+    :returns: the PathCollection
+    """
+
+    if match_original:
+        default_polygon = Polygon(np.zeros((1, 2)), closed=True)
+        kwargs.setdefault('edgecolor', default_polygon.get_edgecolor())
+        kwargs.setdefault('linewidths', default_polygon.get_linewidth())
+
+    if raster:
+        # imported here since the raster backend is optional
+        from scanline_raster_toronto import ScanlineFilledCollection
+        if facecolors is None:
+            return ScanlineFilledCollection([layer_compound_path(layer)],
+                                            layer, compound=True, **kwargs)
+        return ScanlineFilledCollection(layer_ring_paths(layer), layer,
+                                        facecolors=facecolors, **kwargs)
+
+    if facecolors is None:
+        return PathCollection([layer_compound_path(layer)], **kwargs)
+
+    return PathCollection(layer_ring_paths(layer), facecolors=facecolors,
+                          **kwargs)
@@ -10,15 +10,107 @@ and then plots these budgets on a map of Toronto with the wards, coloring
 each ward according to its budget
 """
 
+import argparse
+import hashlib
+import os
 import re
-import xlrd
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-from matplotlib.colors import Normalize
+import sys
 import numpy as np
 
+from basemap_cache_toronto import toronto_basemap
+from budget_etl_cache_toronto import budget_etl_cache_fname, \
+    evict_budget_etl_cache
+from budget_projects_toronto import BudgetProjectTable, totals_agree, \
+    DEFAULT_NUM_TOP_PROJECTS
+from build_graph_toronto import BuildGraph
+from cache_dir_toronto import atomic_save_npz, touch_cache_entry
+from classify_values_toronto import classification_norm, \
+    CLASSIFICATION_SCHEMES, DEFAULT_NUM_CLASSES
+from excel_stream_toronto import iter_excel_rows, XL_CELL_EMPTY, \
+    XL_CELL_NUMBER, XL_CELL_TEXT
+from geometry_cache_toronto import readshapefile_cached, \
+    load_layer_geometry, shapefile_fnames
+from stage_profiler_toronto import enable_profiling, save_profile, \
+    profile_stage, profiled_stage
+
+# (matplotlib, and the modules which draw with it, are imported by the
+# functions which draw, so that the ETL alone doesn't take the time to
+# import them: see cli_toronto)
+
+
+# The Shapefile with the City Wards in Toronto
+CITY_WARDS_SHAPEFILE = './shp_dir/icitw_wgs84'
+
+# The size and resolution of the budget maps rendered in batch
+BUDGET_MAP_SIZE_INCHES = (8, 6)
+BUDGET_MAP_DPI = 150
+BUDGET_MAP_CMAP = 'Greens'
+
+# The frames per second of the animated budget timelines
+BUDGET_ANIMATION_FPS = 2
+
+# Increase this version whenever the drawing of the budget maps changes, so
+# that the maps rendered in batch are rendered again
+BUDGET_MAPS_VERSION = 1
+
+
+def shape_ward_numbers(city_wards):
+    """Return the list of the ward numbers of the polygons in the
+    LayerGeometry 'city_wards', in the same order as its polygons.
+    """
+
+    # The GIS shapefile 'city_wards' ('icitw_wgs84') has the ward
+    # number as the field with key 'SCODE_NAME' in that shapefile
+    # (you need to .lstrip('0') from it, because, e.g., wards whose
+    # number has a single digit are padded with left '0's in the
+    # shapefile, but are nevertheless in the decimal system -just
+    # padded with '0's, that's it- but Python will understand it
+    # as in octal, not decimal syste.)
+
+    return [int(scode_name.lstrip('0')) for scode_name
+            in city_wards.attributes['SCODE_NAME'].tolist()]
+
+
+def ward_budget_collection(city_wards, ward_values,
+                           cmap_name=BUDGET_MAP_CMAP, norm=None):
+    """Return the collection with the polygons of the LayerGeometry
+    'city_wards', each one colored according to its value in 'ward_values'
+    (in the same order as the polygons), normalized by the norm
+    'norm' (by default, from the minimum to the maximum of 'ward_values').
+    """
+
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import Normalize
+    from patch_layers_toronto import layer_collection
+
+    cmap = plt.get_cmap(cmap_name)
+    if norm is None:
+        norm = Normalize(vmin=ward_values.min(),
+                         vmax=ward_values.max())
+    return layer_collection(city_wards,
+                            facecolors=cmap(norm(ward_values)),
+                            match_original=True)
+
+
+def _cell_number(cell_obj):
+    """Return the float value of the Excel cell 'cell_obj' if it is a
+    number, otherwise 0.0.
+    """
+
+    if cell_obj and cell_obj.ctype == XL_CELL_NUMBER:
+        return float(cell_obj.value)
+    return 0.0
+
+
+def _cell_text(cell_obj):
+    """Return the stripped Unicode string of the Excel cell 'cell_obj' if
+    it is a string, otherwise u''.
+    """
+
+    if cell_obj and cell_obj.ctype == XL_CELL_TEXT:
+        return cell_obj.value.strip()
+    return u''
+
 
 class TorontoBudgetForecastPerCityWard(object):
 
@@ -26,7 +118,9 @@ class TorontoBudgetForecastPerCityWard(object):
 
     Methods:
 
-       constructor: no parameters (initializes internal fields)
+       constructor: optionally, the budget year of the first budget column
+                    of a spreadsheet without a header row with the budget
+                    years (by default, 2015)
 
        self.etl_excel_spreadsheet(excel_spreadsh_fname)
                 does an ETL on the Excel-spreadsheet-filename passed as
@@ -35,40 +129,304 @@ class TorontoBudgetForecastPerCityWard(object):
 
                    http://www1.toronto.ca/wps/portal/contentonly?vgnextoid=1dc340271f8e3310VgnVCM1000003dd60f89RCRD
 
+       self.etl_excel_spreadsheet_cached(excel_spreadsh_fname)
+                the same as etl_excel_spreadsheet(), but loading the
+                results of the ETL from the cache if this Excel spreadsheet
+                had been processed before
+
+       self.budget_for_wards(ward_numbers, year=None)
+                returns the vector of budgets for the wards 'ward_numbers'
+                in a budget year (or their total budgets if 'year' is None)
+
+       self.top_projects(ward_number, year=None)
+                returns the projects of a ward with the largest budgets in a
+                budget year (or in all the years span if 'year' is None)
+
     Fields:
 
+       _years: the list of budget years, in the order of the columns of
+               the Excel spreadsheet (taken from its header row)
+
+       _ward_numbers: an int array with the ward numbers, in increasing
+                      order, in the same order as the rows of the
+                      '_budget_matrix'
+
+       _budget_matrix: a float64 array of shape (num_wards, num_years),
+                       whose value [i, j] is the budget of ward
+                       '_ward_numbers[i]' in the year '_years[j]'
+
        _budget: a dictionary indexed by [budget_year][ward_number], whose
                 value is the float with budget for that year and that ward
+                (derived from '_budget_matrix', and built only once until
+                the budget years or the '_budget_matrix' change)
 
        _total_budget_per_ward: a dictionary indexed by [ward_number], whose
                                value is the float with budget for that ward
-                               for the next 10 years
+                               for the next 10 years (derived from
+                               '_budget_matrix')
+
+       _projects: the BudgetProjectTable with the budgets per year of the
+                  projects and sub-projects of each ward (the rows which
+                  aren't totals of a ward)
+
+       _validation_report: the list of messages about the rows of the Excel
+                           spreadsheet which failed the validation of the
+                           ETL
+
+       _default_first_year: the budget year of the first budget column if
+                            the Excel spreadsheet has no header row
 
        _re_total_ward: a compiled regular-expression to match which rows
                        in the Excel spreadsheet define Total of Budgets per
                        ward.
-    """
-
-    def __init__(self):
 
-        # This is budget per ward and per year
-        self._budget = dict()
-        for year in range(2015, 2026):
-            self._budget[year] = dict()
+       _re_ward: a compiled regular-expression to match the ward in the
+                 rows of the projects of a ward
+    """
 
-        # total budget in the 10 years span 2015-2025 per ward
-        self._total_budget_per_ward = dict()
+    # The layout of the columns in the Excel spreadsheet if it doesn't have
+    # a header row with the budget years: the first year is 2015 (unless
+    # another one is given), the columns 3 to 7 are the budgets for
+    # 2015..19, then there is a subtotal column for these first 5 years, and
+    # then the remaining years 2020... until the last column, which has the
+    # total budget
+    _DEFAULT_FIRST_YEAR = 2015
+    _DEFAULT_FIRST_YEAR_COLUMN = 3
+    _DEFAULT_SUBTOTAL_COLUMN = 3 + 5
+
+    # The header row with the budget years, if the Excel spreadsheet has
+    # one, is among its first rows: the rows after these aren't checked
+    _MAX_HEADER_ROWS = 10
+
+    def __init__(self, default_first_year=None):
+
+        self._default_first_year = default_first_year or \
+            self._DEFAULT_FIRST_YEAR
+
+        # The budget years, and the columns in the Excel spreadsheet with
+        # the budget of each of these years and with the total budget (these
+        # are found in the header row of the spreadsheet)
+        self._years = []
+        self._year_columns = None
+        self._total_column = None
+
+        # This is budget per ward and per year, a matrix ward x year
+        self._ward_numbers = np.zeros(0, dtype=np.int64)
+        self._budget_matrix = np.zeros((0, 0), dtype=np.float64)
+
+        # The '_budget' dictionary built from the matrix, or None if it has
+        # to be built again
+        self._budget_dict = None
+
+        # The number of rows of the Excel spreadsheet seen by the ETL
+        self._etl_num_rows = 0
+
+        # The rows with the budget totals of a ward seen by the ETL, before
+        # they are validated and assembled into the '_budget_matrix'
+        self._etl_ward_numbers = []
+        self._etl_ward_budgets = []
+        self._etl_ward_totals = []
+
+        # The budgets of the projects and sub-projects of the wards, and the
+        # rows of the projects seen by the ETL (the ward, the project, the
+        # sub-project and the numbers in the row), before they are
+        # validated and assembled into the table (the budget years of the
+        # row are known only after the first row of totals of a ward if the
+        # spreadsheet has no header row). A row of a project without its
+        # ward, or without its project, is of those of the row before it.
+        self._projects = BudgetProjectTable()
+        self._etl_project_rows = []
+        self._etl_project_ward = None
+        self._etl_project_name = None
+
+        # The messages about the rows which failed the validation of the ETL
+        self._validation_report = []
 
         # This is the reg-expr pattern which gives us a budget total per ward
         ptt_tot_ward = '(?P<ward_name>.*)-(?P<ward_number>[0-9][0-9]*) Total$'
         self._re_total_ward = re.compile(ptt_tot_ward, re.UNICODE)
 
-    def _save_budgets_of_a_ward(self, excel_budget_row, ward_number):
-        """This Excel row 'excel_budget_row' seems to be very likely the row
-        with the budgets for each of the next ten years for ward 'ward_number'
-        in the City of Toronto.
-        Finally check that it is so, and loads that budget into the internal
-        data-structures of this instance.
+        # This is the reg-expr pattern of the ward of a row of a project
+        ptt_ward = '(?P<ward_name>.*)-(?P<ward_number>[0-9][0-9]*)$'
+        self._re_ward = re.compile(ptt_ward, re.UNICODE)
+
+        # This is the reg-expr pattern of a budget year in the header row
+        self._re_year = re.compile(r'(?<![0-9])(?P<year>(19|20)[0-9][0-9])'
+                                   r'(?![0-9])', re.UNICODE)
+
+    @property
+    def _budget(self):
+        """The budget per ward and per year, as a dictionary indexed by
+        [budget_year][ward_number].
+        """
+
+        if self._budget_dict is None:
+            ward_numbers = self._ward_numbers.tolist()
+            if not ward_numbers:
+                self._budget_dict = dict((year, dict())
+                                         for year in self._years)
+            else:
+                self._budget_dict = dict(
+                    (year, dict(zip(ward_numbers,
+                                    self._budget_matrix[:, year_idx].tolist())))
+                    for year_idx, year in enumerate(self._years))
+        return self._budget_dict
+
+    @property
+    def _total_budget_per_ward(self):
+        """The total budget in the years span per ward, as a dictionary
+        indexed by [ward_number].
+        """
+
+        return dict(zip(self._ward_numbers.tolist(),
+                        self._budget_matrix.sum(axis=1).tolist()))
+
+    def budget_for_wards(self, ward_numbers, year=None):
+        """Return a float64 array with the budget of each ward in
+        'ward_numbers' (e.g., in the order of the polygons of the wards in a
+        shapefile) for the budget 'year', or their total budget in all the
+        years span if 'year' is None.
+
+        Raises KeyError if a ward or the year doesn't have a budget.
+        """
+
+        rows = self._ward_rows(ward_numbers)
+
+        if year is None:
+            return self._budget_matrix[rows].sum(axis=1)
+        return self._budget_matrix[rows, self._year_indices([year])[0]]
+
+    def budget_metric_for_wards(self, ward_numbers, metric='budget'):
+        """Return a float64 array of shape (len(ward_numbers), num_years)
+        with the value of the budget 'metric' of each ward in 'ward_numbers'
+        for each budget year. The metrics are:
+
+           'budget': the budget of the ward in that year
+
+           'share': the fraction of the budget of the whole city in that
+                    year which goes to the ward
+
+           'cumulative': the budget of the ward from the first year up to
+                         that year
+
+        Raises KeyError if a ward doesn't have a budget, and ValueError if
+        the metric is unknown.
+        """
+
+        rows = self._ward_rows(ward_numbers)
+
+        if metric == 'budget':
+            metric_matrix = self._budget_matrix
+        elif metric == 'share':
+            city_budget = self._budget_matrix.sum(axis=0)
+            metric_matrix = self._budget_matrix / \
+                np.where(city_budget != 0.0, city_budget, 1.0)
+        elif metric == 'cumulative':
+            metric_matrix = np.cumsum(self._budget_matrix, axis=1)
+        else:
+            raise ValueError("Unknown budget metric '%s'" % metric)
+
+        return metric_matrix[rows]
+
+    def top_projects(self, ward_number, year=None,
+                     num_projects=DEFAULT_NUM_TOP_PROJECTS):
+        """Return the projects of ward 'ward_number' with the largest
+        budgets in the budget 'year' (or in all the years span if 'year' is
+        None), at most 'num_projects' of them, as the list of tuples
+        (project name, sub-project name, budget), the largest first.
+
+        Raises KeyError if the ward doesn't have projects, or the year
+        doesn't have a budget.
+        """
+
+        return self._projects.top_projects(ward_number, year, num_projects)
+
+    def project_budget_for_wards(self, ward_numbers, project_name,
+                                 year=None):
+        """Return a float64 array with the budget of the project
+        'project_name' in each ward of 'ward_numbers' (e.g., in the order of
+        the polygons of the wards in a shapefile) in the budget 'year', or
+        in all the years span if 'year' is None (0.0 in the wards without
+        that project).
+
+        Raises KeyError if there is no such project, or the year doesn't
+        have a budget.
+        """
+
+        return self._projects.project_budget_for_wards(ward_numbers,
+                                                       project_name, year)
+
+    def _year_indices(self, years):
+        """Return the list of the indices in '_years' (the columns of the
+        '_budget_matrix') of the budget 'years'.
+
+        Raises KeyError if a year doesn't have a budget.
+        """
+
+        missing = [year for year in years if year not in self._years]
+        if missing:
+            raise KeyError("No budget for the years %s (the budget years "
+                           "are %s)" % (missing, self._years))
+        return [self._years.index(year) for year in years]
+
+    def _ward_rows(self, ward_numbers):
+        """Return the rows in the '_budget_matrix' of the wards in
+        'ward_numbers'.
+
+        Raises KeyError if a ward doesn't have a budget.
+        """
+
+        ward_numbers = np.asarray(ward_numbers, dtype=np.int64)
+        rows = np.searchsorted(self._ward_numbers, ward_numbers)
+        rows = np.minimum(rows, max(len(self._ward_numbers) - 1, 0))
+        if len(self._ward_numbers) == 0 or \
+           np.any(self._ward_numbers[rows] != ward_numbers):
+            missing = np.setdiff1d(ward_numbers, self._ward_numbers)
+            raise KeyError("No budget for wards %s" % missing.tolist())
+        return rows
+
+    def _etl_header_row(self, excel_row):
+        """See if this row 'excel_row' is the header row of the Excel
+        spreadsheet, i.e., the row with the budget years as the titles of
+        their columns (e.g., '2015 Budget', '2016 Plan', ...). If it is,
+        take from it the budget years and their columns, and the column
+        with the total budget (the last one titled 'Total ...').
+        """
+
+        years = []
+        year_columns = []
+        total_columns = []
+        for col_idx, cell_obj in enumerate(excel_row):
+            if cell_obj.ctype == XL_CELL_NUMBER and \
+               float(cell_obj.value).is_integer():
+                title = u'%d' % cell_obj.value
+            elif cell_obj.ctype == XL_CELL_TEXT:
+                title = cell_obj.value
+            else:
+                continue
+
+            years_in_title = self._re_year.findall(title)
+            if 'total' in title.lower():
+                total_columns.append(col_idx)
+            elif len(years_in_title) == 1:
+                years.append(int(years_in_title[0][0]))
+                year_columns.append(col_idx)
+
+        # a header needs at least a few year columns, in increasing order
+        # (a project can mention a year in its name)
+        if len(years) < 3 or np.any(np.diff(years) <= 0):
+            return False
+
+        self._years = years
+        self._budget_dict = None
+        self._year_columns = np.array(year_columns, dtype=np.int64)
+        self._total_column = total_columns[-1] if total_columns else None
+        return True
+
+    def _default_column_layout(self, excel_budget_row):
+        """Set the layout of the columns of the budget years when the Excel
+        spreadsheet has no header row with the budget years, from the
+        first row with a budget total of a ward 'excel_budget_row'.
         """
 
         max_col_numb = len(excel_budget_row) - 1
@@ -79,70 +437,254 @@ class TorontoBudgetForecastPerCityWard(object):
         # first 5 years in column 9th (8th 0-based), so this subtotal-column
         # for 5 years had to be skipped
 
-        range_columns = range(3, 3+5)             # the budgets for 2015..19
-        range_columns += range(3+5+1, max_col_numb)  # the remainings 2020...
+        year_columns = np.r_[self._DEFAULT_FIRST_YEAR_COLUMN:
+                             self._DEFAULT_SUBTOTAL_COLUMN,
+                             self._DEFAULT_SUBTOTAL_COLUMN + 1:max_col_numb]
+        self._year_columns = year_columns.astype(np.int64)
+        self._years = list(range(self._default_first_year,
+                                 self._default_first_year + len(year_columns)))
+        self._budget_dict = None
 
-        current_budget_year = 2015   # this is the year of the first budget
-        accum_budget_per_ward = 0.0
-        for col_idx in range_columns:  # Iterate through the columns (budgets)
-            cell_obj = excel_budget_row[col_idx]
-            if cell_obj and cell_obj.ctype == xlrd.XL_CELL_NUMBER:
-                ward_budget = float(cell_obj.value)
-            else:
-                ward_budget = 0.0
-            self._budget[current_budget_year][ward_number] = ward_budget
-            accum_budget_per_ward += ward_budget
-            current_budget_year += 1  # go to the next column (year)
-
-        # this is the total budget of the ward in the 10 years span: the
-        # last column of this row (columns are 0-indexed, so the last
-        # column is 'max_col_numb-1')
-        total_ward_budget = 0.0
-        total_of_ward = excel_budget_row[max_col_numb]
-        if total_of_ward and total_of_ward.ctype == xlrd.XL_CELL_NUMBER:
-            total_ward_budget = float(total_of_ward.value)
-
-        # but we had also accumulated this total in the 10-years-span by
-        # adding it above in the for-loop, year by year in this time span,
-        # so validate this ETL too
-        if total_ward_budget != accum_budget_per_ward:
-            print "Something strange in 10-years Total for this Ward %d: " \
-                "Explicit Total and Calculated Total don't agree: " \
-                "%f %f (difference: %f)" % \
-                (ward_number, total_ward_budget, accum_budget_per_ward,
-                 (total_ward_budget - accum_budget_per_ward))
-            return  # ignore this seemingly Ward Total row
+        # the total budget of the ward in the years span is the last column
+        self._total_column = max_col_numb
 
-        self._total_budget_per_ward[ward_number] = accum_budget_per_ward
+    def _save_budgets_of_a_ward(self, excel_budget_row, ward_number):
+        """This Excel row 'excel_budget_row' seems to be very likely the row
+        with the budgets for each of the next ten years for ward 'ward_number'
+        in the City of Toronto.
+        Keep its budgets per year and its explicit total, which are checked
+        against each other, for all the wards at once, at the end of the ETL.
+        """
+
+        if self._year_columns is None:
+            self._default_column_layout(excel_budget_row)
+
+        ward_budgets = np.array([_cell_number(excel_budget_row[col_idx])
+                                 if col_idx < len(excel_budget_row) else 0.0
+                                 for col_idx in self._year_columns])
+
+        # this is the total budget of the ward in the 10 years span, by
+        # default the last column of this row
+        total_column = self._total_column
+        if total_column is None or total_column >= len(excel_budget_row):
+            total_column = len(excel_budget_row) - 1
+        total_ward_budget = _cell_number(excel_budget_row[total_column])
+
+        self._etl_ward_numbers.append(ward_number)
+        self._etl_ward_budgets.append(ward_budgets)
+        self._etl_ward_totals.append(total_ward_budget)
+
+    def _report_invalid_row(self, message):
+        """Report that a row of the Excel spreadsheet failed the validation
+        of the ETL, with the explanation 'message'.
+        """
+
+        print(message)
+        self._validation_report.append(message)
+
+    def _build_budget_matrix(self):
+        """Validate the rows with the budget totals of a ward seen by the
+        ETL and assemble them into the ward x year '_budget_matrix'.
+        """
+
+        if not self._etl_ward_numbers:
+            return
+
+        ward_numbers = np.array(self._etl_ward_numbers, dtype=np.int64)
+        ward_budgets = np.vstack(self._etl_ward_budgets)
+        explicit_totals = np.array(self._etl_ward_totals)
+
+        # the explicit total of each ward has to agree with the total
+        # calculated adding its budgets year by year in this time span (the
+        # cumulative sum adds them in the same order as the spreadsheet), so
+        # validate this ETL too (within a tolerance, since the totals in the
+        # spreadsheet are rounded)
+        calculated_totals = np.cumsum(ward_budgets, axis=1)[:, -1]
+        valid = totals_agree(explicit_totals, calculated_totals)
+
+        for row_idx in np.flatnonzero(~valid):
+            self._report_invalid_row(
+                "Something strange in 10-years Total for this Ward %d: "
+                "Explicit Total and Calculated Total don't agree: "
+                "%f %f (difference: %f)" %
+                (ward_numbers[row_idx], explicit_totals[row_idx],
+                 calculated_totals[row_idx],
+                 (explicit_totals[row_idx] - calculated_totals[row_idx])))
+            # ignore this seemingly Ward Total row
+
+        # merge with the wards of a previous ETL; if a ward appears several
+        # times, its last row is the one kept
+        ward_numbers = np.concatenate((self._ward_numbers,
+                                       ward_numbers[valid]))
+        if self._budget_matrix.size:
+            ward_budgets = np.vstack((self._budget_matrix,
+                                      ward_budgets[valid]))
+        else:
+            ward_budgets = ward_budgets[valid]
+        last_rows = len(ward_numbers) - 1 - \
+            np.unique(ward_numbers[::-1], return_index=True)[1]
+
+        self._ward_numbers = ward_numbers[last_rows]
+        self._budget_matrix = ward_budgets[last_rows]
+        self._budget_dict = None
+
+        self._etl_ward_numbers = []
+        self._etl_ward_budgets = []
+        self._etl_ward_totals = []
+
+    def _build_project_table(self):
+        """Validate the rows of the projects seen by the ETL and assemble
+        them into the table of the '_projects', reconciling the budgets of
+        the projects of each ward with its row of budget totals.
+        """
+
+        project_rows = self._etl_project_rows
+        self._etl_project_rows = []
+        if not project_rows:
+            return
+        if self._year_columns is None:
+            self._report_invalid_row(
+                "No budget years for the %d rows of projects: they are "
+                "ignored" % len(project_rows))
+            return
+
+        # the budgets and the total of each row, in the same columns as in
+        # the rows with the budget totals of a ward
+        row_wards, projects, sub_projects, row_numbers = zip(*project_rows)
+        row_lengths = np.array([len(numbers) for numbers in row_numbers])
+        numbers = np.zeros((len(project_rows),
+                            max(row_lengths.max(),
+                                self._year_columns.max() + 1)))
+        for row_idx, row in enumerate(row_numbers):
+            numbers[row_idx, :len(row)] = row
+        total_columns = row_lengths - 1
+        if self._total_column is not None:
+            total_columns = np.where(self._total_column < row_lengths,
+                                     self._total_column, total_columns)
+        projects = BudgetProjectTable.from_rows(
+            self._years, row_wards, projects, sub_projects,
+            numbers[:, self._year_columns],
+            numbers[np.arange(len(project_rows)), total_columns])
+
+        valid = projects.reconcile_row_totals()
+        for row_idx in np.flatnonzero(~valid):
+            self._report_invalid_row(
+                "Something strange in 10-years Total for this Project of "
+                "Ward %d %s %s: Explicit Total and Calculated Total don't "
+                "agree: %f %f" %
+                (projects.row_wards[row_idx],
+                 projects.project_names[projects.row_projects[row_idx]],
+                 projects.sub_project_names[
+                     projects.row_sub_projects[row_idx]],
+                 projects.totals[row_idx],
+                 projects.budgets[row_idx].sum()))
+            # ignore this seemingly Project row
+        projects = projects.take(np.flatnonzero(valid))
+
+        # the projects of each ward have to add up to its budget in each
+        # year (the wards without projects in the spreadsheet aren't
+        # checked, and those without budget totals can't be)
+        missing_totals = np.setdiff1d(projects.ward_numbers,
+                                      self._ward_numbers)
+        if len(missing_totals):
+            self._report_invalid_row(
+                "No budget Totals for the Wards %s of these Projects: "
+                "they aren't reconciled" % missing_totals.tolist())
+        if len(self._ward_numbers):
+            agree = projects.reconcile_ward_budgets(self._ward_numbers,
+                                                    self._budget_matrix)
+            differences = projects.ward_budget_matrix(self._ward_numbers) - \
+                self._budget_matrix
+            for row_idx in np.flatnonzero(~agree.all(axis=1)):
+                year_idx = np.argmax(np.abs(differences[row_idx]))
+                self._report_invalid_row(
+                    "Something strange in the Projects of Ward %d: they "
+                    "don't add up to its Total in %d budget years (the "
+                    "largest difference: %f in %d)" %
+                    (self._ward_numbers[row_idx],
+                     np.count_nonzero(~agree[row_idx]),
+                     differences[row_idx, year_idx], self._years[year_idx]))
+
+        # merge with the projects of a previous ETL; the projects of a ward
+        # are replaced by those of its last rows
+        self._projects = self._projects.merged(projects)
+
+    def _etl_project_row(self, excel_budget_row, ward_description):
+        """Do an ETL of this row 'excel_budget_row', which isn't a row with
+        the 'Total' budget of a ward, to see if it is a row with the budget
+        of a project (or of a sub-project) of a ward, described as
+        'ward_description' in the col #0 (None if that column isn't a
+        string: then the row is of the ward of the previous row).
+        """
+
+        if ward_description is not None:
+            match = self._re_ward.match(ward_description.strip())
+            ward_number = int(match.group('ward_number')) if match else None
+            if ward_number != self._etl_project_ward:
+                self._etl_project_ward = ward_number
+                self._etl_project_name = None
+        if self._etl_project_ward is None or len(excel_budget_row) < 3:
+            return    # not a row of a ward
+
+        # The columns 1 and 2 are the Project and Sub-project Names (only
+        # the Sub-project Name is given in the rows of the sub-projects
+        # after the first one of a project)
+        project_name = _cell_text(excel_budget_row[1])
+        sub_project_name = _cell_text(excel_budget_row[2])
+        if not project_name:
+            if not sub_project_name or self._etl_project_name is None:
+                return    # no project in this row
+            project_name = self._etl_project_name
+        self._etl_project_name = project_name
+
+        # (the columns with the budget years may be known only after this
+        # row, so all the numbers of the row are kept)
+        self._etl_project_rows.append(
+            (self._etl_project_ward, project_name, sub_project_name,
+             [_cell_number(cell_obj) for cell_obj in excel_budget_row]))
 
     def _etl_excel_row(self, excel_budget_row):
         """Do an ETL of this row 'excel_budget_row', to see if it is a
         row with the summary 'Total' budget for a city ward for each of the
-        next 10 years (there are other rows with budgets per individual
-        projects in a ward: we're interested only in the rows which give
-        'Total' of budget for a ward for the next 10 years).
+        next 10 years, or else a row with the budget of an individual project
+        in a ward (see _etl_project_row()).
         """
 
+        self._etl_num_rows += 1
+        if self._year_columns is None and \
+           self._etl_num_rows <= self._MAX_HEADER_ROWS and \
+           self._etl_header_row(excel_budget_row):
+            return   # this is the header row: no budgets in it
+
         try:
             # Get the col #0 of the Excel row (with description)
             col_0_value = excel_budget_row[0]  # Get the col #0
-            # 'ctype == xlrd.XL_CELL_TEXT' means the value is a string
-            if not col_0_value or col_0_value.ctype != xlrd.XL_CELL_TEXT:
-                return    # ignore this row in the Excel spreadsheet
-
-            # we know now that 'ctype == xlrd.XL_CELL_TEXT', so its value
-            # is a Unicode string
-            # print type(col_0_value.value), col_0_value.value
-            match = self._re_total_ward.match(col_0_value.value)
-            if not match:
-                return   # no match: this row is not a total per ward
-            # It matched: get the ward name and the ward number
-            ward_name = match.group('ward_name')
-            ward_number = int(match.group('ward_number'))
+            # 'ctype == XL_CELL_TEXT' means the value is a string
+            if not col_0_value or col_0_value.ctype != XL_CELL_TEXT:
+                description = None
+                match = None
+            else:
+                # its value is a Unicode string
+                description = col_0_value.value
+                match = self._re_total_ward.match(description)
+            if match:
+                # It matched: get the ward name and the ward number
+                ward_name = match.group('ward_name')
+                ward_number = int(match.group('ward_number'))
         except Exception as an_exc:
-            print "Exception type is: %s\n" % an_exc
+            print("Exception type is: %s\n" % an_exc)
             return  # ignore this row in the Excel spreadsheet
 
+        if not match:
+            # no match: this row is not a total per ward, but it can be a
+            # project of a ward
+            self._etl_project_row(excel_budget_row, description)
+            return
+
+        # the rows after a total of a ward aren't of that ward
+        self._etl_project_ward = None
+        self._etl_project_name = None
+
         # The columns 1 and 2 are the Project and Sub-project Names:
         # validate in the ETL that these two columns should have empty
         # values in the case that the row is a total-budget per ward
@@ -151,19 +693,21 @@ class TorontoBudgetForecastPerCityWard(object):
         if not col_1_value or not col_2_value:
             return
 
-        if col_1_value.ctype != xlrd.XL_CELL_EMPTY or \
-           col_2_value.ctype != xlrd.XL_CELL_EMPTY:
-            print "Something strange in Totals for this Ward %s %s:" + \
-                  " it has Project or Sub-project Names %s %s:" % \
-                   (ward_number, ward_name, col_1_value.value,
-                    col_2_value.value)
+        if col_1_value.ctype != XL_CELL_EMPTY or \
+           col_2_value.ctype != XL_CELL_EMPTY:
+            self._report_invalid_row(
+                "Something strange in Totals for this Ward %s %s:"
+                " it has Project or Sub-project Names %s %s:" %
+                (ward_number, ward_name, col_1_value.value,
+                 col_2_value.value))
             return  # ignore this seemingly Ward Total row
 
-        print "Processing budget totals for Ward %d %s" % \
-              (ward_number, ward_name)
+        print("Processing budget totals for Ward %d %s" %
+              (ward_number, ward_name))
 
         self._save_budgets_of_a_ward(excel_budget_row, ward_number)
 
+    @profiled_stage('etl_excel_spreadsheet')
     def etl_excel_spreadsheet(self, excel_spreadsh_fname):
         """Do an ETL on the Excel spreadsheet 'excel_spreadsh_fname'
         with the budgets of the City of Toronto per Ward for the next
@@ -171,128 +715,503 @@ class TorontoBudgetForecastPerCityWard(object):
         downloaded from:
 
            http://www1.toronto.ca/wps/portal/contentonly?vgnextoid=1dc340271f8e3310VgnVCM1000003dd60f89RCRD
-        """
-
-        # Open the Excel workbook given
-        xl_workbook = xlrd.open_workbook(excel_spreadsh_fname)
 
-        # Open the first spreadsheet in this Excel workbook
-        xl_sheet = xl_workbook.sheet_by_index(0)
+        The rows of the first spreadsheet in this Excel workbook are
+        streamed one at a time, without loading the whole workbook.
+        """
 
-        # Do the ETL for each of the rows in this Excel spreadsheet
-        for curr_row_numb in range(0, xl_sheet.nrows):
-            self._etl_excel_row(xl_sheet.row(curr_row_numb))
+        # Do the ETL for each of the rows in the first spreadsheet of this
+        # Excel workbook
+        self._etl_num_rows = 0
+        for excel_row in iter_excel_rows(excel_spreadsh_fname, sheet_index=0):
+            self._etl_excel_row(excel_row)
 
-        xl_workbook.release_resources()
+        self._build_budget_matrix()
+        self._build_project_table()
 
         # print self._budget
         # print self._total_budget_per_ward
 
-    def _plot_ward_budget_with_color(self, to_map, axes):
+    def save_etl_results(self, npz_fname):
+        """Save the results of the ETL (the budget years, the ward x year
+        budget matrix, the table of the projects, and the validation report)
+        into the '.npz' file 'npz_fname'.
+        """
+
+        atomic_save_npz(npz_fname,
+                        years=np.array(self._years, dtype=np.int64),
+                        ward_numbers=self._ward_numbers,
+                        budget_matrix=self._budget_matrix,
+                        validation_report=np.array(self._validation_report,
+                                                   dtype='U'),
+                        **self._projects.arrays())
+
+    def load_etl_results(self, npz_fname):
+        """Load the results of the ETL saved by save_etl_results() in the
+        '.npz' file 'npz_fname'.
+        """
+
+        with np.load(npz_fname, allow_pickle=False) as npz_file:
+            self._years = npz_file['years'].tolist()
+            self._ward_numbers = npz_file['ward_numbers']
+            self._budget_matrix = npz_file['budget_matrix']
+            self._budget_dict = None
+            self._validation_report = npz_file['validation_report'].tolist()
+            self._projects = BudgetProjectTable.from_arrays(npz_file)
+
+    @profiled_stage('etl_excel_spreadsheet_cached')
+    def etl_excel_spreadsheet_cached(self, excel_spreadsh_fname):
+        """Do the ETL on the Excel spreadsheet 'excel_spreadsh_fname', as
+        etl_excel_spreadsheet() does, unless this same spreadsheet (the same
+        content) had already been processed by this same version of the ETL:
+        in that case, load the results of that ETL from the cache.
+
+        :returns: True if the results were loaded from the cache
+        """
+
+        first_year = self._default_first_year
+        cache_fname = budget_etl_cache_fname(
+            excel_spreadsh_fname,
+            first_year if first_year != self._DEFAULT_FIRST_YEAR else None)
+        if os.path.exists(cache_fname):
+            try:
+                self.load_etl_results(cache_fname)
+                touch_cache_entry(cache_fname)
+                return True
+            except (IOError, OSError, ValueError, KeyError):
+                pass   # a corrupt cache entry: do the ETL again
+
+        self.etl_excel_spreadsheet(excel_spreadsh_fname)
+        self.save_etl_results(cache_fname)
+        evict_budget_etl_cache()
+        return False
+
+    def _plot_ward_budget_with_color(self, to_map, axes,
+                                     classification=None):
         """Plot the budget per city ward, coloring each polygon according to
         "the ward's budget.
 
         to_map: the Basemap with the map of Toronto
 
         axes: the axes
+
+        classification: the tuple (scheme, num_classes) of the classes of
+                        the budgets, each one with its own color (or None
+                        to color them by a linear gradient)
+
+        Returns the tuple (city_wards, ten_yrs_bdg) with the LayerGeometry
+        of the wards drawn, and the budget of each of its polygons.
         """
 
+        import matplotlib.pyplot as plt
+
         # Plot the City Wards in Toronto. The borders of these polygons are
         # plot as they are in the Shapefile
 
-        dummy = to_map.readshapefile(shapefile='./shp_dir/icitw_wgs84',
-                                     name='city_wards',
-                                     drawbounds=False, color='green')
+        city_wards = readshapefile_cached(to_map,
+                                          shapefile=CITY_WARDS_SHAPEFILE,
+                                          name='city_wards',
+                                          drawbounds=False, color='green')
 
-        # The set of polygons (city-wards in Toronto) to add (to plot)
-        patches = []
         # The ten-years budget per city-ward (in same order as its
-        # geographical polygon
-        ten_yrs_bdg = []
-
-        for shape, shp_info in zip(to_map.city_wards, to_map.city_wards_info):
-            # print shp_info
-            # The GIS shapefile 'city_wards' ('icitw_wgs84') has the ward
-            # number as the field with key 'SCODE_NAME' in that shapefile
-            # (you need to .lstrip('0') from it, because, e.g., wards whose
-            # number has a single digit are padded with left '0's in the
-            # shapefile, but are nevertheless in the decimal system -just
-            # padded with '0's, that's it- but Python will understand it
-            # as in octal, not decimal syste.)
-
-            shape_ward_number = int(shp_info['SCODE_NAME'].lstrip('0'))
-
-            # the shapefile doesn't have the budget for this ward-number,
-            # but the Excel spreadsheet we had done the ETL on it did
-
-            ward_budget = self._total_budget_per_ward[shape_ward_number]
-            # print "Ward: %02d, 10-years budget: %f, Ward-name: %s" % \
-            #      (shape_ward_number, ward_budget, shp_info['NAME'])
-
-            # append this budget and its associated geographical polygon
-            ten_yrs_bdg.append(ward_budget)
-            patches.append(Polygon(np.array(shape), True))
-
-        cmap = plt.get_cmap('Greens')
-        patch_collection = PatchCollection(patches, match_original=True)
-        norm = Normalize(vmin=min(ten_yrs_bdg),
-                         vmax=max(ten_yrs_bdg))
-        patch_collection.set_facecolor(cmap(norm(ten_yrs_bdg)))
-
-        axes.add_collection(patch_collection)
-
-    def plot_budget(self):
+        # geographical polygon): the shapefile doesn't have the budget for
+        # this ward-number, but the Excel spreadsheet we had done the ETL on
+        # it did
+
+        ten_yrs_bdg = self.budget_for_wards(shape_ward_numbers(city_wards))
+
+        norm = classification_norm(ten_yrs_bdg,
+                                   plt.get_cmap(BUDGET_MAP_CMAP).N,
+                                   classification)
+        collection = ward_budget_collection(city_wards, ten_yrs_bdg,
+                                            norm=norm)
+        with profile_stage('add_collection', layer='city_wards'):
+            axes.add_collection(collection)
+        return city_wards, ten_yrs_bdg
+
+    def plot_budget(self, classification=None, interactive=False):
         """Plot the budget for the next years per ward in the City of
         Toronto, according to the ETL done by the previous method
         etl_excel_spreadsheet() that should have been called already
+        (with the colors of the 'classification' of the budgets, see
+        _plot_ward_budget_with_color())
+
+        If 'interactive', the ward under the cursor is highlighted, with a
+        tooltip with its budget, and a click prints its attributes.
         """
-        # These are the latitudes of the City of Toronto.
-        # (Fiona can be better to find them, e.g., from the 'icitw_wgs84'
-        # Shapefile below.)
 
-        low_left_corner_longitude = -79.75
-        low_left_corner_latitude = 43.40
-        up_right_corner_longitude = -79.10
-        up_right_corner_latitude = 43.95
+        import matplotlib.pyplot as plt
+        from interactive_picking_toronto import MapInspector
 
         fig = plt.figure()
         axes = fig.add_subplot(111)
 
-        # Prepare the map of Toronto
+        # Prepare the map of Toronto (built once, and shared with the other
+        # maps of Toronto with the same resolution)
 
-        to_map = Basemap(llcrnrlon=low_left_corner_longitude,
-                         llcrnrlat=low_left_corner_latitude,
-                         urcrnrlon=up_right_corner_longitude,
-                         urcrnrlat=up_right_corner_latitude,
-                         ellps='WGS84',
-                         resolution='h', area_thresh=5)
+        to_map = toronto_basemap(axis=axes, resolution='h', area_thresh=5)
 
         to_map.drawmapboundary(fill_color='white')
 
         # Plot the City Wards in Toronto. The borders of these polygons are
         # plot as they are in the Shapefile
 
-        self._plot_ward_budget_with_color(to_map, axes)
+        city_wards, ten_yrs_bdg = self._plot_ward_budget_with_color(
+            to_map, axes, classification)
 
         plt.title('Toronto Neighborhoods: ' +
                   '10-year staff-proposed budget per ward')
         # plt.legend()
+        if interactive:
+            # (kept in a variable while the map is shown: the canvas only
+            # keeps weak references to the callbacks of the inspector)
+            inspector = MapInspector(fig)
+            inspector.add_layer(axes, 'ward', city_wards,
+                                _ward_budget_description(ten_yrs_bdg))
+            inspector.connect()
         plt.show()
 
 
-def main():
-    """Main function on the program.
+def _ward_budget_description(ward_budgets):
+    """Return the function (layer, ring_idx) which describes a ward in the
+    tooltip of the interactive map: its number, its name and its budget in
+    'ward_budgets' (in the same order as the polygons of the layer).
+    """
+
+    from interactive_picking_toronto import attribute_description
+
+    describe_attributes = attribute_description(('SCODE_NAME', 'NAME'))
+
+    def describe(city_wards, ring_idx):
+        """The attributes and the budget of the ward 'ring_idx'."""
+
+        return '%s\nbudget: %.1f M' % (describe_attributes(city_wards,
+                                                            ring_idx),
+                                       ward_budgets[ring_idx] / 1e6)
+
+    return describe
+
+
+# The titles of the budget maps, per budget metric
+_BUDGET_METRIC_TITLES = {
+    'budget': 'staff-proposed budget per ward in %d',
+    'share': 'share of the city budget per ward in %d',
+    'cumulative': 'cumulative budget per ward up to %d',
+}
+
+
+def _render_budget_map(frame):
+    """Render one budget map in a worker process, with the Agg backend.
+
+    :param frame: the tuple (ward_values, title, image_fname, dpi,
+                  classification), with the value for the color of each
+                  polygon of the City Wards Shapefile (in the order of its
+                  polygons), and the classification of these values (see
+                  render_budget_maps())
+    :returns: 'image_fname'
+    """
+
+    import matplotlib.pyplot as plt
+    from matplotlib.cm import ScalarMappable
+    from raster_composite_toronto import new_agg_figure
+
+    ward_values, title, image_fname, dpi, classification = frame
+
+    fig = new_agg_figure(BUDGET_MAP_SIZE_INCHES, dpi)
+    axes = fig.add_subplot(111)
+
+    # the Basemap and the geometry of the wards were loaded by the parent
+    # process before forking this worker, so they are taken from memory
+
+    to_map = toronto_basemap(axis=axes, resolution='h', area_thresh=5)
+    to_map.drawmapboundary(fill_color='white')
+
+    city_wards = load_layer_geometry(to_map, CITY_WARDS_SHAPEFILE,
+                                     'city_wards')
+    cmap = plt.get_cmap(BUDGET_MAP_CMAP)
+    norm = classification_norm(ward_values, cmap.N, classification)
+    collection = ward_budget_collection(city_wards, ward_values, norm=norm)
+    with profile_stage('add_collection', layer='city_wards'):
+        axes.add_collection(collection)
+
+    with profile_stage('colorbar'):
+        mappable = ScalarMappable(norm=norm, cmap=cmap)
+        mappable.set_array(ward_values)
+        color_bar = fig.colorbar(mappable, ax=axes, shrink=0.7)
+        color_bar.ax.tick_params(labelsize=7)
+
+    axes.set_title(title)
+    with profile_stage('savefig', image=image_fname):
+        fig.savefig(image_fname, dpi=dpi)
+    return image_fname
+
+
+def render_budget_maps(budget, output_dir, metrics=('budget',), years=None,
+                       dpi=BUDGET_MAP_DPI, processes=None,
+                       classification=None):
+    """Render without a display one map of the wards of Toronto per budget
+    year and per budget metric (see budget_metric_for_wards()), plus the map
+    of the total budget of each ward, as PNG images in 'output_dir'. The
+    maps are rendered in parallel by a pool of worker processes, and only
+    the maps whose values or parameters changed since they were last
+    rendered are rendered again.
+
+    :param budget: the TorontoBudgetForecastPerCityWard, after its ETL
+    :param output_dir: the directory where to save the images
+    :param metrics: the budget metrics to render
+    :param years: the budget years to render (None for all the years);
+                  KeyError is raised if one of them doesn't have a budget
+    :param dpi: the resolution of the images
+    :param processes: the number of worker processes (None for as many as
+                      CPUs)
+    :param classification: the tuple (scheme, num_classes) of the classes
+                           of the values of each map, each one with its own
+                           color (see classify_values_toronto), or None to
+                           color the values by a linear gradient
+    :returns: the list of the images rendered (those which were up to date
+              aren't)
+    """
+
+    if years is None:
+        years = budget._years
+    year_indices = budget._year_indices(years)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    # Load the Basemap and the geometry of the wards only once, here, so
+    # the worker processes inherit them
+    to_map = toronto_basemap(resolution='h', area_thresh=5)
+    city_wards = load_layer_geometry(to_map, CITY_WARDS_SHAPEFILE,
+                                     'city_wards')
+    ward_numbers = shape_ward_numbers(city_wards)
+
+    title_prefix = 'Toronto Neighborhoods: '
+    frames = [(budget.budget_for_wards(ward_numbers),
+               title_prefix + 'total staff-proposed budget per ward',
+               os.path.join(output_dir, 'TO_budget_total.png'), dpi,
+               classification)]
+
+    for metric in metrics:
+        metric_values = budget.budget_metric_for_wards(ward_numbers, metric)
+        for year, year_idx in zip(years, year_indices):
+            frames.append((metric_values[:, year_idx],
+                           title_prefix + _BUDGET_METRIC_TITLES[metric] % year,
+                           os.path.join(output_dir, 'TO_budget_%s_%d.png' %
+                                        (metric, year)),
+                           dpi, classification))
+
+    # Each map is a target of a build graph, whose key depends on the
+    # values of its wards (not on the whole spreadsheet), so only the maps
+    # whose values changed since they were last rendered are rendered again
+    graph = BuildGraph('budget_maps')
+    for frame in frames:
+        ward_values, title, image_fname, dummy, dummy = frame
+        values_digest = hashlib.sha1(
+            np.ascontiguousarray(ward_values, dtype=np.float64).tobytes())
+        graph.add_target(image_fname, _render_budget_map, args=(frame,),
+                         input_files=shapefile_fnames(CITY_WARDS_SHAPEFILE),
+                         params=(BUDGET_MAPS_VERSION, BUDGET_MAP_SIZE_INCHES,
+                                 BUDGET_MAP_CMAP, title, dpi,
+                                 values_digest.hexdigest(), classification),
+                         outputs=[image_fname])
+
+    return graph.build(processes=processes)
+
+
+def render_budget_animation(budget, animation_fname, metric='budget',
+                            years=None, dpi=BUDGET_MAP_DPI,
+                            fps=BUDGET_ANIMATION_FPS, classification=None):
+    """Render without a display the animated timeline of the budget 'metric'
+    (see budget_metric_for_wards()) of the wards of Toronto, one frame per
+    budget year, into the GIF or MP4 file 'animation_fname'.
+
+    The figure, the map and the collection of the wards are built only once:
+    for each year, only the face colors of the collection and the title
+    change, and only they are drawn again (blitted) over the raster of the
+    rest of the figure. The colors are normalized across all the years, so
+    the frames can be compared, and share a single color bar.
+
+    :param budget: the TorontoBudgetForecastPerCityWard, after its ETL
+    :param animation_fname: the '.gif' or '.mp4' file to write
+    :param metric: the budget metric to animate
+    :param years: the budget years to animate (None for all the years), as
+                  in render_budget_maps()
+    :param dpi: the resolution of the frames
+    :param fps: the frames per second of the animation
+    :param classification: the classification of the values of all the
+                           years (see render_budget_maps())
+    :returns: the number of frames
+    """
+
+    import matplotlib.pyplot as plt
+    from matplotlib.cm import ScalarMappable
+    from animation_writer_toronto import animation_writer
+    from raster_composite_toronto import canvas_rgba, new_agg_figure
+
+    if years is None:
+        years = budget._years
+    year_indices = budget._year_indices(years)
+    writer = animation_writer(animation_fname, fps)
+
+    fig = new_agg_figure(BUDGET_MAP_SIZE_INCHES, dpi)
+    axes = fig.add_subplot(111)
+    to_map = toronto_basemap(axis=axes, resolution='h', area_thresh=5)
+    to_map.drawmapboundary(fill_color='white')
+
+    city_wards = load_layer_geometry(to_map, CITY_WARDS_SHAPEFILE,
+                                     'city_wards')
+    year_values = budget.budget_metric_for_wards(
+        shape_ward_numbers(city_wards), metric)
+    year_values = year_values[:, year_indices]
+
+    # A single normalization (or classification) of the colors for all the
+    # years
+    cmap = plt.get_cmap(BUDGET_MAP_CMAP)
+    norm = classification_norm(year_values, cmap.N, classification)
+
+    collection = ward_budget_collection(city_wards, year_values[:, 0],
+                                        norm=norm)
+    with profile_stage('add_collection', layer='city_wards'):
+        axes.add_collection(collection)
+
+    with profile_stage('colorbar'):
+        mappable = ScalarMappable(norm=norm, cmap=cmap)
+        mappable.set_array(year_values)
+        color_bar = fig.colorbar(mappable, ax=axes, shrink=0.7)
+        color_bar.ax.tick_params(labelsize=7)
+
+    # The artists which change in each frame are animated, so the full draw
+    # of the figure leaves them out of its raster (the background)
+    title = axes.set_title('')
+    collection.set_animated(True)
+    title.set_animated(True)
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    title_format = 'Toronto Neighborhoods: ' + _BUDGET_METRIC_TITLES[metric]
+    for year_idx, year in enumerate(years):
+        with profile_stage('animation_frame', year=year):
+            collection.set_facecolor(cmap(norm(year_values[:, year_idx])))
+            title.set_text(title_format % year)
+            canvas.restore_region(background)
+            axes.draw_artist(collection)
+            axes.draw_artist(title)
+            writer.add_frame(canvas_rgba(canvas))
+
+    with profile_stage('savefig', image=animation_fname):
+        writer.close()
+    return len(years)
+
+
+def plot_excel_budget(args):
+    """Do the ETL of the budget spreadsheet, and plot it as the command-line
+    arguments 'args' say.
     """
 
     opendata_excel_spreadsh = 'shp_dir/budget_per_city_ward.xlsx'
 
     toronto_budg_per_neighb = TorontoBudgetForecastPerCityWard()
 
-    # Do the ETL from the Excel spreadsheet first
-    toronto_budg_per_neighb.etl_excel_spreadsheet(opendata_excel_spreadsh)
+    # Do the ETL from the Excel spreadsheet first (or load its results from
+    # the cache, if this spreadsheet hasn't changed since its last ETL)
+    toronto_budg_per_neighb.etl_excel_spreadsheet_cached(
+        opendata_excel_spreadsh)
+
+    # the budget years requested have to be in the spreadsheet
+    if args.year:
+        try:
+            toronto_budg_per_neighb._year_indices(args.year)
+        except KeyError as an_exc:
+            sys.exit(an_exc.args[0])
+
+    classification = (args.classify, args.classes) if args.classify \
+        else None
+
+    if args.animate:
+        # Render the animated timeline of the budget without a display
+        num_frames = render_budget_animation(
+            toronto_budg_per_neighb, args.animate,
+            metric=(args.metric or ['budget'])[0], years=args.year,
+            dpi=args.dpi, fps=args.fps, classification=classification)
+        print("Rendered the %d frames of the budget timeline into %s" %
+              (num_frames, args.animate))
+        return
+
+    if args.batch:
+        # Render the maps per year (and metric) without a display
+        images = render_budget_maps(toronto_budg_per_neighb, args.batch,
+                                    metrics=args.metric or ('budget',),
+                                    years=args.year, dpi=args.dpi,
+                                    processes=args.processes,
+                                    classification=classification)
+        print("Rendered %d budget maps into %s (the others were up to "
+              "date)" % (len(images), args.batch))
+        return
 
     # Plot the budget using matplotlib/basemap
-    toronto_budg_per_neighb.plot_budget()
+    toronto_budg_per_neighb.plot_budget(classification,
+                                        interactive=args.interactive)
+
+
+def main(argv=None, prog=None):
+    """Main function on the program.
+
+    :param argv: the command-line arguments (None for those of the program)
+    :param prog: the name of the program in its usage (None for the name of
+                 its script)
+    """
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Plot the budget per ward of the City of Toronto')
+    parser.add_argument('--batch', metavar='OUTPUT_DIR',
+                        help='render without a display one map per budget '
+                             'year and metric into OUTPUT_DIR, instead of '
+                             'showing the map of the total budget')
+    parser.add_argument('--animate', metavar='ANIMATION_FNAME',
+                        help='render without a display the timeline of '
+                             'the budget per year, as an animated GIF or '
+                             'MP4 (by the extension of ANIMATION_FNAME)')
+    parser.add_argument('--fps', type=float, default=BUDGET_ANIMATION_FPS,
+                        help='frames per second of the animated timeline '
+                             '(default: %(default)s)')
+    parser.add_argument('--metric', action='append',
+                        choices=sorted(_BUDGET_METRIC_TITLES),
+                        help='budget metric to render in batch (can be '
+                             'repeated; default: budget), or to animate '
+                             '(the first one)')
+    parser.add_argument('--year', type=int, action='append',
+                        help='budget year to render in batch or to animate '
+                             '(can be repeated; default: all the years)')
+    parser.add_argument('--dpi', type=int, default=BUDGET_MAP_DPI,
+                        help='resolution of the maps rendered in batch or '
+                             'animated '
+                             '(default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes rendering in '
+                             'batch (default: as many as CPUs)')
+    parser.add_argument('--classify', choices=CLASSIFICATION_SCHEMES,
+                        help='color the budgets by classes of this scheme, '
+                             'instead of by a linear gradient')
+    parser.add_argument('--classes', type=int, default=DEFAULT_NUM_CLASSES,
+                        help='number of classes with --classify (default: '
+                             '%(default)s)')
+    parser.add_argument('--interactive', action='store_true',
+                        help='in the map shown, highlight the ward under '
+                             'the cursor with a tooltip with its budget, '
+                             'and print the attributes of a ward clicked')
+    parser.add_argument('--profile', metavar='TRACE_FNAME',
+                        help='profile the time and memory of each stage, '
+                             'into a JSON trace of events in TRACE_FNAME')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        enable_profiling(args.profile)
+    try:
+        plot_excel_budget(args)
+    finally:
+        save_profile()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Helpers to render matplotlib figures into RGBA rasters with the Agg
+backend (without a display, e.g., in worker processes), and to composite
+these rasters into a single image.
+
+A figure rendered with a transparent background leaves only its own artists
+in the raster, so several figures with the same size, each one drawing a
+different panel, can be composited over a white background into the same
+image that a single figure drawing all the panels would have given.
+"""
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.image
+
+
+def new_agg_figure(size_inches, dpi):
+    """Return a new matplotlib Figure of 'size_inches' at 'dpi', attached to
+    an Agg canvas (it doesn't need pyplot nor a display).
+    """
+
+    fig = Figure(figsize=size_inches, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def render_figure_rgba(fig, transparent=True):
+    """Render the figure 'fig' with the Agg backend, at the DPI of the
+    figure, and return its raster as an uint8 array (height, width, 4).
+
+    If 'transparent', the background of the figure and of its axes is not
+    drawn, so the raster only has the artists in them.
+    """
+
+    if transparent:
+        fig.patch.set_alpha(0.0)
+        for axis in fig.axes:
+            axis.patch.set_alpha(0.0)
+
+    canvas = fig.canvas
+    if not isinstance(canvas, FigureCanvasAgg):
+        canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return canvas_rgba(canvas).copy()
+
+
+def canvas_rgba(canvas):
+    """Return the raster which the Agg 'canvas' has drawn so far, as an
+    uint8 array (height, width, 4) which shares the memory of the canvas
+    (so it changes when the canvas draws again).
+    """
+
+    renderer = canvas.get_renderer()
+    rgba = np.frombuffer(renderer.buffer_rgba(), dtype=np.uint8)
+    return rgba.reshape(int(renderer.height), int(renderer.width), 4)
+
+
+def composite_over_white(rgba_rasters, band_rows=512):
+    """Composite the RGBA rasters in 'rgba_rasters' (all of the same size),
+    in order, over a white background (alpha blending, the 'over' operator).
+
+    The rasters are composited in bands of 'band_rows' rows, so the memory
+    used is bounded even for big images (the rasters can be memory-mapped
+    '.npy' files).
+
+    :returns: the RGB uint8 array with the composited image
+    """
+
+    height, width = rgba_rasters[0].shape[:2]
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+
+    for band_start in range(0, height, band_rows):
+        band = slice(band_start, min(band_start + band_rows, height))
+        band_rgb = np.ones((band.stop - band.start, width, 3),
+                           dtype=np.float32)
+        for rgba in rgba_rasters:
+            band_rgba = np.asarray(rgba[band], dtype=np.float32) / 255.0
+            alpha = band_rgba[:, :, 3:4]
+            band_rgb *= 1.0 - alpha
+            band_rgb += alpha * band_rgba[:, :, :3]
+        rgb[band] = np.round(band_rgb * 255.0).astype(np.uint8)
+
+    return rgb
+
+
+def save_rgb_png(fname, rgb, dpi):
+    """Save the RGB raster 'rgb' as the PNG image 'fname', with 'dpi' as
+    its resolution.
+    """
+
+    matplotlib.image.imsave(fname, rgb, dpi=dpi, format='png')
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Read an ESRI Shapefile of the City of Toronto into a LayerGeometry
+projected by the Basemap of Toronto, reprojecting it from the coordinate
+system in which it is published (e.g., the Priority Investment
+Neighborhoods are in NAD27 / UTM zone 17N, EPSG:26717), instead of
+converting it first into a WGS84 Shapefile with ogr2ogr.
+
+The vertices of all the shapes of the Shapefile are read into a single
+buffer, which is transformed at once: to longitudes and latitudes with one
+call to pyproj (if the Shapefile isn't already in them), and to the
+projection of the map with one call to the Basemap, instead of one call per
+ring as Basemap.readshapefile() does. The attributes of each ring are the
+same that Basemap.readshapefile() leaves, with its 'RINGNUM' and
+'SHAPENUM'.
+
+The layers read are saved in the geometry cache (see geometry_cache_toronto),
+so this is only done when the Shapefile changes.
+"""
+
+import itertools
+
+import numpy as np
+
+try:
+    import shapefile                                # pyshp
+except ImportError:
+    from mpl_toolkits.basemap import shapefile      # the one in Basemap
+try:
+    import pyproj
+except ImportError:
+    from mpl_toolkits.basemap import pyproj         # the one in Basemap
+
+from geometry_cache_toronto import LayerGeometry, typed_column, WGS84_SRS
+
+
+# The types of the shapes which can be read: Polyline and Polygon, also with
+# Z or M values, of which only the x and y are kept (and the Null shapes,
+# which don't have any ring)
+_SHAPE_TYPES = (shapefile.NULL, shapefile.POLYLINE, shapefile.POLYGON,
+                shapefile.POLYLINEZ, shapefile.POLYGONZ,
+                shapefile.POLYLINEM, shapefile.POLYGONM)
+
+# The transformations from each coordinate system to WGS84, as they are
+# built
+_TRANSFORMERS = dict()
+
+
+def _to_wgs84_transformer(srs):
+    """Return a function (x, y) -> (lons, lats) which transforms the arrays
+    of coordinates 'x' and 'y' in the coordinate system 'srs' (as
+    'EPSG:<code>') into WGS84.
+    """
+
+    transformer = _TRANSFORMERS.get(srs)
+    if transformer is None:
+        if hasattr(pyproj, 'Transformer'):
+            transformer = pyproj.Transformer.from_crs(
+                srs, WGS84_SRS, always_xy=True).transform
+        else:
+            # (the pyproj 1.x of Basemap)
+            src_proj = pyproj.Proj(init=srs.lower())
+            dst_proj = pyproj.Proj(init=WGS84_SRS.lower())
+
+            def transformer(x, y):
+                """The transformation with pyproj 1.x."""
+                return pyproj.transform(src_proj, dst_proj, x, y)
+
+        _TRANSFORMERS[srs] = transformer
+    return transformer
+
+
+def read_shapefile_rings(shapefile_name):
+    """Read the rings of all the shapes of the Shapefile 'shapefile_name'
+    (its path without extension), without projecting them.
+
+    :returns: the tuple (vertices, ring_offsets, attributes), as the fields
+              of a LayerGeometry, with the coordinates of the vertices as
+              they are in the Shapefile
+    """
+
+    reader = shapefile.Reader(shapefile_name)
+    try:
+        shapes = reader.shapes()
+        records = reader.records()
+        field_names = [field[0] for field in reader.fields[1:]]
+    finally:
+        if hasattr(reader, 'close'):
+            reader.close()
+
+    for shape in shapes:
+        if shape.shapeType not in _SHAPE_TYPES:
+            raise ValueError('Shapefile %s has shapes of type %d: only '
+                             'Polylines and Polygons (also Z or M) can '
+                             'be read' %
+                             (shapefile_name, shape.shapeType))
+
+    # the offset of the first vertex of each shape, and of each of its rings
+    # (the parts of the shape) in the single buffer of all their vertices
+    shape_sizes = np.array([len(shape.points) for shape in shapes],
+                           dtype=np.int64)
+    shape_offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+    np.cumsum(shape_sizes, out=shape_offsets[1:])
+    num_rings = np.array([len(shape.parts) if len(shape.points) else 0
+                          for shape in shapes], dtype=np.int64)
+
+    ring_shape_ids = np.repeat(np.arange(len(shapes)), num_rings)
+    ring_starts = np.fromiter(
+        itertools.chain.from_iterable(
+            shape.parts if len(shape.points) else () for shape in shapes),
+        dtype=np.int64, count=int(num_rings.sum()))
+    ring_offsets = np.append(ring_starts + shape_offsets[ring_shape_ids],
+                             shape_offsets[-1])
+
+    # only the x and y of the points (the Z and M values of the PolygonZ,
+    # PolylineM, ... shapes are dropped)
+    vertices = np.fromiter(
+        itertools.chain.from_iterable(
+            itertools.chain.from_iterable(
+                (point[0], point[1]) for point in shape.points)
+            for shape in shapes),
+        dtype=np.float64, count=2 * int(shape_offsets[-1])).reshape(-1, 2)
+
+    # as Basemap.readshapefile(), each ring has the attributes of its shape,
+    # its number in the shape and the number of the shape (from 1)
+    first_ring = np.zeros(len(shapes) + 1, dtype=np.int64)
+    np.cumsum(num_rings, out=first_ring[1:])
+    attributes = dict()
+    for field_idx, field_name in enumerate(field_names):
+        attributes[field_name] = typed_column(
+            [record[field_idx] for record in records])[ring_shape_ids]
+    attributes['RINGNUM'] = \
+        np.arange(len(ring_shape_ids)) - first_ring[ring_shape_ids] + 1
+    attributes['SHAPENUM'] = ring_shape_ids + 1
+
+    return vertices, ring_offsets, attributes
+
+
+def reproject_vertices(vertices, srs, to_map):
+    """Return the 'vertices' (an array of shape (num_vertices, 2)) in the
+    coordinate system 'srs' projected by the Basemap 'to_map', transforming
+    all of them at once.
+    """
+
+    if not len(vertices):
+        return np.zeros((0, 2), dtype=np.float64)
+
+    lons, lats = vertices[:, 0], vertices[:, 1]
+    if srs != WGS84_SRS:
+        lons, lats = _to_wgs84_transformer(srs)(lons, lats)
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+    # (the same check as Basemap.readshapefile())
+    if lons.max() > 721. or lons.min() < -721. or \
+       lats.max() > 90.01 or lats.min() < -90.01:
+        raise ValueError('The vertices are not in geographic coordinates '
+                         '(is %s the coordinate system of the Shapefile?)' %
+                         srs)
+
+    x_coords, y_coords = to_map(lons, lats)
+    return np.column_stack((x_coords, y_coords)).astype(np.float64)
+
+
+def read_layer_geometry(to_map, shapefile_name, srs=WGS84_SRS):
+    """Read the Shapefile 'shapefile_name' (its path without extension),
+    whose coordinates are in the coordinate system 'srs', projected by the
+    Basemap 'to_map'.
+
+    :returns: its LayerGeometry
+    """
+
+    vertices, ring_offsets, attributes = read_shapefile_rings(shapefile_name)
+    return LayerGeometry(reproject_vertices(vertices, srs, to_map),
+                         ring_offsets, attributes)
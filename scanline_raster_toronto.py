@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""A raster backend for the faces of the choropleth layers (the CVA Tax
+Impact sub-wards, the Priority Investment Neighborhoods, ...): their polygons
+are filled by scanlines straight from the vertex buffer of their
+LayerGeometry into a numpy RGBA array, instead of being drawn by Agg as one
+anti-aliased path per polygon, one after the other in a single thread.
+
+The crossings of all the edges with the scanlines of a band of rows are
+found at once with numpy, and sorted by path, scanline and abscissa: the
+running sum of the directions of the crossings of a path is its winding
+number, so the spans between crossings where it isn't zero are inside the
+path (the nonzero rule of Agg). The spans are painted in the order of the
+paths, so the last path is on top, as in the PathCollection. Each pixel is
+sampled SUPERSAMPLING x SUPERSAMPLING times, and the pixels on the borders
+of the polygons take the average of their samples, so they are anti-aliased.
+
+The raster doesn't match Agg pixel for pixel: the interiors of the polygons
+are the same, but Agg blends each path over those below it, so the border
+shared by two polygons lets some of the background through both of them,
+while here its pixel is the average of the two faces. A choropleth of the
+wards at 100 DPI differs in about 2% of its pixels, all on the borders, by
+up to about 100 levels (of 255) where the faces are far apart in colour; a
+finer supersampling doesn't make the difference smaller, since it is in how
+the paths are composited, not in the sampling.
+
+The image is split in bands of rows, rasterized by a pool of threads (numpy
+releases the GIL in its loops over big arrays, as the sorts and the gathers
+here), and only the samples of one band per thread are in memory at a time,
+besides the raster itself. (In a single CPU, this takes about as long as
+Agg takes to fill the polygons: the gain is in the CPUs which Agg doesn't
+use.)
+
+ScanlineFilledCollection is a PathCollection which draws its faces so, with
+the same face colours (those given by the colormap and the Normalize of the
+layer), at the resolution of the renderer and at the z-order of the
+collection, and leaves to matplotlib the drawing of its edges: the raster is
+composited under the text, the axes and the colour bar as the faces drawn by
+Agg would be. The faces are drawn as paths in the vector formats (PDF, SVG,
+...), where a raster would lose resolution, and when they are translucent
+(the raster has only the face on top of each pixel, not blended with those
+below it).
+"""
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.collections import PathCollection
+from matplotlib.transforms import Bbox
+
+from spatial_index_toronto import expand_ranges
+from stage_profiler_toronto import profile_stage
+
+
+# The number of samples per pixel along each axis, and the number of rows of
+# pixels in each band rasterized by a thread
+SUPERSAMPLING = 2
+RASTER_BAND_ROWS = 64
+
+
+def layer_edges(vertices, ring_offsets, ring_paths=None,
+                supersampling=SUPERSAMPLING):
+    """Return the edges of the rings in the vertex buffer 'vertices' (whose
+    ring 'i' is 'vertices[ring_offsets[i]:ring_offsets[i + 1]]'), in pixel
+    coordinates (see rasterize_rings()), which cross a scanline, with the
+    path of each ring in 'ring_paths' (None for a path per ring).
+
+    The scanline 'j' is at the ordinate '(j + 0.5) / supersampling' (the
+    centers of the samples), and an edge crosses the scanlines 'j' in
+    [first_scanline, stop_scanline), so an edge which ends at a scanline
+    crosses it only if the next edge of the ring goes on beyond it. Each
+    ring is closed, even if its last vertex isn't its first one.
+
+    :returns: a dictionary of arrays with one item per edge, sorted by its
+              first scanline: 'first_scanline', 'stop_scanline', 'x_start'
+              and 'y_start' (the first vertex of the edge, in samples),
+              'slope' (dx / dy, in samples), 'direction' (1 if the edge goes
+              to higher rows, -1 otherwise) and 'path'
+    """
+
+    ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+    sizes = np.diff(ring_offsets)
+    if ring_paths is None:
+        ring_paths = np.arange(len(sizes))
+    path_ids = np.repeat(ring_paths, sizes)
+    # the next vertex of each vertex in its ring (the first one for the last
+    # vertex of the ring)
+    next_idx = np.arange(1, len(vertices) + 1)
+    next_idx[ring_offsets[1:][sizes > 0] - 1] = ring_offsets[:-1][sizes > 0]
+
+    # (the samples are at integer coordinates)
+    samples = np.asarray(vertices, dtype=np.float64) * supersampling - 0.5
+    start, end = samples, samples[next_idx]
+    first_scanline = np.ceil(np.minimum(start[:, 1], end[:, 1]))
+    stop_scanline = np.ceil(np.maximum(start[:, 1], end[:, 1]))
+    crosses = stop_scanline > first_scanline
+
+    order = np.nonzero(crosses)[0]
+    order = order[np.argsort(first_scanline[order], kind='mergesort')]
+    start, end = start[order], end[order]
+    return dict(first_scanline=first_scanline[order].astype(np.int64),
+                stop_scanline=stop_scanline[order].astype(np.int64),
+                x_start=start[:, 0], y_start=start[:, 1],
+                slope=(end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1]),
+                direction=np.where(end[:, 1] > start[:, 1], 1, -1),
+                path=path_ids[order])
+
+
+def _color_table(path_colors):
+    """Return the uint32 array of the RGBA colours 'path_colors' (in [0, 1])
+    packed as uint8, followed by the transparent colour of the samples
+    outside all the paths.
+    """
+
+    colors = np.zeros((len(path_colors) + 1, 4), dtype=np.float64)
+    colors[:-1] = path_colors
+    return np.round(colors * 255.0).astype(np.uint8).view(np.uint32)[:, 0]
+
+
+def _band_spans(edges, first_scanline, stop_scanline, sample_width):
+    """Return the spans inside the paths with 'edges' (see layer_edges()) in
+    the scanlines [first_scanline, stop_scanline), as the tuple of arrays
+    (start, stop, path), where start and stop are indices of the samples of
+    these scanlines (row after row), sorted by their start.
+    """
+
+    # the crossings of the edges with the scanlines
+    candidates = np.searchsorted(edges['first_scanline'], stop_scanline)
+    candidates = np.nonzero(
+        edges['stop_scanline'][:candidates] > first_scanline)[0]
+    starts = np.maximum(edges['first_scanline'][candidates], first_scanline)
+    counts = np.minimum(edges['stop_scanline'][candidates],
+                        stop_scanline) - starts
+    scanlines, range_ids = expand_ranges(starts, counts)
+    edge_idx = candidates[range_ids]
+    crossings = edges['x_start'][edge_idx] + \
+        (scanlines - edges['y_start'][edge_idx]) * edges['slope'][edge_idx]
+    paths = edges['path'][edge_idx]
+
+    # the winding number after each crossing of a path in a scanline (the
+    # directions of the crossings of a closed ring in a scanline add up to
+    # zero, so the running sum starts at zero in each path and scanline):
+    # the span up to the next crossing is inside the path if it isn't zero
+    order = np.lexsort((crossings, scanlines, paths))
+    winding = np.cumsum(edges['direction'][edge_idx][order])
+    inside = np.nonzero(winding[:-1])[0]
+    crossings = np.clip(np.ceil(crossings[order]), 0,
+                        sample_width).astype(np.int64)
+    row_offsets = (scanlines[order][inside] - first_scanline) * sample_width
+    span_starts = row_offsets + crossings[inside]
+    span_stops = row_offsets + crossings[inside + 1]
+    span_paths = paths[order][inside]
+
+    non_empty = np.nonzero(span_stops > span_starts)[0]
+    # (a stable sort, so the spans which start at the same sample are still
+    # in the order of their paths)
+    non_empty = non_empty[np.argsort(span_starts[non_empty],
+                                     kind='mergesort')]
+    return span_starts[non_empty], span_stops[non_empty], \
+        span_paths[non_empty]
+
+
+def _band_sample_paths(spans, num_samples, background):
+    """Return the array with the path on top of each of the 'num_samples'
+    samples of a band, given its 'spans' (see _band_spans()), or
+    'background' for the samples outside all the paths.
+    """
+
+    starts, stops, paths = spans
+    if not len(starts):
+        return np.repeat(np.int32(background), num_samples)
+
+    # the band is the sequence of the spans, each one after the gap before
+    # it: a span which overlaps the next ones is cut at the start of the
+    # next one, so all the lengths are positive...
+    cut_stops = np.maximum(np.minimum(stops, np.append(starts[1:],
+                                                       num_samples)),
+                           starts)
+    run_paths = np.empty(2 * len(starts) + 1, dtype=np.int32)
+    run_paths[0::2] = background
+    run_paths[1::2] = paths
+    run_lengths = np.empty(2 * len(starts) + 1, dtype=np.int64)
+    run_lengths[0:-1:2] = starts - np.insert(cut_stops[:-1], 0, 0)
+    run_lengths[1::2] = cut_stops - starts
+    run_lengths[-1] = num_samples - cut_stops[-1]
+    sample_paths = np.repeat(run_paths, run_lengths)
+
+    # ... and the spans which overlap others (e.g., of overlapping polygons)
+    # are painted again in the order of their paths, so the last one is on
+    # top (the last value assigned to a repeated index is the one kept)
+    overlapped = starts[1:] < np.maximum.accumulate(stops)[:-1]
+    if overlapped.any():
+        overlapping = np.nonzero(np.append(overlapped, False) |
+                                 np.insert(overlapped, 0, False))[0]
+        overlapping = overlapping[np.argsort(paths[overlapping],
+                                             kind='mergesort')]
+        samples, span_idx = expand_ranges(
+            starts[overlapping], stops[overlapping] - starts[overlapping])
+        sample_paths[samples] = paths[overlapping][span_idx]
+    return sample_paths
+
+
+def _rasterize_band(edges, colors, first_row, stop_row, supersampling,
+                    band_pixels):
+    """Rasterize the rows [first_row, stop_row) of the paths with 'edges'
+    (see layer_edges()) and 'colors' (see _color_table()) into
+    'band_pixels', the uint32 array (stop_row - first_row, width) of their
+    packed RGBA pixels.
+    """
+
+    width = band_pixels.shape[1]
+    first_scanline = first_row * supersampling
+    stop_scanline = stop_row * supersampling
+    spans = _band_spans(edges, first_scanline, stop_scanline,
+                        width * supersampling)
+    sample_paths = _band_sample_paths(
+        spans, (stop_scanline - first_scanline) * width * supersampling,
+        len(colors) - 1)
+    if supersampling == 1:
+        np.take(colors, sample_paths, out=band_pixels.reshape(-1))
+        return
+
+    # the pixels whose samples are all in the same path take its colour,
+    # and the others (on the borders of the paths) the average of the
+    # colours of their samples, with premultiplied alpha
+    sample_paths = sample_paths.reshape(stop_row - first_row, supersampling,
+                                        width, supersampling)
+    pixel_samples = [sample_paths[:, row_sample, :, col_sample]
+                     for row_sample in range(supersampling)
+                     for col_sample in range(supersampling)]
+    np.take(colors, pixel_samples[0], out=band_pixels)
+    border = np.zeros(band_pixels.shape, dtype=bool)
+    for other_samples in pixel_samples[1:]:
+        border |= other_samples != pixel_samples[0]
+    border = np.nonzero(border)
+    samples = colors[np.column_stack([other_samples[border] for
+                                      other_samples in pixel_samples])]
+    samples = samples.view(np.uint8).reshape(-1, supersampling ** 2,
+                                             4).astype(np.float32)
+    samples[:, :, :3] *= samples[:, :, 3:] / 255.0
+    pixels = samples.mean(axis=1)
+    pixels[:, :3] *= 255.0 / np.maximum(pixels[:, 3:], 1e-3)
+    band_pixels[border] = np.round(pixels).astype(np.uint8).view(
+        np.uint32)[:, 0]
+
+
+def rasterize_rings(vertices, ring_offsets, path_colors, width, height,
+                    ring_paths=None, supersampling=SUPERSAMPLING,
+                    band_rows=RASTER_BAND_ROWS, threads=None):
+    """Fill the rings in the vertex buffer 'vertices' (whose ring 'i' is
+    'vertices[ring_offsets[i]:ring_offsets[i + 1]]') into a raster, as the
+    paths made of these rings would be filled by Agg (by the nonzero rule).
+
+    :param vertices: the array (num_vertices, 2) of the vertices, in pixel
+                     coordinates (the pixel in the column 'i' and the row
+                     'j' of the raster spans [i, i + 1) x [j, j + 1))
+    :param ring_offsets: the offsets of the rings in 'vertices'
+    :param path_colors: the array (num_paths, 4) of the RGBA colour of each
+                        path, in [0, 1] (a translucent path isn't blended
+                        with those below it)
+    :param width: the width of the raster
+    :param height: the height of the raster
+    :param ring_paths: the index of the path of each ring (e.g., all zeros
+                       for a single compound path), or None for a path per
+                       ring
+    :param supersampling: the number of samples per pixel along each axis
+    :param band_rows: the number of rows rasterized at a time by a thread
+    :param threads: the number of threads (None for as many as CPUs)
+    :returns: the RGBA uint8 array (height, width, 4), transparent outside
+              the paths
+    """
+
+    edges = layer_edges(vertices, ring_offsets, ring_paths, supersampling)
+    colors = _color_table(path_colors)
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    pixels = rgba.view(np.uint32)[:, :, 0]
+
+    def rasterize_band(first_row):
+        """Rasterize the band of rows from 'first_row' into 'rgba'."""
+
+        stop_row = min(first_row + band_rows, height)
+        _rasterize_band(edges, colors, first_row, stop_row, supersampling,
+                        pixels[first_row:stop_row])
+
+    first_rows = list(range(0, height, band_rows))
+    threads = min(threads or multiprocessing.cpu_count(), len(first_rows))
+    if threads <= 1:
+        for first_row in first_rows:
+            rasterize_band(first_row)
+    else:
+        pool = ThreadPool(processes=threads)
+        try:
+            pool.map(rasterize_band, first_rows)
+        finally:
+            pool.close()
+            pool.join()
+    return rgba
+
+
+class ScanlineFilledCollection(PathCollection):
+
+    """A PathCollection of the rings of a layer, whose faces are filled by
+    rasterize_rings() when it is drawn by Agg.
+
+    The edges of all the paths are drawn over all the faces, as those of a
+    compound path (Agg draws the edge of each path right after its face, so
+    the face of a path covers the edges of the paths below it).
+
+    Fields:
+
+       layer: the LayerGeometry of the rings (whose vertices are those of
+              the paths of the collection)
+
+       compound: whether the collection is a single compound path with all
+                 the rings, or a path per ring
+
+       threads: the number of threads which rasterize the faces (None for
+                as many as CPUs)
+    """
+
+    def __init__(self, paths, layer, compound=False, threads=None, **kwargs):
+
+        PathCollection.__init__(self, paths, **kwargs)
+        self.layer = layer
+        self.compound = compound
+        self.threads = threads
+
+    def draw(self, renderer):
+        """Draw the faces of the rings as a raster, and their edges as
+        paths (or both as paths, if 'renderer' isn't Agg's, or if a face is
+        translucent: only the face on top of each pixel is in the raster).
+        """
+
+        facecolors = self.get_facecolors()
+        if not self.get_visible() or not isinstance(renderer, RendererAgg) \
+                or not len(facecolors) or not len(self.layer) \
+                or (facecolors[:, 3] < 1.0).any():
+            PathCollection.draw(self, renderer)
+            return
+
+        with profile_stage('scanline_raster', rings=len(self.layer)):
+            self._draw_faces(renderer, facecolors)
+        # (the faces are not drawn again as paths, only the edges: the
+        # collection isn't left stale, since it is restored as it was)
+        self.set_facecolor('none')
+        try:
+            PathCollection.draw(self, renderer)
+        finally:
+            self.set_facecolor(facecolors)
+            self.stale = False
+
+    def _draw_faces(self, renderer, facecolors):
+        """Draw the faces of the paths, coloured by 'facecolors' (cycled
+        over the paths, as matplotlib does), as a raster of the pixels of
+        the axes.
+        """
+
+        clip_box = Bbox.intersection(self.axes.bbox, self.figure.bbox)
+        if clip_box is None:
+            return
+        x_min, y_min = np.floor(clip_box.min).astype(int)
+        x_max, y_max = np.ceil(clip_box.max).astype(int)
+        if x_max <= x_min or y_max <= y_min:
+            return
+
+        # (the rows of the raster from its bottom, as those of an image
+        # drawn by the renderer)
+        vertices = self.get_transform().transform(self.layer.vertices)
+        vertices -= (x_min, y_min)
+        if self.compound:
+            ring_paths = np.zeros(len(self.layer), dtype=np.int64)
+            path_colors = facecolors[:1]
+        else:
+            ring_paths = None
+            path_colors = np.resize(facecolors, (len(self.layer), 4))
+        rgba = rasterize_rings(vertices, self.layer.ring_offsets,
+                               path_colors, x_max - x_min, y_max - y_min,
+                               ring_paths, threads=self.threads)
+
+        graphics_context = renderer.new_gc()
+        self._set_gc_clip(graphics_context)
+        renderer.draw_image(graphics_context, x_min, y_min, rgba)
+        graphics_context.restore()
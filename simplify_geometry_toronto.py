@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""Level-of-detail simplification of the geometry of the shapefiles of the
+City of Toronto, for the resolution (DPI) of the image where they are going
+to be drawn: a vertex which falls into the same output pixel as its
+neighbors adds nothing to the image, but matplotlib still has to process it.
+
+The simplification works on the whole vertex buffer of a LayerGeometry at
+once (there is no loop per shape or per vertex), in two stages:
+
+ . the vertices are snapped to a grid whose cell is the size of an output
+   pixel (the 'tolerance'), and the consecutive vertices of a ring which
+   fall into the same cell are merged;
+
+ . then, as in the Visvalingam-Whyatt algorithm, the vertices whose triangle
+   with their two neighbors has an area smaller than half a pixel are
+   removed, in rounds, until no vertex can be removed.
+
+The simplification preserves the topology between neighboring polygons, like
+two wards sharing a border: a shared vertex snaps to the same grid point in
+all the rings where it appears, and the decision to remove it depends only
+on the vertex and on its (unordered) pair of neighbors, which are the same
+in all the rings along a shared border. The vertices where the rings
+sharing them have different neighbors (the junctions where borders meet),
+and the first and last vertex of each ring, are never removed. In each round
+only the local minima of the area are removed, so two neighbors are never
+removed at once.
+
+Each simplified level of a layer read from the geometry cache is itself
+saved in the geometry cache.
+"""
+
+import os
+
+import numpy as np
+
+from cache_dir_toronto import cache_subdir, cache_key
+from geometry_cache_toronto import LayerGeometry, GEOMETRY_CACHE_SUBDIR, \
+    GEOMETRY_FILE_EXTENSION
+
+
+# Increase this version whenever the simplification changes its results
+SIMPLIFY_VERSION = 1
+
+# A ring with fewer vertices than this (including the vertex closing it)
+# can't be simplified further
+_MIN_RING_VERTICES = 4
+
+# The simplified layers already computed in this process, indexed by their
+# cache key
+_SIMPLIFIED_LAYERS = dict()
+
+
+def pixel_tolerance(to_map, dpi, width_inches):
+    """Return the size, in the projected units of the Basemap 'to_map', of an
+    output pixel of an image 'width_inches' wide at 'dpi' dots per inch,
+    where the whole map of Toronto were drawn.
+
+    The map is never wider than its figure, so this is the finest detail
+    that can be seen when drawing it inside that figure.
+    """
+
+    return (to_map.urcrnrx - to_map.llcrnrx) / float(width_inches * dpi)
+
+
+def _ring_ids(ring_offsets):
+    """Return the index of the ring of each vertex."""
+
+    return np.repeat(np.arange(len(ring_offsets) - 1),
+                     np.diff(ring_offsets))
+
+
+def _ring_offsets(ring_ids, num_rings):
+    """Return the ring offsets for vertices with these 'ring_ids'."""
+
+    ring_offsets = np.zeros(num_rings + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ring_ids, minlength=num_rings),
+              out=ring_offsets[1:])
+    return ring_offsets
+
+
+def _snap_to_grid(layer, tolerance):
+    """Snap the vertices of 'layer' to the grid of cell 'tolerance', and
+    merge the consecutive vertices of a ring in the same cell.
+
+    :returns: the tuple (grid, ring_ids) with the integer grid coordinates
+              of the vertices left, and the index of the ring of each one
+    """
+
+    grid = np.round(layer.vertices / tolerance).astype(np.int64)
+    ring_ids = _ring_ids(layer.ring_offsets)
+
+    same_as_prev = np.zeros(len(grid), dtype=bool)
+    same_as_prev[1:] = np.all(grid[1:] == grid[:-1], axis=1) & \
+        (ring_ids[1:] == ring_ids[:-1])
+
+    return grid[~same_as_prev], ring_ids[~same_as_prev]
+
+
+def pinned_vertices(vertex_ids, ring_ids, num_vertex_ids):
+    """Return a boolean mask of which vertex ids can't be removed: those at
+    the ends of a ring, and those whose occurrences in the rings don't all
+    have the same (unordered) pair of neighbors (the junctions where the
+    shared borders of the rings begin and end).
+    """
+
+    is_ring_start = np.ones(len(ring_ids), dtype=bool)
+    is_ring_start[1:] = ring_ids[1:] != ring_ids[:-1]
+    is_ring_end = np.ones(len(ring_ids), dtype=bool)
+    is_ring_end[:-1] = ring_ids[:-1] != ring_ids[1:]
+
+    pinned = np.zeros(num_vertex_ids, dtype=bool)
+    pinned[vertex_ids[is_ring_start | is_ring_end]] = True
+
+    interior = np.flatnonzero(~(is_ring_start | is_ring_end))
+    prev_ids = vertex_ids[interior - 1]
+    next_ids = vertex_ids[interior + 1]
+    neighbor_pairs = np.minimum(prev_ids, next_ids) * num_vertex_ids + \
+        np.maximum(prev_ids, next_ids)
+
+    distinct = np.unique(np.column_stack((vertex_ids[interior],
+                                          neighbor_pairs)), axis=0)
+    num_distinct_pairs = np.bincount(distinct[:, 0],
+                                     minlength=num_vertex_ids)
+    pinned |= num_distinct_pairs > 1
+    return pinned
+
+
+def _lexicographic_less(area_a, tie_a, area_b, tie_b):
+    """Return the element-wise (area_a, tie_a) < (area_b, tie_b)."""
+
+    return (area_a < area_b) | ((area_a == area_b) & (tie_a < tie_b))
+
+
+def _tie_breakers(vertex_ids):
+    """Return a pseudo-random, but deterministic, key for each vertex id to
+    break the ties between vertices with the same area (breaking them by the
+    vertex id itself, which grows along a straight border, would remove only
+    one vertex of that border per round).
+    """
+
+    return (vertex_ids.astype(np.uint64) * np.uint64(2654435761)) % \
+        np.uint64(1 << 32)
+
+
+def _visvalingam_round(grid, ring_ids, num_rings):
+    """Do a round of removal of vertices with a small effective area.
+
+    :returns: the boolean mask of the vertices in 'grid' to keep
+    """
+
+    unique_vertices, vertex_ids = np.unique(grid, axis=0, return_inverse=True)
+    vertex_ids = vertex_ids.reshape(-1)
+    pinned = pinned_vertices(vertex_ids, ring_ids, len(unique_vertices))
+
+    # the doubled area of the triangle of each vertex with its neighbors, in
+    # grid cells (the grid cell is a pixel); the pinned vertices have an
+    # infinite area
+    area = np.empty(len(grid))
+    area.fill(np.inf)
+    removable = np.flatnonzero(~pinned[vertex_ids])
+    to_prev = (grid[removable - 1] - grid[removable]).astype(np.float64)
+    to_next = (grid[removable + 1] - grid[removable]).astype(np.float64)
+    area[removable] = np.abs(to_prev[:, 0] * to_next[:, 1] -
+                             to_prev[:, 1] * to_next[:, 0])
+
+    # remove the vertices whose triangle is smaller than half a pixel, which
+    # are a local minimum of the area along their ring (ties between equal
+    # areas are broken by a key of the vertex, the same in all the rings)
+    ties = _tie_breakers(vertex_ids)
+    to_remove = np.zeros(len(grid), dtype=bool)
+    to_remove[removable] = \
+        (area[removable] < 1.0) & \
+        _lexicographic_less(area[removable], ties[removable],
+                            area[removable - 1], ties[removable - 1]) & \
+        _lexicographic_less(area[removable], ties[removable],
+                            area[removable + 1], ties[removable + 1])
+
+    # but never leave a ring with less than a triangle; the vertices which
+    # such a ring keeps are kept by all the rings which share them, so the
+    # shared borders stay the same (keeping them can't leave a ring smaller)
+    num_left = np.bincount(ring_ids[~to_remove], minlength=num_rings)
+    too_small = num_left < _MIN_RING_VERTICES
+    kept_ids = np.zeros(len(unique_vertices), dtype=bool)
+    kept_ids[vertex_ids[to_remove & too_small[ring_ids]]] = True
+    to_remove &= ~kept_ids[vertex_ids]
+
+    return ~to_remove
+
+
+def simplify_layer(layer, tolerance, max_rounds=64):
+    """Return a simplified copy of the LayerGeometry 'layer' where no detail
+    smaller than 'tolerance' (in projected units) is kept. The attributes of
+    the rings are the same, and in the same order, as in 'layer'.
+    """
+
+    num_rings = len(layer)
+    grid, ring_ids = _snap_to_grid(layer, tolerance)
+
+    for dummy in range(max_rounds):
+        if len(grid) == 0:
+            break
+        to_keep = _visvalingam_round(grid, ring_ids, num_rings)
+        if np.all(to_keep):
+            break
+        grid = grid[to_keep]
+        ring_ids = ring_ids[to_keep]
+
+    return LayerGeometry(grid * tolerance,
+                         _ring_offsets(ring_ids, num_rings),
+                         layer.attributes)
+
+
+def simplify_layer_cached(layer, tolerance):
+    """Return the simplified 'layer' for 'tolerance', as simplify_layer()
+    does, but reusing the simplified level from the geometry cache if it has
+    already been computed (only for layers loaded through the geometry cache,
+    which know their cache key).
+    """
+
+    if tolerance is None or tolerance <= 0:
+        return layer
+    source_key = getattr(layer, 'source_key', None)
+    if source_key is None:
+        return simplify_layer(layer, tolerance)
+
+    key = cache_key([], (source_key, SIMPLIFY_VERSION, '%.9g' % tolerance))
+    simplified = _SIMPLIFIED_LAYERS.get(key)
+    if simplified is not None:
+        return simplified
+
+    cache_fname = os.path.join(cache_subdir(GEOMETRY_CACHE_SUBDIR),
+                               key + GEOMETRY_FILE_EXTENSION)
+    if os.path.exists(cache_fname):
+        simplified = LayerGeometry.load(cache_fname)
+
+    if simplified is None:
+        simplified = simplify_layer(layer, tolerance)
+        simplified.save(cache_fname)
+
+    simplified.source_key = key
+    _SIMPLIFIED_LAYERS[key] = simplified
+    return simplified
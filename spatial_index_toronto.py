@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+
+"""A spatial index of the rings of the layers of Toronto (wards, CVA
+sub-wards, Priority Investment Neighborhoods, Business Improvement Areas),
+and a vectorized spatial join between two layers which gives the area of the
+overlap of each pair of their rings, so that a layer can be related to
+another (e.g., the share of each CVA sub-ward inside a Priority Investment
+Neighborhood, or the Business Improvement Areas per ward) without looping in
+Python over each pair of polygons.
+
+The index is a Sort-Tile-Recursive (STR) packed R-tree over the bounding
+boxes of the rings: its levels are numpy arrays, and a whole batch of query
+boxes descends the tree at once, one level at a time. The same index finds
+the rings under a point (e.g., under the cursor, see
+interactive_picking_toronto), testing it against the edges of the few rings
+whose boxes contain it.
+
+The area of the overlap of two rings is computed exactly from their edges:
+a ring is the signed sum of the trapezoids below each of its edges (from
+the edge down to a baseline), so the area of the overlap of two rings is
+the signed sum, over the pairs of edges whose x-ranges overlap, of the area
+below the lowest of the two edges. This has a closed form for each pair of
+edges, and it is also exact when the rings share borders (as the CVA
+sub-wards and the wards do). As when they are drawn, each ring is taken as
+a filled polygon, whatever its orientation.
+"""
+
+import numpy as np
+
+
+# The maximum number of children of a node of the STR tree
+STR_NODE_CAPACITY = 16
+
+# The STR trees of the layers already indexed in this process, indexed by the
+# cache key of their geometry
+_LAYER_INDEXES = dict()
+
+
+def ring_bounds(layer):
+    """Return a float64 array (num_rings, 4) with the bounding box
+    (xmin, ymin, xmax, ymax) of each ring of the LayerGeometry 'layer'
+    (an empty ring has an empty box: xmin > xmax).
+    """
+
+    bounds = np.empty((len(layer), 4))
+    bounds[:, :2] = np.inf
+    bounds[:, 2:] = -np.inf
+
+    non_empty = np.flatnonzero(np.diff(layer.ring_offsets) > 0)
+    if len(non_empty):
+        starts = layer.ring_offsets[non_empty]
+        bounds[non_empty, :2] = np.minimum.reduceat(layer.vertices,
+                                                    starts, axis=0)
+        bounds[non_empty, 2:] = np.maximum.reduceat(layer.vertices,
+                                                    starts, axis=0)
+    return bounds
+
+
+def ring_areas(layer, signed=False):
+    """Return the area of each ring of the LayerGeometry 'layer', by the
+    shoelace formula over its whole vertex buffer at once (the area is
+    positive for counter-clockwise rings if 'signed').
+    """
+
+    edges = _ring_edges(layer)
+    cross = edges['x0'] * edges['y1'] - edges['x1'] * edges['y0']
+    areas = 0.5 * np.bincount(edges['ring'], weights=cross,
+                              minlength=len(layer))
+    if signed:
+        return areas
+    return np.abs(areas)
+
+
+def _ring_edges(layer):
+    """Return the edges of all the rings of 'layer', as a dictionary of
+    arrays: 'ring' (the index of the ring of each edge), and 'x0', 'y0',
+    'x1', 'y1' (its two end points). A ring which is not explicitly closed
+    is closed with an edge from its last vertex to its first one.
+    """
+
+    vertices = layer.vertices
+    ring_ids = np.repeat(np.arange(len(layer)), np.diff(layer.ring_offsets))
+
+    # each vertex is the start of an edge which ends in the next vertex of
+    # its ring (and the last vertex of a ring, in the first one)
+    non_empty = np.diff(layer.ring_offsets) > 0
+    next_idx = np.arange(1, len(vertices) + 1)
+    next_idx[layer.ring_offsets[1:][non_empty] - 1] = \
+        layer.ring_offsets[:-1][non_empty]
+
+    return dict(ring=ring_ids,
+                x0=vertices[:, 0], y0=vertices[:, 1],
+                x1=vertices[next_idx, 0], y1=vertices[next_idx, 1])
+
+
+def expand_ranges(starts, counts):
+    """Return the concatenation of the ranges [starts[i], starts[i] +
+    counts[i]), and the index 'i' of the range of each element.
+    """
+
+    counts = np.asarray(counts, dtype=np.int64)
+    range_ids = np.repeat(np.arange(len(counts)), counts)
+    range_offsets = np.cumsum(counts) - counts
+    positions = np.arange(counts.sum()) - range_offsets[range_ids]
+    return np.asarray(starts, dtype=np.int64)[range_ids] + positions, \
+        range_ids
+
+
+def _boxes_intersect(boxes_a, boxes_b):
+    """Return the element-wise test of intersection of two arrays of boxes
+    (xmin, ymin, xmax, ymax); touching boxes intersect.
+    """
+
+    return (boxes_a[:, 0] <= boxes_b[:, 2]) & \
+        (boxes_b[:, 0] <= boxes_a[:, 2]) & \
+        (boxes_a[:, 1] <= boxes_b[:, 3]) & \
+        (boxes_b[:, 1] <= boxes_a[:, 3])
+
+
+class STRtree(object):
+
+    """A Sort-Tile-Recursive packed R-tree over a set of bounding boxes.
+
+    Fields:
+
+       _levels: the list of the levels of the tree, from the root down to
+                the level above the leaves: each level is the tuple
+                (node_bounds, child_offsets), so that the children of node
+                'n' are the nodes (or the leaf entries)
+                child_offsets[n]:child_offsets[n + 1] of the level below
+
+       _leaf_bounds: the bounding boxes of the leaf entries
+
+       _leaf_items: the index of the item (in the bounds given to the
+                    constructor) of each leaf entry
+    """
+
+    def __init__(self, bounds, node_capacity=STR_NODE_CAPACITY):
+
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        non_empty = np.flatnonzero((bounds[:, 0] <= bounds[:, 2]) &
+                                   (bounds[:, 1] <= bounds[:, 3]))
+
+        order = self._str_order(bounds[non_empty], node_capacity)
+        self._leaf_items = non_empty[order]
+        self._leaf_bounds = bounds[self._leaf_items]
+
+        self._levels = []
+        level_bounds = self._leaf_bounds
+        while len(level_bounds) > node_capacity or not self._levels:
+            # pack the entries of this level, in their STR order, into nodes
+            # of 'node_capacity' children
+            num_nodes = -(-len(level_bounds) // node_capacity)
+            child_offsets = np.minimum(
+                np.arange(num_nodes + 1) * node_capacity, len(level_bounds))
+            node_bounds = self._reduce_bounds(level_bounds, child_offsets)
+            self._levels.insert(0, (node_bounds, child_offsets))
+
+            if num_nodes <= 1:
+                break
+            # the nodes of this level are reordered by STR for the next one
+            order = self._str_order(node_bounds, node_capacity)
+            node_bounds = node_bounds[order]
+            self._reorder_level(order)
+            level_bounds = node_bounds
+
+    @staticmethod
+    def _str_order(bounds, node_capacity):
+        """Return the Sort-Tile-Recursive order of the boxes 'bounds': they
+        are sorted by the x of their centers into vertical slices, and each
+        slice by the y of their centers.
+        """
+
+        num_boxes = len(bounds)
+        if num_boxes == 0:
+            return np.zeros(0, dtype=np.int64)
+        num_leaves = -(-num_boxes // node_capacity)
+        num_slices = int(np.ceil(np.sqrt(num_leaves)))
+        slice_size = num_slices * node_capacity
+
+        center_x = bounds[:, 0] + bounds[:, 2]
+        center_y = bounds[:, 1] + bounds[:, 3]
+        by_x = np.argsort(center_x, kind='mergesort')
+        slice_ids = np.empty(num_boxes, dtype=np.int64)
+        slice_ids[by_x] = np.arange(num_boxes) // slice_size
+        return np.lexsort((center_y, slice_ids))
+
+    @staticmethod
+    def _reduce_bounds(bounds, offsets):
+        """Return the bounding box of each group bounds[offsets[i]:
+        offsets[i + 1]] (all the groups are non-empty).
+        """
+
+        if len(offsets) < 2:
+            return np.zeros((0, 4))
+        starts = offsets[:-1]
+        return np.column_stack(
+            (np.minimum.reduceat(bounds[:, :2], starts, axis=0),
+             np.maximum.reduceat(bounds[:, 2:], starts, axis=0)))
+
+    def _reorder_level(self, order):
+        """Reorder the nodes of the top level of the tree to the new 'order'
+        (and so, recursively, the groups of their children).
+        """
+
+        self._reorder_entries(order, level_idx=0)
+
+    def _reorder_entries(self, order, level_idx):
+        """Reorder the entries of the level 'level_idx' (or the leaf entries
+        if it is below the last level) to 'order', recursively.
+        """
+
+        if level_idx >= len(self._levels):
+            self._leaf_bounds = self._leaf_bounds[order]
+            self._leaf_items = self._leaf_items[order]
+            return
+
+        node_bounds, child_offsets = self._levels[level_idx]
+        counts = np.diff(child_offsets)[order]
+        children, dummy = expand_ranges(child_offsets[:-1][order], counts)
+        new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(counts, out=new_offsets[1:])
+        self._levels[level_idx] = (node_bounds[order], new_offsets)
+        self._reorder_entries(children, level_idx + 1)
+
+    def query_pairs(self, query_bounds):
+        """Return the pairs (query_idx, item_idx) of the query boxes in
+        'query_bounds' (an array (num_queries, 4)) and the items of the tree
+        whose boxes intersect.
+
+        :returns: the tuple of arrays (query_idx, item_idx)
+        """
+
+        query_bounds = np.asarray(query_bounds,
+                                  dtype=np.float64).reshape(-1, 4)
+
+        # all the queries start at all the nodes of the root level
+        root_bounds, dummy = self._levels[0]
+        query_idx = np.repeat(np.arange(len(query_bounds)), len(root_bounds))
+        node_idx = np.tile(np.arange(len(root_bounds)), len(query_bounds))
+
+        for level_idx, (node_bounds, child_offsets) in \
+                enumerate(self._levels):
+            hit = _boxes_intersect(query_bounds[query_idx],
+                                   node_bounds[node_idx])
+            query_idx = query_idx[hit]
+            node_idx = node_idx[hit]
+
+            # descend to the children of the nodes hit
+            node_idx, range_ids = expand_ranges(
+                child_offsets[:-1][node_idx], np.diff(child_offsets)[node_idx])
+            query_idx = query_idx[range_ids]
+
+        hit = _boxes_intersect(query_bounds[query_idx],
+                               self._leaf_bounds[node_idx])
+        return query_idx[hit], self._leaf_items[node_idx[hit]]
+
+
+def layer_index(layer):
+    """Return the STRtree of the bounding boxes of the rings of 'layer' (it
+    is built once per process for a layer loaded through the geometry cache,
+    which knows its cache key).
+    """
+
+    source_key = getattr(layer, 'source_key', None)
+    index = _LAYER_INDEXES.get(source_key)
+    if index is None:
+        index = STRtree(ring_bounds(layer))
+        if source_key is not None:
+            _LAYER_INDEXES[source_key] = index
+    return index
+
+
+def points_in_rings(layer, points, index=None):
+    """Return the pairs (point, ring) of the 'points' (an array
+    (num_points, 2)) and the rings of the LayerGeometry 'layer' which
+    contain them (taking each ring as a filled polygon).
+
+    The candidate rings of each point are those whose bounding box contains
+    it, from the STRtree 'index' of the layer (built if it is None), and the
+    point is tested against all their edges at once by the even-odd rule
+    (only the edges of the candidate rings are gathered, not those of the
+    whole layer).
+
+    :returns: the tuple of arrays (point_idx, ring_idx), sorted by point
+              and then by ring
+    """
+
+    if index is None:
+        index = layer_index(layer)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    point_idx, ring_idx = index.query_pairs(np.hstack((points, points)))
+    if len(point_idx) == 0:
+        return point_idx, ring_idx
+
+    # the edges of each candidate pair, from each vertex of the ring to the
+    # next one (and from the last vertex to the first one)
+    ring_starts = layer.ring_offsets[ring_idx]
+    ring_sizes = layer.ring_offsets[ring_idx + 1] - ring_starts
+    start_idx, pair_idx = expand_ranges(ring_starts, ring_sizes)
+    end_idx = start_idx + 1
+    ring_ends = (ring_starts + ring_sizes)[pair_idx]
+    wraps = end_idx == ring_ends
+    end_idx[wraps] = ring_starts[pair_idx[wraps]]
+
+    x_pos = points[point_idx[pair_idx], 0]
+    y_pos = points[point_idx[pair_idx], 1]
+    x0, y0 = layer.vertices[start_idx, 0], layer.vertices[start_idx, 1]
+    x1, y1 = layer.vertices[end_idx, 0], layer.vertices[end_idx, 1]
+
+    # the edges which the horizontal ray from the point to the right crosses
+    straddles = (y0 > y_pos) != (y1 > y_pos)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (y_pos - y0) * (x1 - x0) / (y1 - y0)
+        crosses = straddles & (x_pos < x_cross)
+    crossings = np.bincount(pair_idx, weights=crosses,
+                            minlength=len(point_idx))
+    inside = crossings.astype(np.int64) % 2 == 1
+
+    point_idx, ring_idx = point_idx[inside], ring_idx[inside]
+    order = np.lexsort((ring_idx, point_idx))
+    return point_idx[order], ring_idx[order]
+
+
+def _x_overlapping_edge_pairs(edges_a, edges_b, ring_pairs_a, ring_pairs_b):
+    """Return the pairs of edges (edge_a, edge_b), of the rings in each pair
+    of rings (ring_pairs_a[k], ring_pairs_b[k]), whose x-ranges overlap,
+    together with the index 'k' of their pair of rings.
+
+    An x-range [xmin_a, xmax_a) and [xmin_b, xmax_b) overlap if xmin_a <=
+    xmin_b < xmax_a, or if xmin_b < xmin_a < xmax_b: in both cases, the
+    edges of the second ring (sorted by xmin inside their ring) satisfying
+    it are contiguous, so they are found by binary search.
+    """
+
+    def starts_in(edges_p, pairs_p, edges_q, pairs_q, strict):
+        """The pairs (p, q) where xmin_p <= xmin_q < xmax_p (or with '<'
+        instead of '<=' if 'strict')."""
+
+        # the edges of q, sorted by their key (pair of rings, xmin), where
+        # the pair of rings 'k' contains the ring of each edge of q
+        q_edge_idx, q_pair_idx = _edges_of_ring_pairs(edges_q, pairs_q)
+        q_key = q_pair_idx + edges_q['xmin_unit'][q_edge_idx]
+        order = np.argsort(q_key, kind='mergesort')
+        q_edge_idx = q_edge_idx[order]
+        q_key = q_key[order]
+
+        p_edge_idx, p_pair_idx = _edges_of_ring_pairs(edges_p, pairs_p)
+        low = np.searchsorted(q_key, p_pair_idx +
+                              edges_p['xmin_unit'][p_edge_idx],
+                              side='right' if strict else 'left')
+        high = np.searchsorted(q_key, p_pair_idx +
+                               edges_p['xmax_unit'][p_edge_idx],
+                               side='left')
+        q_pos, range_ids = expand_ranges(low, np.maximum(high - low, 0))
+        return p_edge_idx[range_ids], q_edge_idx[q_pos], \
+            p_pair_idx[range_ids]
+
+    a_of_1, b_of_1, pair_of_1 = starts_in(edges_a, ring_pairs_a,
+                                          edges_b, ring_pairs_b, False)
+    b_of_2, a_of_2, pair_of_2 = starts_in(edges_b, ring_pairs_b,
+                                          edges_a, ring_pairs_a, True)
+    return np.concatenate((a_of_1, a_of_2)), \
+        np.concatenate((b_of_1, b_of_2)), \
+        np.concatenate((pair_of_1, pair_of_2))
+
+
+def _edges_of_ring_pairs(edges, ring_pairs):
+    """Return the edges of the ring ring_pairs[k] of each pair of rings 'k',
+    as the tuple of arrays (edge_idx, pair_idx).
+    """
+
+    return expand_ranges(edges['ring_offsets'][:-1][ring_pairs],
+                          np.diff(edges['ring_offsets'])[ring_pairs])[0], \
+        np.repeat(np.arange(len(ring_pairs)),
+                  np.diff(edges['ring_offsets'])[ring_pairs])
+
+
+def _sloped_edges(layer, x_origin, x_span):
+    """Return the edges of 'layer' which aren't vertical (a vertical edge
+    has no area below it), with the sign of the trapezoid below each one,
+    and grouped by their ring.
+    """
+
+    edges = _ring_edges(layer)
+    orientation = np.sign(ring_areas(layer, signed=True))
+
+    sloped = edges['x0'] != edges['x1']
+    edges = dict((name, values[sloped]) for name, values in edges.items())
+
+    # the edges of the upper side of a counter-clockwise ring go from right
+    # to left: the area below them is added, and the area below the edges
+    # of the lower side is subtracted
+    edges['sign'] = np.where(edges['x1'] < edges['x0'], 1.0, -1.0) * \
+        orientation[edges['ring']]
+    edges['xmin'] = np.minimum(edges['x0'], edges['x1'])
+    edges['xmax'] = np.maximum(edges['x0'], edges['x1'])
+    # the x of the edges scaled into [0, 1), to build the search keys
+    edges['xmin_unit'] = (edges['xmin'] - x_origin) / x_span
+    edges['xmax_unit'] = (edges['xmax'] - x_origin) / x_span
+
+    # the edges are already grouped by ring, in the order of the rings
+    edges['ring_offsets'] = np.zeros(len(layer) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges['ring'], minlength=len(layer)),
+              out=edges['ring_offsets'][1:])
+    return edges
+
+
+def _line_y(edges, edge_idx, x_pos):
+    """Return the y of the lines of the edges 'edge_idx' at 'x_pos'."""
+
+    x0 = edges['x0'][edge_idx]
+    y0 = edges['y0'][edge_idx]
+    slope = (edges['y1'][edge_idx] - y0) / (edges['x1'][edge_idx] - x0)
+    return y0 + slope * (x_pos - x0)
+
+
+def overlay_areas(layer_a, layer_b, index_b=None):
+    """Return the area of the overlap of each pair of rings of the
+    LayerGeometry 'layer_a' and 'layer_b' which overlap.
+
+    :param layer_a: the first layer
+    :param layer_b: the second layer (both in the same projection)
+    :param index_b: the STRtree of 'layer_b', if it was already built
+    :returns: the tuple of arrays (ring_a, ring_b, area) of the pairs of
+              rings with an overlap of positive area
+    """
+
+    if index_b is None:
+        index_b = layer_index(layer_b)
+
+    # the candidate pairs of rings are those whose bounding boxes intersect
+    ring_a, ring_b = index_b.query_pairs(ring_bounds(layer_a))
+    empty = np.zeros(0, dtype=np.int64)
+    if len(ring_a) == 0:
+        return empty, empty, np.zeros(0)
+
+    all_x = np.concatenate((layer_a.vertices[:, 0], layer_b.vertices[:, 0]))
+    x_origin = all_x.min()
+    x_span = (all_x.max() - x_origin) * (1.0 + 1e-9) or 1.0
+
+    edges_a = _sloped_edges(layer_a, x_origin, x_span)
+    edges_b = _sloped_edges(layer_b, x_origin, x_span)
+
+    edge_a, edge_b, pair_idx = _x_overlapping_edge_pairs(edges_a, edges_b,
+                                                         ring_a, ring_b)
+
+    # the area below the lowest of the two edges, on their common x-range
+    # [left, right] (the y are relative to the bottom of the pair of rings
+    # to keep the precision)
+    left = np.maximum(edges_a['xmin'][edge_a], edges_b['xmin'][edge_b])
+    right = np.minimum(edges_a['xmax'][edge_a], edges_b['xmax'][edge_b])
+    width = np.maximum(right - left, 0.0)
+
+    bounds_a = ring_bounds(layer_a)
+    bounds_b = ring_bounds(layer_b)
+    baseline = np.minimum(bounds_a[ring_a, 1], bounds_b[ring_b, 1])[pair_idx]
+
+    y_a_left = _line_y(edges_a, edge_a, left) - baseline
+    y_a_right = _line_y(edges_a, edge_a, right) - baseline
+    y_b_left = _line_y(edges_b, edge_b, left) - baseline
+    y_b_right = _line_y(edges_b, edge_b, right) - baseline
+
+    # min(y_a, y_b) = (y_a + y_b) / 2 - |y_a - y_b| / 2, and the difference
+    # y_a - y_b is linear along [left, right]
+    diff_left = y_a_left - y_b_left
+    diff_right = y_a_right - y_b_right
+    mean_integral = width * (y_a_left + y_a_right +
+                             y_b_left + y_b_right) / 4.0
+    abs_diff_sum = np.abs(diff_left) + np.abs(diff_right)
+    same_sign = diff_left * diff_right >= 0.0
+    abs_diff_integral = np.where(
+        same_sign,
+        width * np.abs(diff_left + diff_right) / 2.0,
+        width * (diff_left ** 2 + diff_right ** 2) /
+        (2.0 * np.where(abs_diff_sum > 0.0, abs_diff_sum, 1.0)))
+    below_lowest = mean_integral - abs_diff_integral / 2.0
+
+    signs = edges_a['sign'][edge_a] * edges_b['sign'][edge_b]
+    areas = np.bincount(pair_idx, weights=signs * below_lowest,
+                        minlength=len(ring_a))
+
+    # rounding errors can leave tiny areas for rings which only touch
+    scale = np.minimum(ring_areas(layer_a)[ring_a],
+                       ring_areas(layer_b)[ring_b])
+    overlapping = areas > 1e-9 * scale
+    return ring_a[overlapping], ring_b[overlapping], areas[overlapping]
+
+
+def overlap_shares(layer_a, layer_b, index_b=None):
+    """Return the share (from 0 to 1) of the area of each ring of 'layer_a'
+    which is inside the rings of 'layer_b' (e.g., the share of each CVA
+    sub-ward inside a Priority Investment Neighborhood), assuming that the
+    rings of 'layer_b' don't overlap among themselves.
+    """
+
+    ring_a, dummy, areas = overlay_areas(layer_a, layer_b, index_b)
+    covered = np.bincount(ring_a, weights=areas, minlength=len(layer_a))
+    total = ring_areas(layer_a)
+    return np.clip(covered / np.where(total > 0.0, total, 1.0), 0.0, 1.0)
+
+
+def count_overlapping(layer_a, layer_b, index_b=None):
+    """Return the number of rings of 'layer_b' which overlap each ring of
+    'layer_a' (e.g., the number of Business Improvement Areas per ward).
+    """
+
+    ring_a, dummy, dummy = overlay_areas(layer_a, layer_b, index_b)
+    return np.bincount(ring_a, minlength=len(layer_a))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""Optional profiling of the stages of the visualizations of Toronto (the
+read of the Shapefiles, the conversion of their polygons into paths, the
+add_collection() of their layers, the construction of the colour bars, the
+ETL of the budget spreadsheet and the savefig() of the figures), so that
+when a render slows down the stage which regressed can be told.
+
+The stages are marked in the code with the context manager profile_stage()
+or the decorator profiled_stage(), which do nothing unless the profiling
+was enabled with enable_profiling() (the option '--profile' of the
+programs). When it is enabled, each run of a stage records its wall time,
+the peak RSS of the process and the number of objects tracked by the
+garbage collector at its end, and how much these grew during the stage.
+
+The stages are saved as a JSON file in the Trace Event Format, which can be
+opened by chrome://tracing or Perfetto, with the summary per stage in the
+field 'stageSummary'. The stages run by the worker processes (forked by
+the parallel renders) are appended by each worker to a side file, which is
+merged into the trace when it is saved.
+"""
+
+import contextlib
+import functools
+import gc
+import json
+import os
+import sys
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None     # (not in Windows: the peak RSS isn't recorded)
+
+from cache_dir_toronto import atomic_write
+
+
+# The profiler of this process, or None if the profiling isn't enabled
+_PROFILER = None
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None
+    if it is unknown in this platform.
+    """
+
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (in bytes in Mac OS/X, and in kilobytes in Linux)
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class StageProfiler(object):
+
+    """The profile of the stages run in this process (and its workers).
+
+    Fields:
+
+       trace_fname: the JSON file where to save the trace of the stages
+
+       pid: the process which enabled the profiling (the stages of the
+            other processes are appended to the file 'trace_fname' +
+            '.workers')
+
+       count_objects: whether to record the number of objects tracked by
+                      the garbage collector (it has to walk all of them)
+
+       events: the trace events of the stages run in this process
+
+       _start_time: the timer when the profiling was enabled, the origin of
+                    the timestamps of the trace events
+    """
+
+    def __init__(self, trace_fname, count_objects=True):
+
+        self.trace_fname = trace_fname
+        self.pid = os.getpid()
+        self.count_objects = count_objects
+        self.events = []
+        self._start_time = timeit.default_timer()
+
+    def _sample(self):
+        """Return the current timer, peak RSS and number of objects."""
+
+        num_objects = len(gc.get_objects()) if self.count_objects else None
+        return timeit.default_timer(), peak_rss_bytes(), num_objects
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        """Record a run of the stage 'name' (with the arguments 'args' in
+        its trace event) around the body of the 'with' statement.
+        """
+
+        start_time, start_rss, start_objects = self._sample()
+        try:
+            yield
+        finally:
+            end_time, end_rss, end_objects = self._sample()
+            args.update(peak_rss_bytes=end_rss, objects=end_objects)
+            if end_rss is not None:
+                args['peak_rss_growth_bytes'] = end_rss - start_rss
+            if end_objects is not None:
+                args['objects_growth'] = end_objects - start_objects
+            self._add_event(dict(
+                name=name, cat='stage', ph='X', pid=os.getpid(), tid=0,
+                ts=int((start_time - self._start_time) * 1e6),
+                dur=int((end_time - start_time) * 1e6), args=args))
+
+    def _add_event(self, event):
+        """Add the trace event of a stage: in a worker process, it is
+        appended to the side file of the workers (a single write of a line
+        in append mode, which doesn't interleave with the other workers).
+        """
+
+        if os.getpid() == self.pid:
+            self.events.append(event)
+        else:
+            with open(self.trace_fname + '.workers', 'a') as out_file:
+                out_file.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def _worker_events(self):
+        """Return the trace events of the worker processes, and remove
+        their side file.
+        """
+
+        workers_fname = self.trace_fname + '.workers'
+        try:
+            with open(workers_fname) as in_file:
+                events = [json.loads(line) for line in in_file
+                          if line.strip()]
+        except (IOError, OSError):
+            return []
+        os.remove(workers_fname)
+        return events
+
+    def summary(self, events=None):
+        """Return a dictionary indexed by the name of each stage, with the
+        number of its runs, their total and maximum wall time in seconds,
+        and the maximum peak RSS of the processes which ran it.
+        """
+
+        stages = dict()
+        for event in self.events if events is None else events:
+            stage = stages.setdefault(event['name'], dict(
+                runs=0, total_seconds=0.0, max_seconds=0.0,
+                peak_rss_bytes=None))
+            seconds = event['dur'] / 1e6
+            stage['runs'] += 1
+            stage['total_seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            peak_rss = event['args'].get('peak_rss_bytes')
+            if peak_rss is not None:
+                stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'] or 0,
+                                              peak_rss)
+        return stages
+
+    def save(self):
+        """Save the trace of the stages of this process and of its workers
+        into 'trace_fname'.
+
+        :returns: the summary of the stages
+        """
+
+        events = sorted(self.events + self._worker_events(),
+                        key=lambda event: (event['ts'], -event['dur']))
+        summary = self.summary(events)
+        atomic_write(self.trace_fname,
+                     json.dumps(dict(traceEvents=events,
+                                     displayTimeUnit='ms',
+                                     stageSummary=summary),
+                                indent=1, sort_keys=True,
+                                separators=(',', ': ')))
+        return summary
+
+
+def enable_profiling(trace_fname, count_objects=True):
+    """Enable the profiling of the stages in this process (and in the worker
+    processes it forks from now on), to be saved into 'trace_fname'.
+
+    :returns: the StageProfiler
+    """
+
+    global _PROFILER
+    _PROFILER = StageProfiler(trace_fname, count_objects=count_objects)
+    return _PROFILER
+
+
+def save_profile():
+    """Save the profile of the stages, if the profiling is enabled, and
+    print the summary of each stage.
+    """
+
+    if _PROFILER is None:
+        return
+    summary = _PROFILER.save()
+    for name in sorted(summary, key=lambda name:
+                       -summary[name]['total_seconds']):
+        stage = summary[name]
+        peak_rss = stage['peak_rss_bytes']
+        print('%-30s %4d runs %10.3f s  peak RSS %s' %
+              (name, stage['runs'], stage['total_seconds'],
+               '%.1f MB' % (peak_rss / 1048576.0)
+               if peak_rss is not None else 'unknown'))
+    print('Profile of the stages saved into %s' % _PROFILER.trace_fname)
+
+
+@contextlib.contextmanager
+def profile_stage(name, **args):
+    """Profile the body of the 'with' statement as a run of the stage
+    'name', if the profiling is enabled.
+    """
+
+    if _PROFILER is None:
+        yield
+    else:
+        with _PROFILER.stage(name, **args):
+            yield
+
+
+def profiled_stage(name):
+    """A decorator which profiles each call of a function as a run of the
+    stage 'name', if the profiling is enabled.
+    """
+
+    def decorator(function):
+        """Wrap 'function'."""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            """The profiled 'function'."""
+            if _PROFILER is None:
+                return function(*args, **kwargs)
+            with _PROFILER.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+"""Generate synthetic inputs, of a configurable size, with the same layout
+as the Open Data of the City of Toronto used by the visualizations, so that
+they can be benchmarked (and tested) offline, without downloading it:
+
+ . Shapefiles of polygons (like the City Wards, or the CVA sub-wards with
+   their 'ward' and 'avgtaximpa' fields), whose features are the cells of a
+   perturbed grid over the bounding box of Toronto: the neighboring cells
+   share their borders exactly, vertex by vertex, as the real wards do;
+
+ . Excel workbooks ('.xlsx') with the budget per ward, with a row per
+   project and a 'Name-NN Total' row per ward, in the layout which the ETL
+   of the budget expects.
+
+The Shapefiles and the workbooks are written directly, with the standard
+library, and the same parameters always generate the same files.
+"""
+
+import math
+import struct
+import zipfile
+
+import numpy as np
+
+from basemap_cache_toronto import TORONTO_BOUNDING_BOX
+
+
+# The first budget year, and the number of years of the budget workbooks
+# (with a subtotal column after the first five years, as the real one)
+SYNTHETIC_FIRST_YEAR = 2015
+SYNTHETIC_NUM_YEARS = 10
+SYNTHETIC_SUBTOTAL_AFTER_YEARS = 5
+
+# The wave numbers (per span of the bounding box) of the perturbation of the
+# vertices of the synthetic polygons, and the bound of its gain: with the
+# coordinates scaled by the spans, the perturbation of a vertex changes at
+# most 'amplitude * hypot(*_WAVE_NUMBERS) * hypot(1 / lon_span, 1 /
+# lat_span)' times as much as its position, and while this is below 1 two
+# different points can't be moved onto each other (so the rings can't
+# cross themselves, nor their neighbors)
+_WAVE_NUMBERS = (40.0, 25.0)
+_MAX_PERTURBATION_GAIN = 0.5
+
+# The Shapefile type of a polygon, and the dBase type of its attributes
+_SHP_POLYGON = 5
+_DBF_VERSION = 3
+
+
+def grid_polygons(num_features, vertices_per_ring,
+                  bounding_box=TORONTO_BOUNDING_BOX, seed=0):
+    """Return the rings of 'num_features' polygons, the cells of a grid
+    over 'bounding_box', each one with about 'vertices_per_ring' vertices.
+
+    The vertices are perturbed by a smooth function of their position, the
+    same for all the cells, so the borders of the neighboring cells are
+    still shared. The perturbation is small enough to be a contraction, so
+    that no two points of the plane are moved onto each other: the rings
+    stay simple (valid polygons), and the neighboring cells don't overlap.
+
+    :returns: the tuple (rings, centers): a list with the (num_vertices, 2)
+              array of the (lon, lat) of each ring, clockwise and closed (as
+              the outer rings of a Shapefile), and the array with the center
+              of each cell
+    """
+
+    lon_span = bounding_box['urcrnrlon'] - bounding_box['llcrnrlon']
+    lat_span = bounding_box['urcrnrlat'] - bounding_box['llcrnrlat']
+    num_cols = max(1, int(math.ceil(math.sqrt(num_features * lon_span /
+                                              lat_span))))
+    num_rows = int(math.ceil(num_features / float(num_cols)))
+
+    # the grid lines, inside the bounding box with a margin
+    lons = np.linspace(bounding_box['llcrnrlon'] + 0.05 * lon_span,
+                       bounding_box['urcrnrlon'] - 0.05 * lon_span,
+                       num_cols + 1)
+    lats = np.linspace(bounding_box['llcrnrlat'] + 0.05 * lat_span,
+                       bounding_box['urcrnrlat'] - 0.05 * lat_span,
+                       num_rows + 1)
+
+    # the parameter along each side of a cell of its vertices
+    side_steps = max(1, vertices_per_ring // 4)
+    steps = np.arange(side_steps) / float(side_steps)
+
+    rng = np.random.RandomState(seed)
+    phases = rng.uniform(0.0, 2.0 * math.pi, 4)
+    amplitude = min(0.15 * min(lon_span / num_cols, lat_span / num_rows),
+                    _MAX_PERTURBATION_GAIN /
+                    (math.hypot(_WAVE_NUMBERS[0], _WAVE_NUMBERS[1]) *
+                     math.hypot(1.0 / lon_span, 1.0 / lat_span)))
+
+    cols, rows = np.divmod(np.arange(num_features), num_rows)
+    west, east = lons[cols], lons[cols + 1]
+    south, north = lats[rows], lats[rows + 1]
+
+    # the vertices along the horizontal and vertical sides of each cell,
+    # from west to east and from south to north (a shared side is computed
+    # from the same grid lines in both cells, so its vertices are exactly
+    # the same in both)
+    horizontal = west[:, None] + steps * (east - west)[:, None]
+    vertical = south[:, None] + steps * (north - south)[:, None]
+    ones = np.ones((num_features, side_steps))
+
+    # clockwise from the south-west corner: up the west side, east along the
+    # north side, down the east side and west along the south side
+    ring_lons = np.hstack((
+        west[:, None] * ones,
+        horizontal,
+        east[:, None] * ones,
+        east[:, None], horizontal[:, :0:-1],
+        west[:, None]))
+    ring_lats = np.hstack((
+        vertical,
+        north[:, None] * ones,
+        north[:, None], vertical[:, :0:-1],
+        south[:, None] * ones,
+        south[:, None]))
+
+    # perturb the vertices by a smooth function of their position, so a
+    # vertex shared by two rings is moved the same in both
+    long_wave, short_wave = _WAVE_NUMBERS
+    lon_waves = np.sin(ring_lats * long_wave / lat_span + phases[0]) * \
+        np.sin(ring_lons * short_wave / lon_span + phases[1])
+    lat_waves = np.sin(ring_lons * long_wave / lon_span + phases[2]) * \
+        np.sin(ring_lats * short_wave / lat_span + phases[3])
+    ring_lons = ring_lons + amplitude * lon_waves
+    ring_lats = ring_lats + amplitude * lat_waves
+
+    rings = [np.column_stack((ring_lons[idx], ring_lats[idx]))
+             for idx in range(num_features)]
+    centers = np.column_stack(((west + east) / 2.0, (south + north) / 2.0))
+    return rings, centers
+
+
+def _dbf_field_descriptor(name, field_type, length, decimals):
+    """Return the 32-byte dBase descriptor of a field."""
+
+    return struct.pack('<11sc4xBB14x', name.encode('ascii'),
+                       field_type.encode('ascii'), length, decimals)
+
+
+def _write_dbf(dbf_fname, fields, records):
+    """Write the dBase file with the attributes of a Shapefile.
+
+    :param fields: the list of (name, type, length, decimals) of the fields,
+                   where the type is 'C' (text) or 'N' (number)
+    :param records: the list of the tuples with the values of each record
+    """
+
+    header_length = 32 + 32 * len(fields) + 1
+    record_length = 1 + sum(length for dummy, dummy, length, dummy in fields)
+
+    with open(dbf_fname, 'wb') as out_file:
+        out_file.write(struct.pack('<BBBBIHH20x', _DBF_VERSION, 115, 1, 1,
+                                   len(records), header_length,
+                                   record_length))
+        for field in fields:
+            out_file.write(_dbf_field_descriptor(*field))
+        out_file.write(b'\r')
+
+        for record in records:
+            values = [b' ']
+            for (dummy, field_type, length, decimals), value in \
+                    zip(fields, record):
+                if field_type == 'N':
+                    text = ('%*.*f' % (length, decimals, value))[:length]
+                else:
+                    text = (u'%-*s' % (length, value))[:length]
+                values.append(text.encode('latin-1'))
+            out_file.write(b''.join(values))
+        out_file.write(b'\x1a')
+
+
+def _shp_header(file_length_bytes, bounds):
+    """Return the 100-byte header of a '.shp' or '.shx' file."""
+
+    return struct.pack('>7i', 9994, 0, 0, 0, 0, 0, file_length_bytes // 2) + \
+        struct.pack('<2i4d4d', 1000, _SHP_POLYGON, bounds[0], bounds[1],
+                    bounds[2], bounds[3], 0.0, 0.0, 0.0, 0.0)
+
+
+def write_polygon_shapefile(shapefile, rings, fields, records):
+    """Write the polygons with a single ring each in 'rings' (arrays of
+    (lon, lat), clockwise and closed), and their attributes, as the ESRI
+    Shapefile 'shapefile' (its path without extension: the '.shp', '.shx',
+    '.dbf' and '.prj' files are written).
+
+    :param fields: the list of (name, type, length, decimals) of the fields
+                   of the attributes, where the type is 'C' or 'N'
+    :param records: the list of the tuples with the attributes of each ring
+    """
+
+    contents = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        box = (ring[:, 0].min(), ring[:, 1].min(),
+               ring[:, 0].max(), ring[:, 1].max())
+        contents.append(struct.pack('<i4d2ii', _SHP_POLYGON, box[0], box[1],
+                                    box[2], box[3], 1, len(ring), 0) +
+                        ring.astype('<f8').tobytes())
+
+    all_vertices = np.concatenate(rings) if rings else np.zeros((1, 2))
+    bounds = (all_vertices[:, 0].min(), all_vertices[:, 1].min(),
+              all_vertices[:, 0].max(), all_vertices[:, 1].max())
+
+    shp_length = 100 + sum(8 + len(content) for content in contents)
+    shx_length = 100 + 8 * len(contents)
+    with open(shapefile + '.shp', 'wb') as shp_file, \
+            open(shapefile + '.shx', 'wb') as shx_file:
+        shp_file.write(_shp_header(shp_length, bounds))
+        shx_file.write(_shp_header(shx_length, bounds))
+        offset = 100
+        for record_number, content in enumerate(contents, 1):
+            shx_file.write(struct.pack('>2i', offset // 2, len(content) // 2))
+            shp_file.write(struct.pack('>2i', record_number,
+                                       len(content) // 2))
+            shp_file.write(content)
+            offset += 8 + len(content)
+
+    _write_dbf(shapefile + '.dbf', fields, records)
+
+    with open(shapefile + '.prj', 'w') as prj_file:
+        prj_file.write('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",'
+                       'SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+                       'PRIMEM["Greenwich",0.0],'
+                       'UNIT["Degree",0.0174532925199433]]')
+
+
+def write_wards_shapefile(shapefile, num_wards, vertices_per_ring, seed=0):
+    """Write a synthetic City Wards Shapefile, with 'num_wards' wards whose
+    number is in their field 'SCODE_NAME' (padded with '0's, as the real
+    one).
+    """
+
+    rings, dummy = grid_polygons(num_wards, vertices_per_ring, seed=seed)
+    records = [(u'%02d' % (ward_idx + 1), u'Ward %d' % (ward_idx + 1))
+               for ward_idx in range(num_wards)]
+    write_polygon_shapefile(shapefile, rings,
+                            [('SCODE_NAME', 'C', 10, 0),
+                             ('NAME', 'C', 40, 0)],
+                            records)
+
+
+def write_subwards_shapefile(shapefile, num_subwards, vertices_per_ring,
+                             num_wards, seed=1):
+    """Write a synthetic CVA Tax Impact Shapefile, with 'num_subwards'
+    sub-wards with their fields 'subdiv', 'ward' (from 1 to 'num_wards',
+    by the position of the sub-ward) and 'avgtaximpa'.
+    """
+
+    rings, centers = grid_polygons(num_subwards, vertices_per_ring,
+                                   seed=seed)
+
+    # the ward of a sub-ward is given by its position, in vertical strips
+    # of the bounding box
+    lon_span = TORONTO_BOUNDING_BOX['urcrnrlon'] - \
+        TORONTO_BOUNDING_BOX['llcrnrlon']
+    wards = 1 + np.minimum(
+        ((centers[:, 0] - TORONTO_BOUNDING_BOX['llcrnrlon']) / lon_span *
+         num_wards).astype(np.int64), num_wards - 1)
+
+    rng = np.random.RandomState(seed)
+    tax_impacts = rng.normal(0.0, 60.0, num_subwards)
+    records = [(u'%05d' % (19000 + idx), float(wards[idx]),
+                float(tax_impacts[idx])) for idx in range(num_subwards)]
+    write_polygon_shapefile(shapefile, rings,
+                            [('subdiv', 'C', 10, 0),
+                             ('ward', 'N', 10, 1),
+                             ('avgtaximpa', 'N', 19, 4)],
+                            records)
+
+
+def _xlsx_column_name(col_idx):
+    """Return the letters of the 0-based column 'col_idx' (e.g., 'AB')."""
+
+    letters = ''
+    col_idx += 1
+    while col_idx:
+        col_idx, remainder = divmod(col_idx - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def _xlsx_cell(row_idx, col_idx, value):
+    """Return the XML of a cell of an '.xlsx' sheet (text is inline)."""
+
+    reference = '%s%d' % (_xlsx_column_name(col_idx), row_idx + 1)
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return '<c r="%s"><v>%r</v></c>' % (reference, float(value))
+    text = value.replace('&', '&amp;').replace('<', '&lt;')
+    return '<c r="%s" t="inlineStr"><is><t>%s</t></is></c>' % (reference,
+                                                               text)
+
+
+def _write_xlsx(xlsx_fname, rows):
+    """Write the 'rows' (lists of numbers, texts or None for an empty cell)
+    as the only sheet of the '.xlsx' workbook 'xlsx_fname'.
+    """
+
+    num_columns = max(len(row) for row in rows)
+    sheet = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/'
+             'spreadsheetml/2006/main"><dimension ref="A1:%s%d"/>'
+             '<sheetData>' % (_xlsx_column_name(num_columns - 1), len(rows))]
+    for row_idx, row in enumerate(rows):
+        sheet.append('<row r="%d">' % (row_idx + 1))
+        sheet.extend(_xlsx_cell(row_idx, col_idx, value)
+                     for col_idx, value in enumerate(row))
+        sheet.append('</row>')
+    sheet.append('</sheetData></worksheet>')
+
+    main_ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    rels_ns = 'http://schemas.openxmlformats.org/officeDocument/2006/' \
+        'relationships'
+    pkg_rels_ns = 'http://schemas.openxmlformats.org/package/2006/' \
+        'relationships'
+    parts = {
+        '[Content_Types].xml':
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://'
+            'schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.'
+            'openxmlformats-package.relationships+xml"/><Default '
+            'Extension="xml" ContentType="application/xml"/><Override '
+            'PartName="/xl/workbook.xml" ContentType="application/vnd.'
+            'openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+            '"application/vnd.openxmlformats-officedocument.spreadsheetml.'
+            'worksheet+xml"/></Types>',
+        '_rels/.rels':
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="%s">'
+            '<Relationship Id="rId1" Type="%s/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>' %
+            (pkg_rels_ns, rels_ns),
+        'xl/workbook.xml':
+            '<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="%s" '
+            'xmlns:r="%s"><sheets><sheet name="Budget" sheetId="1" '
+            'r:id="rId1"/></sheets></workbook>' % (main_ns, rels_ns),
+        'xl/_rels/workbook.xml.rels':
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="%s">'
+            '<Relationship Id="rId1" Type="%s/worksheet" '
+            'Target="worksheets/sheet1.xml"/></Relationships>' %
+            (pkg_rels_ns, rels_ns),
+        'xl/worksheets/sheet1.xml': ''.join(sheet),
+    }
+
+    with zipfile.ZipFile(xlsx_fname, 'w', zipfile.ZIP_DEFLATED) as xlsx_zip:
+        for part_name in sorted(parts):
+            xlsx_zip.writestr(part_name, parts[part_name].encode('utf-8'))
+
+
+def write_budget_workbook(xlsx_fname, num_rows, num_wards, seed=2,
+                          first_year=SYNTHETIC_FIRST_YEAR):
+    """Write a synthetic budget workbook with about 'num_rows' rows: for
+    each of the 'num_wards' wards, the rows of its projects and then its
+    'Name-NN Total' row, with the budget of each of the years from
+    'first_year', a subtotal column after the first five years, and the
+    total in the last column.
+
+    :returns: the matrix ward x year with the budgets of the total rows
+    """
+
+    rows_per_ward = max(2, num_rows // max(1, num_wards))
+    num_projects = rows_per_ward - 1
+
+    header = [u'Ward', u'Project Name', u'Sub-project Name']
+    for year_idx in range(SYNTHETIC_NUM_YEARS):
+        header.append(u'%d Plan' % (first_year + year_idx))
+        if year_idx + 1 == SYNTHETIC_SUBTOTAL_AFTER_YEARS:
+            header.append(u'%d Year Total' % SYNTHETIC_SUBTOTAL_AFTER_YEARS)
+    header.append(u'%d Year Total' % SYNTHETIC_NUM_YEARS)
+
+    def budget_row(first_columns, budgets):
+        """A row with the budgets, the subtotal, and the total."""
+        row = list(first_columns)
+        for year_idx, budget in enumerate(budgets):
+            row.append(float(budget))
+            if year_idx + 1 == SYNTHETIC_SUBTOTAL_AFTER_YEARS:
+                row.append(float(budgets[:year_idx + 1].sum()))
+        # the total as the ETL validates it, adding the years in order
+        row.append(float(np.cumsum(budgets)[-1]))
+        return row
+
+    rng = np.random.RandomState(seed)
+    rows = [header]
+    ward_budgets = np.zeros((num_wards, SYNTHETIC_NUM_YEARS))
+    for ward_idx in range(num_wards):
+        ward_name = u'Ward Name %d-%02d' % (ward_idx + 1, ward_idx + 1)
+        project_budgets = rng.randint(0, 500, (num_projects,
+                                               SYNTHETIC_NUM_YEARS)) * 1000.0
+        for project_idx in range(num_projects):
+            rows.append(budget_row(
+                (ward_name, u'Project %d' % project_idx, u'Sub-project'),
+                project_budgets[project_idx]))
+        ward_budgets[ward_idx] = project_budgets.sum(axis=0)
+        rows.append(budget_row((ward_name + u' Total', None, None),
+                               ward_budgets[ward_idx]))
+
+    _write_xlsx(xlsx_fname, rows)
+    return ward_budgets
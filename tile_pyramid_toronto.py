@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+# pylint: disable=no-member
+
+"""Pre-render the layers of Toronto (City Wards, Priority Investment
+Neighborhoods, Business Improvement Areas, CVA Tax Impact, and the budget
+per ward) into pyramids of XYZ tiles, the 256x256 PNG images in Web
+Mercator that the web maps (Leaflet, OpenLayers, ...) fetch as 'z/x/y.png',
+and serve these pyramids with a small local HTTP server, so that a map of
+Toronto can be panned and zoomed without rendering the whole city on each
+request.
+
+Each pyramid is saved under './cache_dir/tiles/<layer>/<key>', where the key
+is derived from the geometry of the layer, its data and its style, so a
+tile is only rendered once while none of them change. For each zoom level,
+the geometry of the layer is simplified to the size of a pixel of its tiles,
+and the rings of the layer under each tile are found with an STR tree: the
+tiles without any ring aren't rendered, and the tiles which are left fully
+transparent aren't saved. The tiles are rendered in parallel by a pool of
+worker processes.
+"""
+
+import argparse
+import email.utils
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import matplotlib.image
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+import numpy as np
+
+from basemap_cache_toronto import toronto_basemap, TORONTO_BOUNDING_BOX
+from cache_dir_toronto import cache_subdir, cache_key, atomic_write
+from geometry_cache_toronto import LayerGeometry, load_layer_geometry, \
+    WGS84_SRS
+from patch_layers_toronto import layer_collection
+from raster_composite_toronto import new_agg_figure, render_figure_rgba
+from simplify_geometry_toronto import simplify_layer_cached
+from spatial_index_toronto import STRtree, ring_bounds
+from visualiz_investm_toronto_neighborhoods import \
+    PRIORITY_INVESTMENT_SHAPEFILE, PRIORITY_INVESTMENT_SRS, \
+    BUSINESS_IMPROVEMENT_SHAPEFILE
+
+
+TILES_CACHE_SUBDIR = 'tiles'
+
+# Increase this version whenever the rendering of the tiles changes
+TILES_VERSION = 1
+
+# The index of the current pyramid of each layer, in the tiles directory
+TILES_INDEX_FNAME = 'tiles.json'
+
+# The size of a tile in pixels, and the resolution of its figure
+TILE_SIZE = 256
+TILE_DPI = 64
+
+# The margin, in pixels, around a tile for the rings drawn on it, so that
+# the borders of the rings just outside the tile are also drawn
+TILE_MARGIN_PIXELS = 2
+
+DEFAULT_MIN_ZOOM = 9
+DEFAULT_MAX_ZOOM = 14
+
+# The radius of the sphere of the Web Mercator projection (EPSG:3857), and
+# the limit of its latitudes
+WEB_MERCATOR_RADIUS = 6378137.0
+WEB_MERCATOR_MAX_LATITUDE = 85.0511287798
+
+# The half size of the world in Web Mercator: the tiles cover the square
+# [-WEB_MERCATOR_ORIGIN, WEB_MERCATOR_ORIGIN] in both axes
+WEB_MERCATOR_ORIGIN = math.pi * WEB_MERCATOR_RADIUS
+
+# The cache headers of the tiles served: they don't change while their
+# pyramid exists
+TILE_MAX_AGE_SECONDS = 24 * 3600
+
+# The Excel spreadsheet with the budget per ward
+BUDGET_SPREADSHEET = 'shp_dir/budget_per_city_ward.xlsx'
+
+
+def _ward_total_budgets(layer):
+    """Return the total budget of the ward of each ring of the City Wards
+    'layer', from the ETL of the budget spreadsheet.
+    """
+
+    # imported here because only this layer needs the budget ETL
+    from plot_excel_budget_toronto_neighborhoods import \
+        TorontoBudgetForecastPerCityWard, shape_ward_numbers
+
+    budget = TorontoBudgetForecastPerCityWard()
+    budget.etl_excel_spreadsheet_cached(BUDGET_SPREADSHEET)
+    return budget.budget_for_wards(shape_ward_numbers(layer))
+
+
+# The layers which can be rendered into tiles: the Shapefile of each one,
+# and its style, as in the panels of the visualization of the investment
+# and in the map of the budget per ward. The layers colored by a value give
+# the colormap and either the field of the Shapefile with that value, or
+# the function which returns the value of each ring (and then the data
+# files it reads). The Shapefiles which aren't in WGS84 give their
+# coordinate system
+TILE_LAYERS = {
+    'wards': dict(shapefile='./shp_dir/icitw_wgs84',
+                  facecolor='none', edgecolor='green', linewidths=0.5),
+    'priority_investment': dict(shapefile=PRIORITY_INVESTMENT_SHAPEFILE,
+                                srs=PRIORITY_INVESTMENT_SRS,
+                                facecolor='m', edgecolor='k',
+                                linewidths=1.),
+    'business_improvement': dict(shapefile=BUSINESS_IMPROVEMENT_SHAPEFILE,
+                                 facecolor='g', edgecolor='k',
+                                 linewidths=1.),
+    'tax_impact': dict(shapefile='shp_dir/CVA_2011_Tax_Impact_WGS84',
+                       cmap='Reds', value_field='avgtaximpa'),
+    'ward_budget': dict(shapefile='./shp_dir/icitw_wgs84',
+                        cmap='Greens', value_function=_ward_total_budgets,
+                        data_files=(BUDGET_SPREADSHEET,)),
+}
+
+# The layers (simplified for a zoom level) and their styles, indexed by
+# (layer_name, zoom): loaded by the parent process, and passed to each
+# worker which renders their tiles when it starts (see _init_tile_worker())
+_TILE_SOURCES = dict()
+
+
+def lonlat_to_web_mercator(lons, lats):
+    """Return the Web Mercator coordinates (x, y), in meters, of the
+    longitudes and latitudes 'lons' and 'lats' (in degrees).
+    """
+
+    lats = np.clip(lats, -WEB_MERCATOR_MAX_LATITUDE, WEB_MERCATOR_MAX_LATITUDE)
+    x_merc = WEB_MERCATOR_RADIUS * np.radians(lons)
+    y_merc = WEB_MERCATOR_RADIUS * np.log(np.tan(math.pi / 4.0 +
+                                                 np.radians(lats) / 2.0))
+    return x_merc, y_merc
+
+
+def tile_span(zoom):
+    """Return the side of a tile at 'zoom', in Web Mercator meters."""
+
+    return 2.0 * WEB_MERCATOR_ORIGIN / (1 << zoom)
+
+
+def tile_bounds(zoom, tile_x, tile_y):
+    """Return the bounds (xmin, ymin, xmax, ymax), in Web Mercator meters,
+    of the tile 'tile_x', 'tile_y' at 'zoom' (the tile y grows southwards).
+    """
+
+    span = tile_span(zoom)
+    xmin = -WEB_MERCATOR_ORIGIN + tile_x * span
+    ymax = WEB_MERCATOR_ORIGIN - tile_y * span
+    return (xmin, ymax - span, xmin + span, ymax)
+
+
+def tiles_of_bounding_box(zoom, bounding_box=TORONTO_BOUNDING_BOX):
+    """Return the arrays (tile_x, tile_y) of all the tiles at 'zoom' which
+    cover the 'bounding_box' (with the keys of the TORONTO_BOUNDING_BOX).
+    """
+
+    xmin, ymin = lonlat_to_web_mercator(bounding_box['llcrnrlon'],
+                                        bounding_box['llcrnrlat'])
+    xmax, ymax = lonlat_to_web_mercator(bounding_box['urcrnrlon'],
+                                        bounding_box['urcrnrlat'])
+    span = tile_span(zoom)
+    last_tile = (1 << zoom) - 1
+    tiles_x = np.arange(max(0, int((xmin + WEB_MERCATOR_ORIGIN) // span)),
+                        min(last_tile,
+                            int((xmax + WEB_MERCATOR_ORIGIN) // span)) + 1)
+    tiles_y = np.arange(max(0, int((WEB_MERCATOR_ORIGIN - ymax) // span)),
+                        min(last_tile,
+                            int((WEB_MERCATOR_ORIGIN - ymin) // span)) + 1)
+    tile_x, tile_y = np.meshgrid(tiles_x, tiles_y, indexing='ij')
+    return tile_x.ravel(), tile_y.ravel()
+
+
+def web_mercator_layer(to_map, layer):
+    """Return a copy of the LayerGeometry 'layer', projected by the Basemap
+    'to_map', in Web Mercator coordinates.
+    """
+
+    lons, lats = to_map(layer.vertices[:, 0], layer.vertices[:, 1],
+                        inverse=True)
+    x_merc, y_merc = lonlat_to_web_mercator(np.asarray(lons),
+                                            np.asarray(lats))
+    merc_layer = LayerGeometry(np.column_stack((x_merc, y_merc)),
+                               layer.ring_offsets, layer.attributes)
+    if layer.source_key is not None:
+        merc_layer.source_key = cache_key([], (layer.source_key,
+                                               'web_mercator'))
+    return merc_layer
+
+
+def _layer_facecolors(layer_spec, layer):
+    """Return the RGBA face color of each ring of 'layer', for a layer
+    colored by a value, or None for a layer with a single face color.
+    """
+
+    if 'cmap' not in layer_spec:
+        return None
+    if 'value_field' in layer_spec:
+        values = layer.attributes[layer_spec['value_field']]
+    else:
+        values = layer_spec['value_function'](layer)
+    values = np.asarray(values, dtype=np.float64)
+
+    norm = Normalize(vmin=values.min(), vmax=values.max())
+    return plt.get_cmap(layer_spec['cmap'])(norm(values))
+
+
+def _pyramid_key(layer_name, layer_spec, merc_layer):
+    """Return the key of the pyramid of tiles of a layer, derived from its
+    geometry, its data and its style.
+    """
+
+    style = sorted((name, value) for name, value in layer_spec.items()
+                   if name not in ('value_function', 'data_files'))
+    return cache_key(layer_spec.get('data_files', ()),
+                     (TILES_VERSION, TILE_SIZE, layer_name,
+                      merc_layer.source_key, style))
+
+
+def pyramid_dir(layer_name, pyramid_key):
+    """Return the directory of the pyramid 'pyramid_key' of a layer."""
+
+    return os.path.join(cache_subdir(TILES_CACHE_SUBDIR), layer_name,
+                        pyramid_key)
+
+
+def tile_fname(pyramid_path, zoom, tile_x, tile_y):
+    """Return the path of the PNG of a tile in the pyramid 'pyramid_path'."""
+
+    return os.path.join(pyramid_path, str(zoom), str(tile_x),
+                        '%d.png' % tile_y)
+
+
+def _init_tile_worker(tile_sources):
+    """Initialize a worker process which renders tiles with the layers and
+    styles 'tile_sources' loaded by the parent process (a dictionary
+    indexed by (layer_name, zoom), see _TILE_SOURCES), as it doesn't
+    inherit them unless it is forked.
+    """
+
+    _TILE_SOURCES.update(tile_sources)
+
+
+def _render_tile(tile_job):
+    """Render a tile in a worker process, with the Agg backend.
+
+    :param tile_job: the tuple (layer_name, zoom, tile_x, tile_y,
+                     ring_indices, png_fname), with the rings of the layer
+                     which are under the tile
+    :returns: whether the tile was saved (it isn't if it is empty)
+    """
+
+    layer_name, zoom, tile_x, tile_y, ring_indices, png_fname = tile_job
+
+    # the layer and its face colors were loaded by the parent process, and
+    # passed to this worker when it started
+    layer, facecolors, style = _TILE_SOURCES[(layer_name, zoom)]
+
+    fig = new_agg_figure((TILE_SIZE / float(TILE_DPI),) * 2, TILE_DPI)
+    axis = fig.add_axes([0.0, 0.0, 1.0, 1.0])
+    axis.set_axis_off()
+    xmin, ymin, xmax, ymax = tile_bounds(zoom, tile_x, tile_y)
+    axis.set_xlim(xmin, xmax)
+    axis.set_ylim(ymin, ymax)
+
+    if facecolors is None:
+        collection = layer_collection(layer.take(ring_indices), **style)
+    else:
+        collection = layer_collection(layer.take(ring_indices),
+                                      facecolors=facecolors[ring_indices],
+                                      match_original=True)
+    axis.add_collection(collection)
+
+    rgba = render_figure_rgba(fig)
+    if not rgba[:, :, 3].any():
+        return False
+
+    png_data = io.BytesIO()
+    matplotlib.image.imsave(png_data, rgba, format='png')
+    tile_dir = os.path.dirname(png_fname)
+    if not os.path.isdir(tile_dir):
+        try:
+            os.makedirs(tile_dir)
+        except OSError:
+            pass   # created meanwhile by another worker
+    atomic_write(png_fname, png_data.getvalue())
+    return True
+
+
+def _load_tile_sources(layer_name, zooms):
+    """Load the layer 'layer_name', simplified for each of the 'zooms', with
+    its style, into _TILE_SOURCES.
+
+    :returns: the key of the pyramid of the layer
+    """
+
+    layer_spec = TILE_LAYERS[layer_name]
+    to_map = toronto_basemap()
+    layer = load_layer_geometry(to_map, layer_spec['shapefile'], layer_name,
+                                srs=layer_spec.get('srs', WGS84_SRS))
+    merc_layer = web_mercator_layer(to_map, layer)
+
+    facecolors = _layer_facecolors(layer_spec, layer)
+    style = dict((name, value) for name, value in layer_spec.items()
+                 if name in ('facecolor', 'edgecolor', 'linewidths'))
+
+    for zoom in zooms:
+        # the simplification keeps the rings, in the same order, so they
+        # keep their face colors
+        simplified = simplify_layer_cached(merc_layer,
+                                           tile_span(zoom) / TILE_SIZE)
+        _TILE_SOURCES[(layer_name, zoom)] = (simplified, facecolors, style)
+
+    return _pyramid_key(layer_name, layer_spec, merc_layer)
+
+
+def _tile_jobs(layer_name, zoom, pyramid_path):
+    """Return the jobs to render the tiles of a layer at 'zoom' which have
+    some ring of the layer and which aren't already in its pyramid.
+    """
+
+    layer = _TILE_SOURCES[(layer_name, zoom)][0]
+    tiles_x, tiles_y = tiles_of_bounding_box(zoom)
+    if len(tiles_x) == 0 or len(layer) == 0:
+        return []
+
+    margin = TILE_MARGIN_PIXELS * tile_span(zoom) / TILE_SIZE
+    tile_boxes = np.column_stack(tile_bounds(zoom, tiles_x, tiles_y))
+    tile_boxes[:, :2] -= margin
+    tile_boxes[:, 2:] += margin
+
+    tile_idx, ring_idx = STRtree(ring_bounds(layer)).query_pairs(tile_boxes)
+    order = np.lexsort((ring_idx, tile_idx))
+    tile_idx = tile_idx[order]
+    ring_idx = ring_idx[order]
+    run_starts = np.flatnonzero(np.r_[True, tile_idx[1:] != tile_idx[:-1]])
+    run_ends = np.r_[run_starts[1:], len(tile_idx)]
+
+    tile_jobs = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        tile_x = int(tiles_x[tile_idx[run_start]])
+        tile_y = int(tiles_y[tile_idx[run_start]])
+        png_fname = tile_fname(pyramid_path, zoom, tile_x, tile_y)
+        if not os.path.exists(png_fname):
+            tile_jobs.append((layer_name, zoom, tile_x, tile_y,
+                              ring_idx[run_start:run_end], png_fname))
+    return tile_jobs
+
+
+def _load_tiles_index():
+    """Return the index of the current pyramid of each layer."""
+
+    index_fname = os.path.join(cache_subdir(TILES_CACHE_SUBDIR),
+                               TILES_INDEX_FNAME)
+    try:
+        with open(index_fname) as in_file:
+            return json.load(in_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def render_tile_pyramids(layer_names=None, min_zoom=DEFAULT_MIN_ZOOM,
+                         max_zoom=DEFAULT_MAX_ZOOM, processes=None):
+    """Render the pyramids of tiles of the layers 'layer_names' (all the
+    TILE_LAYERS if None) for the bounding box of Toronto, from 'min_zoom'
+    to 'max_zoom', with a pool of 'processes' worker processes (None for as
+    many as CPUs). The tiles already rendered are not rendered again.
+
+    :returns: a dictionary indexed by layer name, with the number of tiles
+              saved for that layer
+    """
+
+    if layer_names is None:
+        layer_names = sorted(TILE_LAYERS)
+    zooms = range(min_zoom, max_zoom + 1)
+
+    # Load the layers and find their tiles here, and pass them to the
+    # worker processes when they start (they aren't inherited when the
+    # workers are spawned instead of forked)
+    tiles_index = _load_tiles_index()
+    tile_jobs = []
+    for layer_name in layer_names:
+        pyramid_key = _load_tile_sources(layer_name, zooms)
+        tiles_index[layer_name] = dict(key=pyramid_key, min_zoom=min_zoom,
+                                       max_zoom=max_zoom)
+        pyramid_path = pyramid_dir(layer_name, pyramid_key)
+        for zoom in zooms:
+            tile_jobs.extend(_tile_jobs(layer_name, zoom, pyramid_path))
+
+    num_saved = dict((layer_name, 0) for layer_name in layer_names)
+    if tile_jobs:
+        tile_sources = dict(((layer_name, zoom),
+                             _TILE_SOURCES[(layer_name, zoom)])
+                            for layer_name in layer_names for zoom in zooms)
+        pool = multiprocessing.Pool(processes=processes,
+                                    initializer=_init_tile_worker,
+                                    initargs=(tile_sources,))
+        try:
+            saved = pool.map(_render_tile, tile_jobs,
+                             chunksize=max(1, len(tile_jobs) // 64))
+        finally:
+            pool.close()
+            pool.join()
+        for tile_job, tile_saved in zip(tile_jobs, saved):
+            num_saved[tile_job[0]] += int(tile_saved)
+
+    atomic_write(os.path.join(cache_subdir(TILES_CACHE_SUBDIR),
+                              TILES_INDEX_FNAME),
+                 json.dumps(tiles_index, indent=1, sort_keys=True))
+    return num_saved
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server which handles each request in its own thread."""
+
+    daemon_threads = True
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+
+    """Serve the tiles of the pyramids as '/<layer>/<z>/<x>/<y>.png', with
+    cache headers: the ETag of a tile is its pyramid key and its position,
+    so it changes when its pyramid is rendered again.
+
+    A tile of a layer which doesn't exist is empty: it is answered with
+    '204 No Content' (with the same cache headers).
+    """
+
+    _RE_TILE_PATH = re.compile(r'^/(?P<layer>[A-Za-z0-9_]+)/(?P<zoom>[0-9]+)/'
+                               r'(?P<x>[0-9]+)/(?P<y>[0-9]+)\.png$')
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Answer the request of a tile."""
+
+        match = self._RE_TILE_PATH.match(self.path.split('?', 1)[0])
+        pyramid = None
+        if match:
+            pyramid = _load_tiles_index().get(match.group('layer'))
+        if pyramid is None:
+            self.send_error(404, 'Unknown tile')
+            return
+
+        zoom = int(match.group('zoom'))
+        tile_x = int(match.group('x'))
+        tile_y = int(match.group('y'))
+        png_fname = tile_fname(pyramid_dir(match.group('layer'),
+                                           pyramid['key']),
+                               zoom, tile_x, tile_y)
+        etag = '"%s-%d-%d-%d"' % (pyramid['key'][:16], zoom, tile_x, tile_y)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self._send_cache_headers(etag)
+            self.end_headers()
+            return
+
+        try:
+            with open(png_fname, 'rb') as in_file:
+                png_data = in_file.read()
+            last_modified = os.path.getmtime(png_fname)
+        except (IOError, OSError):
+            self.send_response(204)
+            self._send_cache_headers(etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self._send_cache_headers(etag)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png_data)))
+        self.send_header('Last-Modified',
+                         email.utils.formatdate(last_modified, usegmt=True))
+        self.end_headers()
+        self.wfile.write(png_data)
+
+    def _send_cache_headers(self, etag):
+        """Send the headers to cache a tile in the client."""
+
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control',
+                         'public, max-age=%d' % TILE_MAX_AGE_SECONDS)
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+
+def serve_tiles(host='localhost', port=8000):
+    """Serve the pyramids of tiles at http://<host>:<port>/ until
+    interrupted.
+    """
+
+    server = _ThreadingHTTPServer((host, port), TileRequestHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    """Main function on the program.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Render the layers of Toronto into pyramids of XYZ '
+                    'tiles, and serve them')
+    parser.add_argument('--layer', action='append',
+                        choices=sorted(TILE_LAYERS),
+                        help='layer to render (can be repeated; default: '
+                             'all the layers)')
+    parser.add_argument('--min-zoom', type=int, default=DEFAULT_MIN_ZOOM,
+                        help='first zoom level (default: %(default)s)')
+    parser.add_argument('--max-zoom', type=int, default=DEFAULT_MAX_ZOOM,
+                        help='last zoom level (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes rendering the '
+                             'tiles (default: as many as CPUs)')
+    parser.add_argument('--serve', action='store_true',
+                        help='serve the tiles over HTTP after rendering '
+                             'them')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port of the HTTP server (default: '
+                             '%(default)s)')
+    args = parser.parse_args()
+
+    num_saved = render_tile_pyramids(args.layer, args.min_zoom,
+                                     args.max_zoom, args.processes)
+    for layer_name in sorted(num_saved):
+        print('%s: %d new tiles' % (layer_name, num_saved[layer_name]))
+
+    if args.serve:
+        print('Serving the tiles at http://localhost:%d/<layer>/<z>/<x>/'
+              '<y>.png' % args.port)
+        serve_tiles(port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+
+"""Export the layers of Toronto (City Wards with their budget, CVA Tax
+Impact sub-wards, Priority Investment Neighborhoods and Business
+Improvement Areas) as compact vector data for the web maps: TopoJSON, or
+quantized GeoJSON.
+
+The layers are taken from the geometry cache (see geometry_cache_toronto),
+back in longitudes and latitudes. Their vertices are quantized to a grid of
+'quantization' x 'quantization' cells over the bounding box of all of them,
+and then an arc topology is built from them, on the whole vertex buffer at
+once: the rings are cut at their junctions (the vertices where the rings
+which share them have different neighbors, as the simplification of the
+geometry finds them), and each border shared by several rings, of the same
+or of different layers, becomes a single arc, stored once. In the TopoJSON,
+the arcs are delta-encoded (each point is the difference from the previous
+one in grid cells), and the polygons are lists of indexes of arcs (~index
+for an arc reversed).
+
+The quantized GeoJSON has the same quantized coordinates, written with the
+decimals that the grid needs, but without the shared arcs (which GeoJSON
+can't express). In both formats, each Shapefile shape is a feature (a
+Polygon or a MultiPolygon, with its exterior rings counter-clockwise and its
+holes clockwise, as RFC 7946 says), with the attributes of the shape as its
+properties; the wards have their total budget and their budget per year
+too.
+"""
+
+import argparse
+import json
+import math
+
+import numpy as np
+
+from basemap_cache_toronto import toronto_basemap
+from cache_dir_toronto import atomic_write
+from geometry_cache_toronto import LayerGeometry, load_layer_geometry, \
+    WGS84_SRS
+from simplify_geometry_toronto import pinned_vertices, simplify_layer_cached
+from spatial_index_toronto import expand_ranges, points_in_rings
+from visualiz_investm_toronto_neighborhoods import \
+    PRIORITY_INVESTMENT_SHAPEFILE, PRIORITY_INVESTMENT_SRS, \
+    BUSINESS_IMPROVEMENT_SHAPEFILE
+
+
+# The number of cells of the grid of the quantization along each axis (over
+# Toronto, a cell of about half a meter)
+DEFAULT_QUANTIZATION = 100000
+
+# The Excel spreadsheet with the budget per ward
+BUDGET_SPREADSHEET = 'shp_dir/budget_per_city_ward.xlsx'
+
+# The attributes which Basemap adds to each ring, which aren't exported
+_RING_ATTRIBUTES = ('RINGNUM', 'SHAPENUM')
+
+
+def _ward_budget_properties(layer):
+    """Return the properties with the budget of the ward of each ring of the
+    City Wards 'layer', from the ETL of the budget spreadsheet: its total
+    budget and its budget in each year, as a dictionary of arrays with a
+    value per ring.
+    """
+
+    # imported here because only this layer needs the budget ETL
+    from plot_excel_budget_toronto_neighborhoods import \
+        TorontoBudgetForecastPerCityWard, shape_ward_numbers
+
+    budget = TorontoBudgetForecastPerCityWard()
+    budget.etl_excel_spreadsheet_cached(BUDGET_SPREADSHEET)
+    ward_numbers = shape_ward_numbers(layer)
+
+    properties = dict(budget=budget.budget_for_wards(ward_numbers))
+    year_budgets = budget.budget_metric_for_wards(ward_numbers, 'budget')
+    for year_idx, year in enumerate(budget._years):
+        properties['budget_%d' % year] = year_budgets[:, year_idx]
+    return properties
+
+
+# The layers which can be exported: the Shapefile of each one (with its
+# coordinate system, if it isn't in WGS84), and the function which returns
+# the properties of its rings which aren't attributes of the Shapefile
+EXPORT_LAYERS = {
+    'wards': dict(shapefile='./shp_dir/icitw_wgs84',
+                  properties_function=_ward_budget_properties),
+    'tax_impact': dict(shapefile='shp_dir/CVA_2011_Tax_Impact_WGS84'),
+    'priority_investment': dict(shapefile=PRIORITY_INVESTMENT_SHAPEFILE,
+                                srs=PRIORITY_INVESTMENT_SRS),
+    'business_improvement': dict(shapefile=BUSINESS_IMPROVEMENT_SHAPEFILE),
+}
+
+
+class QuantizedLayers(object):
+
+    """The vertices of several layers, quantized to the same grid.
+
+    Fields:
+
+       names: the names of the layers
+
+       layers: the LayerGeometry of each layer, in longitudes and latitudes
+
+       grid: an int64 array of shape (num_vertices, 2) with the grid cell of
+             each vertex of all the layers, without the consecutive vertices
+             of a ring in the same cell
+
+       ring_ids: the index of the ring of each vertex in 'grid', numbering
+                 the rings of all the layers in sequence
+
+       ring_offsets: the offset in 'grid' of the first vertex of each ring,
+                     plus the number of vertices
+
+       layer_rings: the index of the first ring of each layer, plus the
+                    number of rings
+
+       translate, scale: the transform from the grid to longitudes and
+                         latitudes: (lon, lat) = translate + grid * scale
+    """
+
+    def __init__(self, names, layers, quantization=DEFAULT_QUANTIZATION):
+
+        self.names = list(names)
+        self.layers = list(layers)
+
+        vertices = np.concatenate([np.zeros((0, 2))] +
+                                  [layer.vertices for layer in self.layers])
+        if len(vertices):
+            lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+        else:
+            lower, upper = np.zeros(2), np.ones(2)
+        self.translate = lower
+        self.scale = np.where(upper > lower, upper - lower, 1.0) / \
+            float(quantization - 1)
+
+        num_rings = [len(layer) for layer in self.layers]
+        self.layer_rings = np.zeros(len(self.layers) + 1, dtype=np.int64)
+        np.cumsum(num_rings, out=self.layer_rings[1:])
+        ring_ids = np.repeat(np.arange(self.layer_rings[-1]), np.concatenate(
+            [np.zeros(0, dtype=np.int64)] +
+            [np.diff(layer.ring_offsets) for layer in self.layers]))
+
+        grid = np.round((vertices - self.translate) /
+                        self.scale).astype(np.int64)
+        same_as_prev = np.zeros(len(grid), dtype=bool)
+        same_as_prev[1:] = np.all(grid[1:] == grid[:-1], axis=1) & \
+            (ring_ids[1:] == ring_ids[:-1])
+        self.grid = grid[~same_as_prev]
+        self.ring_ids = ring_ids[~same_as_prev]
+
+        self.ring_offsets = np.zeros(self.layer_rings[-1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.ring_ids, minlength=self.layer_rings[-1]),
+                  out=self.ring_offsets[1:])
+
+    def lonlats(self, grid):
+        """Return the longitudes and latitudes of the cells 'grid'."""
+
+        return self.translate + grid * self.scale
+
+    def ring_areas(self):
+        """Return the signed area of each ring, in grid cells (positive for
+        the rings counter-clockwise).
+        """
+
+        num_rings = len(self.ring_offsets) - 1
+        if not len(self.grid):
+            return np.zeros(num_rings)
+        x_coords = self.grid[:, 0].astype(np.float64)
+        y_coords = self.grid[:, 1].astype(np.float64)
+        cross = np.zeros(len(self.grid))
+        cross[:-1] = x_coords[:-1] * y_coords[1:] - \
+            x_coords[1:] * y_coords[:-1]
+        # (the last vertex of a ring doesn't pair with the next ring)
+        cross[self.ring_offsets[1:] - 1] = 0.0
+        sums = np.zeros(num_rings)
+        non_empty = np.diff(self.ring_offsets) > 0
+        sums[non_empty] = np.add.reduceat(
+            cross, self.ring_offsets[:-1][non_empty])
+        return sums / 2.0
+
+
+def build_arcs(quantized):
+    """Build the arc topology of the QuantizedLayers 'quantized': cut each
+    ring at its junctions, and keep each arc (or the same arc reversed) once.
+
+    :returns: the tuple (arcs, ring_arcs), with the list of the arcs (each
+              one an int64 array (num_points, 2) of grid cells), and the
+              list of the indexes of the arcs of each ring, in order, where
+              the index ~i is the arc i reversed
+    """
+
+    num_rings = len(quantized.ring_offsets) - 1
+    if not len(quantized.grid):
+        return [], [[] for dummy in range(num_rings)]
+
+    unique_cells, vertex_ids = np.unique(quantized.grid, axis=0,
+                                         return_inverse=True)
+    vertex_ids = vertex_ids.reshape(-1)
+    junctions = pinned_vertices(vertex_ids, quantized.ring_ids,
+                                len(unique_cells))
+
+    # each arc goes from a junction to the next one in the same ring (the
+    # first and the last vertex of a ring are always junctions)
+    cuts = np.flatnonzero(junctions[vertex_ids])
+    same_ring = quantized.ring_ids[cuts[:-1]] == quantized.ring_ids[cuts[1:]]
+    arc_starts = cuts[:-1][same_ring]
+    arc_ends = cuts[1:][same_ring]
+
+    arcs = []
+    arc_index = dict()
+    ring_arcs = [[] for dummy in range(num_rings)]
+    for start, end, ring_id in zip(arc_starts.tolist(), arc_ends.tolist(),
+                                   quantized.ring_ids[arc_starts].tolist()):
+        arc_ids = vertex_ids[start:end + 1]
+        key = arc_ids.tobytes()
+        index = arc_index.get(key)
+        if index is None:
+            reversed_index = arc_index.get(arc_ids[::-1].tobytes())
+            if reversed_index is not None:
+                index = ~reversed_index
+            else:
+                index = len(arcs)
+                arcs.append(quantized.grid[start:end + 1])
+                arc_index[key] = index
+        ring_arcs[ring_id].append(index)
+
+    return arcs, ring_arcs
+
+
+def _reversed_ring_arcs(ring_arcs):
+    """Return the arcs of a ring, 'ring_arcs', for the ring reversed."""
+
+    return [~index for index in reversed(ring_arcs)]
+
+
+def _hole_exteriors(quantized, hole_ids, exterior_ids, ring_shapes):
+    """Return, for each ring of 'hole_ids', the ring of 'exterior_ids' of
+    the same shape (as given by 'ring_shapes', indexed by ring id) which
+    contains the most of its vertices, or -1 if none contains any of them.
+
+    All the vertices of a hole are tested, and not only one, since a vertex
+    of a hole can touch its exterior ring.
+    """
+
+    hole_exteriors = np.empty(len(hole_ids), dtype=np.int64)
+    hole_exteriors.fill(-1)
+    if not len(hole_ids) or not len(exterior_ids):
+        return hole_exteriors
+
+    ring_offsets = quantized.ring_offsets
+    exterior_sizes = ring_offsets[exterior_ids + 1] - \
+        ring_offsets[exterior_ids]
+    exterior_vertices, dummy = expand_ranges(ring_offsets[exterior_ids],
+                                             exterior_sizes)
+    exteriors = LayerGeometry(quantized.grid[exterior_vertices],
+                              np.append(0, np.cumsum(exterior_sizes)), {})
+
+    hole_vertices, vertex_holes = expand_ranges(
+        ring_offsets[hole_ids],
+        ring_offsets[hole_ids + 1] - ring_offsets[hole_ids])
+    point_idx, exterior_idx = points_in_rings(
+        exteriors, quantized.grid[hole_vertices])
+    hole_idx = vertex_holes[point_idx]
+    same_shape = ring_shapes[hole_ids[hole_idx]] == \
+        ring_shapes[exterior_ids[exterior_idx]]
+    if not np.any(same_shape):
+        return hole_exteriors
+
+    # the number of vertices of each hole inside each exterior ring, and the
+    # exterior ring with the most of them (the last one of a hole, in the
+    # order by hole and then by number of vertices)
+    pairs, num_vertices = np.unique(
+        hole_idx[same_shape] * len(exterior_ids) + exterior_idx[same_shape],
+        return_counts=True)
+    pair_holes = pairs // len(exterior_ids)
+    order = np.lexsort((num_vertices, pair_holes))
+    last_of_hole = np.ones(len(order), dtype=bool)
+    last_of_hole[:-1] = pair_holes[order[1:]] != pair_holes[order[:-1]]
+    best_pairs = pairs[order[last_of_hole]]
+    hole_exteriors[best_pairs // len(exterior_ids)] = \
+        exterior_ids[best_pairs % len(exterior_ids)]
+    return hole_exteriors
+
+
+def _shape_polygons(quantized, layer_idx, ring_areas):
+    """Return, for each shape of the layer 'layer_idx' of 'quantized', the
+    tuple (first_ring, polygons), where 'polygons' is the list of its
+    polygons, each one the list of its rings as tuples (ring_id, reverse):
+    the exterior ring first, and then its holes, with 'reverse' saying if
+    the ring has to be reversed to have the orientation of RFC 7946. The
+    rings which collapse at the resolution of the grid (with less than 4
+    vertices) are left out.
+
+    As in the Shapefiles, the exterior rings are clockwise and the holes
+    counter-clockwise. Each hole goes to the exterior ring of its shape
+    which contains it (or, if none does, to the exterior ring before it).
+    """
+
+    layer = quantized.layers[layer_idx]
+    first_ring = quantized.layer_rings[layer_idx]
+    ring_sizes = np.diff(quantized.ring_offsets)
+    if 'SHAPENUM' in layer.attributes:
+        shape_numbers = np.asarray(layer.attributes['SHAPENUM'])
+    else:
+        shape_numbers = np.arange(len(layer))
+    new_shape = np.ones(len(layer), dtype=bool)
+    new_shape[1:] = shape_numbers[1:] != shape_numbers[:-1]
+    shape_starts = np.flatnonzero(new_shape).tolist() + [len(layer)]
+
+    # the shape of each ring, and the exterior ring of each hole of a shape
+    # with several exterior rings
+    ring_ids = np.arange(first_ring, first_ring + len(layer))
+    ring_shapes = np.zeros(len(quantized.ring_offsets) - 1, dtype=np.int64)
+    ring_shapes[ring_ids] = np.cumsum(new_shape) - 1
+    kept = ring_sizes[ring_ids] >= 4
+    is_hole = kept & (ring_areas[ring_ids] > 0)
+    is_exterior = kept & ~is_hole
+    num_exteriors = np.bincount(ring_shapes[ring_ids[is_exterior]],
+                                minlength=len(shape_starts) - 1)
+    ambiguous = is_hole & (num_exteriors[ring_shapes[ring_ids]] > 1)
+    hole_ids = ring_ids[ambiguous]
+    hole_exteriors = dict(zip(hole_ids.tolist(), _hole_exteriors(
+        quantized, hole_ids,
+        ring_ids[is_exterior & (num_exteriors[ring_shapes[ring_ids]] > 1)],
+        ring_shapes).tolist()))
+
+    shapes = []
+    for start, end in zip(shape_starts[:-1], shape_starts[1:]):
+        polygons = []
+        exterior_polygons = dict()
+        holes = []
+        for ring_id in range(first_ring + start, first_ring + end):
+            if ring_sizes[ring_id] < 4:
+                continue
+            if ring_areas[ring_id] > 0 and \
+               (polygons or hole_exteriors.get(ring_id, -1) >= 0):
+                holes.append((ring_id, polygons[-1] if polygons else None))
+            else:
+                polygons.append([(ring_id, ring_areas[ring_id] < 0)])
+                exterior_polygons[ring_id] = polygons[-1]
+        # the holes go after all the exterior rings, since a hole can come
+        # before the exterior ring which contains it
+        for ring_id, previous_polygon in holes:
+            exterior_polygons.get(hole_exteriors.get(ring_id, -1),
+                                  previous_polygon).append((ring_id, True))
+        shapes.append((start, polygons))
+    return shapes
+
+
+def _shape_properties(layer, properties_function=None):
+    """Return the properties of each ring of 'layer', as a dictionary of
+    lists with a JSON value per ring: the attributes of its Shapefile, and
+    those returned by 'properties_function(layer)'.
+    """
+
+    columns = dict((name, values) for name, values
+                   in layer.attributes.items()
+                   if name not in _RING_ATTRIBUTES)
+    if properties_function is not None:
+        columns.update(properties_function(layer))
+    return dict((name, np.asarray(values).tolist())
+                for name, values in columns.items())
+
+
+def _geometry(polygons, ring_coordinates):
+    """Return the type and the coordinates (or arcs) of the geometry of a
+    shape with 'polygons' (see _shape_polygons()), where
+    'ring_coordinates(ring_id, reverse)' gives the coordinates (or arcs) of
+    a ring, or (None, None) for a shape without polygons.
+    """
+
+    coordinates = [[ring_coordinates(ring_id, reverse)
+                    for ring_id, reverse in polygon]
+                   for polygon in polygons]
+    if not coordinates:
+        return None, None
+    if len(coordinates) == 1:
+        return 'Polygon', coordinates[0]
+    return 'MultiPolygon', coordinates
+
+
+def topojson_topology(quantized, properties):
+    """Return the TopoJSON topology (a dictionary) of the QuantizedLayers
+    'quantized', with an object per layer.
+
+    :param properties: the properties of the rings of each layer (see
+                       _shape_properties())
+    """
+
+    arcs, ring_arcs = build_arcs(quantized)
+    ring_areas = quantized.ring_areas()
+
+    def ring_coordinates(ring_id, reverse):
+        """The arcs of a ring."""
+        return _reversed_ring_arcs(ring_arcs[ring_id]) if reverse \
+            else ring_arcs[ring_id]
+
+    objects = dict()
+    for layer_idx, name in enumerate(quantized.names):
+        geometries = []
+        for first_ring, polygons in _shape_polygons(quantized, layer_idx,
+                                                    ring_areas):
+            geometry_type, geometry_arcs = _geometry(polygons,
+                                                     ring_coordinates)
+            geometry = dict(type=geometry_type,
+                            properties=dict((field, values[first_ring])
+                                            for field, values
+                                            in properties[layer_idx].items()))
+            if geometry_arcs is not None:
+                geometry['arcs'] = geometry_arcs
+            geometries.append(geometry)
+        objects[name] = dict(type='GeometryCollection', geometries=geometries)
+
+    # the arcs are delta-encoded: the first point of each arc is its grid
+    # cell, and each of the others the difference from the previous one
+    encoded_arcs = []
+    for arc in arcs:
+        deltas = arc.copy()
+        deltas[1:] -= arc[:-1]
+        encoded_arcs.append(deltas.tolist())
+
+    lower = quantized.translate
+    upper = quantized.lonlats(quantized.grid.max(axis=0)) \
+        if len(quantized.grid) else lower
+    return dict(type='Topology',
+                bbox=[float(lower[0]), float(lower[1]),
+                      float(upper[0]), float(upper[1])],
+                transform=dict(scale=quantized.scale.tolist(),
+                               translate=quantized.translate.tolist()),
+                objects=objects, arcs=encoded_arcs)
+
+
+def quantized_geojson(quantized, properties):
+    """Return the GeoJSON FeatureCollection (a dictionary) of the
+    QuantizedLayers 'quantized', with a feature per shape of each layer (the
+    name of its layer in its property 'layer'), whose coordinates are
+    rounded to the decimals the grid needs.
+
+    :param properties: the properties of the rings of each layer (see
+                       _shape_properties())
+    """
+
+    ring_areas = quantized.ring_areas()
+    decimals = [max(0, int(math.ceil(-math.log10(scale))))
+                for scale in quantized.scale]
+    lonlats = quantized.lonlats(quantized.grid)
+    lonlats = np.column_stack((np.round(lonlats[:, 0], decimals[0]),
+                               np.round(lonlats[:, 1], decimals[1])))
+
+    def ring_coordinates(ring_id, reverse):
+        """The coordinates of a ring."""
+        ring = lonlats[quantized.ring_offsets[ring_id]:
+                       quantized.ring_offsets[ring_id + 1]]
+        return (ring[::-1] if reverse else ring).tolist()
+
+    features = []
+    for layer_idx, name in enumerate(quantized.names):
+        for first_ring, polygons in _shape_polygons(quantized, layer_idx,
+                                                    ring_areas):
+            geometry_type, coordinates = _geometry(polygons,
+                                                   ring_coordinates)
+            feature_properties = dict((field, values[first_ring])
+                                      for field, values
+                                      in properties[layer_idx].items())
+            feature_properties['layer'] = name
+            features.append(dict(type='Feature',
+                                 geometry=dict(type=geometry_type,
+                                               coordinates=coordinates)
+                                 if geometry_type else None,
+                                 properties=feature_properties))
+    return dict(type='FeatureCollection', features=features)
+
+
+def lonlat_layer(to_map, layer):
+    """Return a copy of the LayerGeometry 'layer', projected by the Basemap
+    'to_map', in longitudes and latitudes.
+    """
+
+    lons, lats = to_map(layer.vertices[:, 0], layer.vertices[:, 1],
+                        inverse=True)
+    return type(layer)(np.column_stack((np.asarray(lons, dtype=np.float64),
+                                        np.asarray(lats, dtype=np.float64))),
+                       layer.ring_offsets, layer.attributes)
+
+
+def export_layers(out_fname, layer_names=None, fmt='topojson',
+                  quantization=DEFAULT_QUANTIZATION, tolerance=None):
+    """Export the layers 'layer_names' (of EXPORT_LAYERS, None for all of
+    them) into the file 'out_fname', as TopoJSON or as quantized GeoJSON.
+
+    :param fmt: the format, 'topojson' or 'geojson'
+    :param quantization: the number of cells of the grid along each axis
+    :param tolerance: if given, the layers are first simplified so that no
+                      detail smaller than it is kept (in projected units,
+                      see simplify_geometry_toronto)
+    :returns: the tuple (number of bytes written, number of arcs), with no
+              arcs for GeoJSON
+    """
+
+    if layer_names is None:
+        layer_names = sorted(EXPORT_LAYERS)
+
+    to_map = toronto_basemap()
+    layers = []
+    properties = []
+    for layer_name in layer_names:
+        layer_spec = EXPORT_LAYERS[layer_name]
+        layer = load_layer_geometry(to_map, layer_spec['shapefile'],
+                                    layer_name,
+                                    srs=layer_spec.get('srs', WGS84_SRS))
+        properties.append(_shape_properties(
+            layer, layer_spec.get('properties_function')))
+        layers.append(lonlat_layer(to_map,
+                                   simplify_layer_cached(layer, tolerance)))
+
+    quantized = QuantizedLayers(layer_names, layers, quantization)
+    if fmt == 'topojson':
+        document = topojson_topology(quantized, properties)
+        num_arcs = len(document['arcs'])
+    elif fmt == 'geojson':
+        document = quantized_geojson(quantized, properties)
+        num_arcs = 0
+    else:
+        raise ValueError("Unknown format of vector export '%s'" % fmt)
+
+    content = json.dumps(document, separators=(',', ':'), sort_keys=True)
+    atomic_write(out_fname, content)
+    return len(content), num_arcs
+
+
+def main(argv=None, prog=None):
+    """Main function on the program.
+
+    :param argv: the command-line arguments (None for those of the program)
+    :param prog: the name of the program in its usage (None for the name of
+                 its script)
+    """
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Export the layers of Toronto as TopoJSON or as '
+                    'quantized GeoJSON')
+    parser.add_argument('out_fname', metavar='OUTPUT_FNAME',
+                        help='the file where to export the layers')
+    parser.add_argument('--layer', action='append',
+                        choices=sorted(EXPORT_LAYERS),
+                        help='layer to export (can be repeated; default: '
+                             'all the layers)')
+    parser.add_argument('--format', dest='fmt', default='topojson',
+                        choices=('topojson', 'geojson'),
+                        help='format of the export (default: %(default)s)')
+    parser.add_argument('--quantization', type=int,
+                        default=DEFAULT_QUANTIZATION,
+                        help='number of cells of the grid of the '
+                             'coordinates along each axis (default: '
+                             '%(default)s)')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='simplify the layers first, keeping no detail '
+                             'smaller than TOLERANCE map units')
+    args = parser.parse_args(argv)
+
+    num_bytes, num_arcs = export_layers(args.out_fname, args.layer,
+                                        args.fmt, args.quantization,
+                                        args.tolerance)
+    print('Exported %s into %s (%d bytes%s)' %
+          (', '.join(args.layer or sorted(EXPORT_LAYERS)), args.out_fname,
+           num_bytes, ', %d arcs' % num_arcs if num_arcs else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,14 +32,58 @@ This visualization is another way to express the development of the City
 of Toronto, instead of using words as written media, but with visualization.
 """
 
+import argparse
+import json
+import os
+
 import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-from matplotlib.colors import Normalize, LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.gridspec import GridSpec
 import matplotlib.cm as cm
 import numpy as np
 
+from basemap_cache_toronto import toronto_basemap, TORONTO_BOUNDING_BOX
+from build_graph_toronto import BuildGraph, BUILD_CACHE_SUBDIR
+from cache_dir_toronto import cache_subdir, atomic_write, \
+    evict_cache_entries, touch_cache_entry
+from classify_values_toronto import classification_norm, \
+    CLASSIFICATION_SCHEMES, DEFAULT_NUM_CLASSES
+from geometry_cache_toronto import readshapefile_cached, shapefile_fnames
+from interactive_picking_toronto import MapInspector, attribute_description
+from patch_layers_toronto import layer_collection
+from raster_composite_toronto import new_agg_figure, render_figure_rgba, \
+    composite_over_white, save_rgb_png
+from simplify_geometry_toronto import pixel_tolerance
+from stage_profiler_toronto import enable_profiling, save_profile, \
+    profile_stage, profiled_stage
+
+
+# The size of the figure and the resolution of the image saved: the
+# geometry of the shapefiles is simplified to this resolution
+FIGURE_SIZE_INCHES = (9, 7)
+OUTPUT_DPI = 600
+
+# The Shapefiles of the panels (as they are published: the Priority
+# Investment Neighbourhoods are in NAD27 / UTM zone 17N, and the others in
+# WGS84), and the colormap of the Tax Impact
+CITY_WARDS_SHAPEFILE = './shp_dir/icitw_wgs84'
+PRIORITY_INVESTMENT_SHAPEFILE = './shp_dir/Priority Investment Neighbourhoods'
+PRIORITY_INVESTMENT_SRS = 'EPSG:26717'
+BUSINESS_IMPROVEMENT_SHAPEFILE = './shp_dir/BUSINESS_IMPROVEMENT_AREA_WGS84'
+TAX_IMPACT_SHAPEFILE = 'shp_dir/CVA_2011_Tax_Impact_WGS84'
+TAX_IMPACT_CMAP = 'Reds'
+
+# Increase this version whenever the drawing of the panels changes, so that
+# their rasters in the cache are rendered again
+PANELS_VERSION = 1
+
+# The sub-directory of the cache with the rasters of the panels rendered in
+# parallel, and the limits of its size and of the age of its rasters (a
+# raster at a high resolution takes tens of megabytes)
+PANEL_RASTER_CACHE_SUBDIR = 'panel_rasters'
+PANEL_RASTER_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+PANEL_RASTER_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+
 
 def draw_basic_map_of_toronto(axis):
     """Draw a basic map of Toronto.
@@ -47,117 +91,129 @@ def draw_basic_map_of_toronto(axis):
     :param axis: where to draw the map
     :returns: Basemap with Toronto
     """
-    # These are the latitudes of the City of Toronto.
-    # (Fiona can be better to find them, e.g., from the 'icitw_wgs84' Shapefile
-    #  below.)
-
-    low_left_corner_longitude = -79.75
-    low_left_corner_latitude = 43.40
-    up_right_corner_longitude = -79.10
-    up_right_corner_latitude = 43.95
-
-    to_map = Basemap(llcrnrlon=low_left_corner_longitude,
-                     llcrnrlat=low_left_corner_latitude,
-                     urcrnrlon=up_right_corner_longitude,
-                     urcrnrlat=up_right_corner_latitude,
-                     ellps='WGS84',
-                     resolution='h', area_thresh=0.1,
-                     ax=axis)
+    # The Basemap of Toronto (with its high-resolution coastline) is built
+    # only once, and each call gets its own copy of it attached to 'axis'
+
+    to_map = toronto_basemap(axis=axis, resolution='h', area_thresh=0.1)
 
     to_map.drawmapboundary(fill_color='white')
     return to_map
 
 
-def draw_toronto_and_city_wards(axis):
+def draw_toronto_and_city_wards(axis, tolerance=None):
     """Draw a basic map of Toronto with also the division among
     its city wards.
 
     :param axis: where to draw the map
+    :param tolerance: the size of the smallest detail to draw (None to draw
+                      the wards with all the detail in the Shapefile)
     :returns: Basemap with Toronto
     """
 
     to_map = draw_basic_map_of_toronto(axis)
 
     # Plot the City Wards in Toronto. The borders of these polygons are plot as
-    # they are in the Shapefile
+    # they are in the Shapefile (whose geometry is read from the geometry cache
+    # if the shapefile has already been read before)
 
-    dummy = to_map.readshapefile(shapefile='./shp_dir/icitw_wgs84',
+    dummy = readshapefile_cached(to_map, shapefile=CITY_WARDS_SHAPEFILE,
                                  name='city_wards',
-                                 drawbounds=True, color='green')
+                                 drawbounds=True, color='green',
+                                 tolerance=tolerance)
 
     return to_map
 
 
-def visualize_investment_in_toronto():
-    """Function to visualize the investment in the neighborhoods of
-    Toronto.
-
-    This function is too big, it will be splitted in several parts according
-    to the visualization they do.
+def draw_priority_investment_panel(axis, tolerance=None, draw_layers=True,
+                                   raster=False):
+    """Draw the panel with the Priority investment by the City of Toronto.
 
-    It plots these ESRI Shapefiles from Toronto using matplotlib/basemap/etc.
-    (These shapefiles are available as Open Data from the City of Toronto):
-
-     . The City Wards in Toronto;
-     . The Neighborhoods defined as Priority Investment by the City of Toronto
-     . The Business Improvement Areas defined by the City of Toronto
-     . The Current Value Assessment on Tax Impact for Residential Neighborhoods
-       in the City of Toronto (last year available, 2011)
+    :param axis: where to draw the panel
+    :param tolerance: the size of the smallest detail to draw
+    :param draw_layers: whether to draw the polygons of the Shapefiles, or
+                        only the frame of the panel (its map and its title)
+    :param raster: whether to fill the polygons by scanlines into a raster
+                   (see scanline_raster_toronto), instead of as paths
+    :returns: Basemap with Toronto
     """
 
-    fig = plt.figure()
-
-    axes = [None, None, None]
-    # grid of 2x2 rows and colums for the subplots with differ. visualizations
-    axes[0] = plt.subplot2grid((2, 2), (0, 0))
-    axes[1] = plt.subplot2grid((2, 2), (0, 1))
-    axes[2] = plt.subplot2grid((2, 2), (1, 0), colspan=2)
-
-    # axes = fig.add_subplot(111)
+    axis.set_title("Priority investment by the City of Toronto")
+    if not draw_layers:
+        return draw_basic_map_of_toronto(axis=axis)
 
-    # First map is the Priority investment by the City of Toronto
-
-    axes[0].set_title("Priority investment by the City of Toronto")
-    to_map = draw_toronto_and_city_wards(axis=axes[0])
+    to_map = draw_toronto_and_city_wards(axis=axis, tolerance=tolerance)
 
     # Read the Shapefile of the Priority Investment Neighborhoods in Toronto.
-    # The Shapefile is read first and its polygons are filled with the color
-    # 'facecolor' in a for-loop below
-
-    dummy = to_map.readshapefile(shapefile='./shp_dir/TO_priority_inv_neighb',
-                                 name='prio_investm',
-                                 drawbounds=False)
+    # The Shapefile is read first and all its polygons are filled with the
+    # color 'facecolor' as a single compound path below
+
+    prio_investm = readshapefile_cached(
+        to_map, shapefile=PRIORITY_INVESTMENT_SHAPEFILE,
+        name='prio_investm', drawbounds=False, tolerance=tolerance,
+        srs=PRIORITY_INVESTMENT_SRS)
+
+    collection = layer_collection(prio_investm, facecolor='m', edgecolor='k',
+                                  linewidths=1., zorder=3, raster=raster)
+    with profile_stage('add_collection', layer='prio_investm'):
+        axis.add_collection(collection)
+    return to_map
 
-    patches = []
 
-    for info, shape in zip(to_map.prio_investm_info, to_map.prio_investm):
-        # print info
-        patches.append(Polygon(np.array(shape), True))
+def draw_business_improvement_panel(axis, tolerance=None, draw_layers=True,
+                                    raster=False):
+    """Draw the panel with the Business Improvement Areas of Toronto.
 
-    axes[0].add_collection(PatchCollection(patches, facecolor='m',
-                                           edgecolor='k', linewidths=1.,
-                                           zorder=3))
+    :param axis: where to draw the panel
+    :param tolerance: the size of the smallest detail to draw
+    :param draw_layers: whether to draw the polygons of the Shapefiles, or
+                        only the frame of the panel (its map and its title)
+    :param raster: whether to fill the polygons by scanlines into a raster
+                   (see scanline_raster_toronto), instead of as paths
+    :returns: Basemap with Toronto
+    """
 
     # Read the Shapefile of the Business Improvement Areas in Toronto.
-    # The Shapefile is read first and its polygons are filled with the color
-    # 'facecolor' in a for-loop below
+    # The Shapefile is read first and all its polygons are filled with the
+    # color 'facecolor' as a single compound path below
+
+    axis.set_title("Business Improvement Areas of Toronto")
+    if not draw_layers:
+        return draw_basic_map_of_toronto(axis=axis)
 
-    axes[1].set_title("Business Improvement Areas of Toronto")
-    to_map = draw_toronto_and_city_wards(axis=axes[1])
+    to_map = draw_toronto_and_city_wards(axis=axis, tolerance=tolerance)
 
-    dummy = to_map.readshapefile(shapefile='./shp_dir/TO_busin_improv_area',
-                                 name='busin_improv',
-                                 drawbounds=False)
+    busin_improv = readshapefile_cached(
+        to_map, shapefile=BUSINESS_IMPROVEMENT_SHAPEFILE,
+        name='busin_improv', drawbounds=False, tolerance=tolerance)
 
-    patches = []
+    collection = layer_collection(busin_improv, facecolor='g', edgecolor='k',
+                                  linewidths=1., zorder=2, raster=raster)
+    with profile_stage('add_collection', layer='busin_improv'):
+        axis.add_collection(collection)
+    return to_map
 
-    for info, shape in zip(to_map.busin_improv_info, to_map.busin_improv):
-        # print info
-        patches.append(Polygon(np.array(shape), True))
 
-    axes[1].add_collection(PatchCollection(patches, facecolor='g',
-                                           edgecolor='k', linewidths=1.,
-                                           zorder=2))
+def draw_tax_impact_panel(axis, tolerance=None, draw_layers=True,
+                          colorbar_axis=None, classification=None,
+                          raster=False):
+    """Draw the panel with the Current Value and Assessed Tax Impact per
+    Sub-Ward in Toronto, and its colour bar.
+
+    :param axis: where to draw the panel
+    :param tolerance: the size of the smallest detail to draw
+    :param draw_layers: whether to draw the polygons of the Shapefiles, or
+                        only the frame of the panel (its map, its title and
+                        its colour bar)
+    :param colorbar_axis: where to draw the colour bar (if None, the space
+                          for the colour bar is taken from 'axis')
+    :param classification: the tuple (scheme, num_classes) of the classes
+                           of the tax impact, each one with its own colour
+                           (see classify_values_toronto), or None to colour
+                           it by a linear gradient
+    :param raster: whether to fill the sub-wards by scanlines into a raster
+                   (see scanline_raster_toronto), instead of as paths
+    :returns: Basemap with Toronto
+    """
 
     # Read the Shapefile of the Estimated Tax Impact in Toronto.
     # The way to plot this Shapefile is different than the previous one, since
@@ -166,15 +222,12 @@ def visualize_investment_in_toronto():
     # 'facecolor' in its polygons represent the Avg Tax Impact value in each
     # polygon
 
-    axes[2].set_title("Current Value and Assessed Tax Impact per Sub-Ward")
-    to_map = draw_basic_map_of_toronto(axis=axes[2])
-
-    dummy = to_map.readshapefile(shapefile='shp_dir/CVA_2011_Tax_Impact_WGS84',
-                                 name='tax_assesm_impact',
-                                 drawbounds=False)
+    axis.set_title("Current Value and Assessed Tax Impact per Sub-Ward")
+    to_map = draw_basic_map_of_toronto(axis=axis)
 
-    patches = []
-    taxes = []
+    tax_assesm_impact = readshapefile_cached(
+        to_map, shapefile=TAX_IMPACT_SHAPEFILE,
+        name='tax_assesm_impact', drawbounds=False, tolerance=tolerance)
 
     # Note that the taxes impact (in taxes[]) is different inside a same ward
     # in the city of Toronto. I.e., a same ward can have different subpolygons
@@ -182,34 +235,46 @@ def visualize_investment_in_toronto():
     #    {'subdiv': '19041', 'ward': 2.0, 'avgtaximpa': -56.0554, ...}
     #    {'subdiv': '19042', 'ward': 2.0, 'avgtaximpa': -58.6994, ...}
 
-    for info, shape in zip(to_map.tax_assesm_impact_info,
-                           to_map.tax_assesm_impact):
-        # print info
-        # The estimated taxes in the polygon is the gradient which gives the
-        # tonality of red to the polygon
-        taxes.append(float(info['avgtaximpa']))
+    # The estimated taxes in each polygon is the gradient which gives the
+    # tonality of red to the polygon
+    taxes = tax_assesm_impact.attributes['avgtaximpa'].astype(np.float64)
 
-        patches.append(Polygon(np.array(shape), True))
+    cmap = plt.get_cmap(TAX_IMPACT_CMAP)
+    min_taxes = float(taxes.min())
+    max_taxes = float(taxes.max())
+    norm = classification_norm(taxes, cmap.N, classification)
 
-    cmap = plt.get_cmap('Reds')
-    patch_collection = PatchCollection(patches, match_original=True)
-    min_taxes = min(taxes)
-    max_taxes = max(taxes)
-    norm = Normalize(min_taxes, max_taxes)
-    patch_collection.set_facecolor(cmap(norm(taxes)))
+    if draw_layers:
+        patch_collection = layer_collection(tax_assesm_impact,
+                                            facecolors=cmap(norm(taxes)),
+                                            match_original=True,
+                                            raster=raster)
 
-    axes[2].add_collection(patch_collection)
+        with profile_stage('add_collection', layer='tax_assesm_impact'):
+            axis.add_collection(patch_collection)
 
     # Add a colour bar
-    delta_gradient_taxes = max_taxes - min_taxes
-    color_bar_taxes = [min_taxes]
-    for i in range(1, 6):
-        color_bar_taxes.append(min_taxes + (i/6.0) * delta_gradient_taxes)
-    color_bar_taxes.append(max_taxes)
-
-    clor_bar = colorbar_index(ncolors=len(color_bar_taxes), cmap=cmap,
-                              shrink=0.7, labels=color_bar_taxes,
-                              format='%.2f', ax=axes[2])
+    if colorbar_axis is None:
+        colorbar_place = dict(shrink=0.7, ax=axis)
+    else:
+        colorbar_place = dict(cax=colorbar_axis)
+
+    if classification is None:
+        delta_gradient_taxes = max_taxes - min_taxes
+        color_bar_taxes = [min_taxes]
+        for i in range(1, 6):
+            color_bar_taxes.append(min_taxes + (i/6.0) * delta_gradient_taxes)
+        color_bar_taxes.append(max_taxes)
+
+        clor_bar = colorbar_index(ncolors=len(color_bar_taxes), cmap=cmap,
+                                  labels=color_bar_taxes, format='%.2f',
+                                  **colorbar_place)
+    else:
+        # a band of the same size per class, with its breaks as ticks
+        mappable = cm.ScalarMappable(norm=norm, cmap=cmap)
+        mappable.set_array(taxes)
+        clor_bar = axis.figure.colorbar(mappable, spacing='uniform',
+                                        format='%.2f', **colorbar_place)
     # Set the font-size of the tick labels in the color bar
     clor_bar.ax.tick_params(labelsize=7)
     clor_bar.set_label(label='Tax Impact')
@@ -231,7 +296,7 @@ def visualize_investment_in_toronto():
     # Add a small legend
     # ( http://matplotlib.org/api/axes_api.html#matplotlib.axes.Axes.text )
 
-    # dummy = axes[2].text(
+    # dummy = axis.text(
     #    0.98, 0.05,
     #    'This is a map of taxes and investment per subwards in Toronto\n' +
     #    'Obtained from Open Data of the City of Toronto\n' +
@@ -240,7 +305,7 @@ def visualize_investment_in_toronto():
     #    size=6,
     #    color='#555555',
     #    bbox=dict(facecolor='red', alpha=0.2),
-    #    transform=axes[2].transAxes)
+    #    transform=axis.transAxes)
 
     # Draw a map scale
 
@@ -253,25 +318,350 @@ def visualize_investment_in_toronto():
     #    fontcolor='#555555',
     #    zorder=5)
 
+    return to_map
+
+
+# The panels of the visualization, in the order of their axes in the figure,
+# and the Shapefiles which each one draws
+PANEL_DRAWERS = (draw_priority_investment_panel,
+                 draw_business_improvement_panel,
+                 draw_tax_impact_panel)
+
+PANEL_SHAPEFILES = ((CITY_WARDS_SHAPEFILE, PRIORITY_INVESTMENT_SHAPEFILE),
+                    (CITY_WARDS_SHAPEFILE, BUSINESS_IMPROVEMENT_SHAPEFILE),
+                    (TAX_IMPACT_SHAPEFILE,))
+
+# The layers which can be inspected in the interactive figure, in the order
+# they are drawn: the attribute of the Basemap of a panel where the layer is
+# left, its name in the tooltip, and its fields in the tooltip (None for its
+# first attributes)
+INSPECTED_LAYERS = (('city_wards', 'ward', ('SCODE_NAME', 'NAME')),
+                    ('prio_investm', 'priority investment', None),
+                    ('busin_improv', 'business improvement area', None),
+                    ('tax_assesm_impact', 'sub-ward',
+                     ('subdiv', 'ward', 'avgtaximpa')))
+
+
+def _create_panel_axes(fig):
+    """Create the axes of the panels in the figure 'fig', in a grid of 2x2
+    rows and columns: the first two panels in the first row, and the third
+    panel taking the whole second row.
+    """
+
+    # grid of 2x2 rows and colums for the subplots with differ. visualizations
+    grid_spec = GridSpec(2, 2)
+    return [fig.add_subplot(grid_spec[0, 0]),
+            fig.add_subplot(grid_spec[0, 1]),
+            fig.add_subplot(grid_spec[1, :])]
+
+
+def _panel_kwargs(draw_panel, classification, raster=False):
+    """Return the keyword arguments of the drawer of a panel, 'draw_panel',
+    for the 'classification' of the tax impact (only its panel takes it) and
+    the 'raster' fill of the polygons.
+    """
+
+    if draw_panel is draw_tax_impact_panel:
+        return dict(classification=classification, raster=raster)
+    return dict(raster=raster)
+
+
+def _panels_layout(dpi, tolerance, layout_fname, classification=None):
+    """Lay out the figure with the frames of all the panels (their maps,
+    titles and the colour bar, but not the polygons of their Shapefiles),
+    as the figure drawn by a single process would be laid out, and save
+    this layout into the JSON file 'layout_fname'.
+
+    The layout is the list of the (position, aspect, anchor) of the axes of
+    the panels, followed by the one of the axes of the colour bar.
+    """
+
+    fig = new_agg_figure(FIGURE_SIZE_INCHES, dpi)
+    axes = _create_panel_axes(fig)
+    for axis, draw_panel in zip(axes, PANEL_DRAWERS):
+        draw_panel(axis, tolerance=tolerance, draw_layers=False,
+                   **_panel_kwargs(draw_panel, classification))
+    fig.tight_layout()
+
+    layout = [(axis.get_position(original=True).bounds, axis.get_aspect(),
+               axis.get_anchor()) for axis in fig.axes]
+    atomic_write(layout_fname, json.dumps(layout))
+
+
+def _load_panels_layout(layout_fname):
+    """Return the layout of the panels saved by _panels_layout()."""
+
+    with open(layout_fname) as in_file:
+        layout = json.load(in_file)
+
+    # the anchors which aren't a name are a tuple (x, y)
+    return [(tuple(position), aspect,
+             anchor if isinstance(anchor, type(u'')) else tuple(anchor))
+            for position, aspect, anchor in layout]
+
+
+def _render_panel(panel_idx, layout_fname, dpi, tolerance, raster_fname,
+                  classification=None, raster=False):
+    """Render one panel of the visualization (in a worker process) into a
+    transparent raster, with the axes in the same place as in the whole
+    figure.
+
+    :param panel_idx: the index of the panel in PANEL_DRAWERS
+    :param layout_fname: the layout saved by _panels_layout()
+    :param dpi: the resolution of the raster
+    :param tolerance: the size of the smallest detail to draw
+    :param raster_fname: the '.npy' file where to save the raster
+    :param classification: the classification of the tax impact (see
+                           draw_tax_impact_panel())
+    :param raster: whether to fill the polygons by scanlines into a raster
+    """
+
+    layout = _load_panels_layout(layout_fname)
+
+    fig = new_agg_figure(FIGURE_SIZE_INCHES, dpi)
+    position, panel_aspect, panel_anchor = layout[panel_idx]
+    axis = fig.add_axes(position)
+
+    panel_kwargs = _panel_kwargs(PANEL_DRAWERS[panel_idx], classification,
+                                 raster)
+    if PANEL_DRAWERS[panel_idx] is draw_tax_impact_panel:
+        position, aspect, anchor = layout[len(PANEL_DRAWERS)]
+        colorbar_axis = fig.add_axes(position)
+        colorbar_axis.set_aspect(aspect, adjustable='box', anchor=anchor)
+        panel_kwargs['colorbar_axis'] = colorbar_axis
+
+    PANEL_DRAWERS[panel_idx](axis, tolerance=tolerance, **panel_kwargs)
+    # (the colour bar of the whole figure moves the anchor of its panel)
+    axis.set_aspect(panel_aspect, adjustable='box', anchor=panel_anchor)
+
+    with profile_stage('savefig', panel=panel_idx):
+        np.save(raster_fname, render_figure_rgba(fig, transparent=True))
+
+
+def _composite_panels(raster_fnames, dpi, image_fname):
+    """Composite the rasters of the panels into the image 'image_fname'."""
+
+    rasters = [np.load(raster_fname, mmap_mode='r')
+               for raster_fname in raster_fnames]
+    with profile_stage('savefig', image=image_fname):
+        save_rgb_png(image_fname, composite_over_white(rasters), dpi)
+
+
+def render_panels_in_parallel(dpi, tolerance, image_fname,
+                              classification=None, raster=False):
+    """Render each panel of the visualization in its own worker process with
+    the Agg backend, and composite their rasters into the image
+    'image_fname', laid out as the figure drawn by a single process.
+
+    The layout, the rasters of the panels and the image are the targets of
+    a build graph, so only those whose Shapefiles or parameters changed
+    since they were last built are rendered again, and the rasters of the
+    other panels are reused from the cache (where the rasters least
+    recently used are evicted).
+
+    :returns: the names of the targets which were built
+    """
+
+    build_dir = cache_subdir(BUILD_CACHE_SUBDIR)
+    graph = BuildGraph('investment_panels')
+
+    # the parameters which all the targets depend on
+    params = (PANELS_VERSION, FIGURE_SIZE_INCHES, dpi, '%.9g' % tolerance,
+              sorted(TORONTO_BOUNDING_BOX.items()), classification)
+
+    # (the layout depends on the Shapefiles too, through the labels of the
+    # colour bar)
+    layout_fname = os.path.join(build_dir, 'panels_layout_%ddpi.json' % dpi)
+    layout_input_files = sorted(set(
+        fname for shapefiles in PANEL_SHAPEFILES
+        for shapefile in shapefiles for fname in shapefile_fnames(shapefile)))
+    graph.add_target('layout@%ddpi' % dpi, _panels_layout,
+                     args=(dpi, tolerance, layout_fname, classification),
+                     input_files=layout_input_files, params=params,
+                     outputs=[layout_fname])
+
+    raster_dir = cache_subdir(PANEL_RASTER_CACHE_SUBDIR)
+    panel_targets = []
+    raster_fnames = []
+    for panel_idx, shapefiles in enumerate(PANEL_SHAPEFILES):
+        raster_fname = os.path.join(raster_dir, 'panel_%d_%ddpi.npy' %
+                                    (panel_idx, dpi))
+        panel_target = 'panel_%d@%ddpi' % (panel_idx, dpi)
+        input_files = [fname for shapefile in shapefiles
+                       for fname in shapefile_fnames(shapefile)]
+        graph.add_target(panel_target, _render_panel,
+                         args=(panel_idx, layout_fname, dpi, tolerance,
+                               raster_fname, classification, raster),
+                         input_files=input_files,
+                         params=params + (TAX_IMPACT_CMAP, raster),
+                         deps=['layout@%ddpi' % dpi],
+                         outputs=[raster_fname])
+        panel_targets.append(panel_target)
+        raster_fnames.append(raster_fname)
+
+    graph.add_target(image_fname, _composite_panels,
+                     args=(raster_fnames, dpi, image_fname),
+                     params=params, deps=panel_targets,
+                     outputs=[image_fname])
+
+    built = graph.build(processes=len(PANEL_DRAWERS))
+
+    # (a raster evicted is rendered again the next time it is needed)
+    for raster_fname in raster_fnames:
+        touch_cache_entry(raster_fname)
+    evict_cache_entries(PANEL_RASTER_CACHE_SUBDIR,
+                        max_total_bytes=PANEL_RASTER_CACHE_MAX_BYTES,
+                        max_age_seconds=PANEL_RASTER_CACHE_MAX_AGE_SECONDS)
+    return built
+
+
+def _inspect_panels(fig, axes, to_maps):
+    """Return the MapInspector of the layers drawn in the panels 'axes' of
+    the figure 'fig' (with their Basemaps in 'to_maps'), connected to its
+    canvas.
+    """
+
+    inspector = MapInspector(fig)
+    for axis, to_map in zip(axes, to_maps):
+        for attribute, name, fields in INSPECTED_LAYERS:
+            shapes = getattr(to_map, attribute, None)
+            if shapes is not None:
+                inspector.add_layer(axis, name, shapes.layer,
+                                    attribute_description(fields))
+    inspector.connect()
+    return inspector
+
+
+def visualize_investment_in_toronto(dpi=OUTPUT_DPI, parallel=False,
+                                    classification=None, interactive=False,
+                                    raster=False):
+    """Function to visualize the investment in the neighborhoods of
+    Toronto.
+
+    It plots these ESRI Shapefiles from Toronto using matplotlib/basemap/etc.
+    (These shapefiles are available as Open Data from the City of Toronto):
+
+     . The City Wards in Toronto;
+     . The Neighborhoods defined as Priority Investment by the City of Toronto
+     . The Business Improvement Areas defined by the City of Toronto
+     . The Current Value Assessment on Tax Impact for Residential Neighborhoods
+       in the City of Toronto (last year available, 2011)
+
+    The image is saved with 'dpi' dots per inch, and the polygons of these
+    Shapefiles are simplified to the size of a pixel at that resolution.
+
+    If 'parallel', each panel is rendered in its own worker process and the
+    image is only saved, not shown.
+
+    The tax impact is coloured by the classes of 'classification', the tuple
+    (scheme, num_classes), or by a linear gradient if it is None.
+
+    If 'interactive' (and not 'parallel'), the features under the cursor
+    in the figure shown are highlighted, with a tooltip with their
+    attributes, and a click prints all their attributes.
+
+    If 'raster', the polygons of the Shapefiles are filled by scanlines into
+    a raster with numpy, by all the CPUs, and composited under the rest of
+    the figure (see scanline_raster_toronto), instead of drawn as paths.
+    """
+
+    # The size of an output pixel in the projected coordinates of the map:
+    # smaller details in the Shapefiles can't be seen in the image
+    tolerance = pixel_tolerance(toronto_basemap(), dpi, FIGURE_SIZE_INCHES[0])
+
+    if parallel:
+        built = render_panels_in_parallel(dpi, tolerance,
+                                          'TO_developm_neighborhoods.png',
+                                          classification, raster)
+        print('Rebuilt: %s' % (', '.join(built) or 'nothing, up to date'))
+        return
+
+    fig = plt.figure()
+
+    axes = _create_panel_axes(fig)
+
+    # axes = fig.add_subplot(111)
+
+    # First map is the Priority investment by the City of Toronto, then the
+    # Business Improvement Areas, and then the Tax Impact per Sub-Ward
+
+    to_maps = [draw_panel(axis, tolerance=tolerance,
+                          **_panel_kwargs(draw_panel, classification, raster))
+               for axis, draw_panel in zip(axes, PANEL_DRAWERS)]
+
     fig.set_tight_layout(True)
-    fig.set_size_inches(9, 7)
+    fig.set_size_inches(*FIGURE_SIZE_INCHES)
 
     # plt.title('Toronto Neighborhoods: Priority Investment, Business ' +
     #          'Improvement Areas,\nand Current Value Assessment of Tax ' +
     #          'Impact on Residential Properties')
     # plt.legend()
-    fig.savefig('TO_developm_neighborhoods.png', dpi=600)
+    with profile_stage('savefig', image='TO_developm_neighborhoods.png'):
+        fig.savefig('TO_developm_neighborhoods.png', dpi=dpi)
+    if interactive:
+        # (the canvas only keeps weak references to the callbacks of the
+        # inspector, so it is kept alive here while the figure is shown)
+        inspector = _inspect_panels(fig, axes, to_maps)
     plt.show()
 
 
-def main():
+def main(argv=None, prog=None):
     """Main function on the program.
 
     What it does, for now, is just to visualize the investment and taxes
     in the neighborhoods in Toronto,
+
+    :param argv: the command-line arguments (None for those of the program)
+    :param prog: the name of the program in its usage (None for the name of
+                 its script)
     """
 
-    visualize_investment_in_toronto()
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Visualize the investment and taxes in the '
+                    'neighborhoods of Toronto')
+    parser.add_argument('--dpi', type=int, default=OUTPUT_DPI,
+                        help='resolution of the image saved '
+                             '(default: %(default)s)')
+    parser.add_argument('--parallel', action='store_true',
+                        help='render each panel in its own process, and '
+                             'only save the image (without showing it)')
+    parser.add_argument('--classify', choices=CLASSIFICATION_SCHEMES,
+                        help='colour the tax impact by classes of this '
+                             'scheme, instead of by a linear gradient')
+    parser.add_argument('--classes', type=int, default=DEFAULT_NUM_CLASSES,
+                        help='number of classes with --classify (default: '
+                             '%(default)s)')
+    parser.add_argument('--raster-fill', action='store_true',
+                        help='fill the polygons by scanlines into a raster '
+                             'with numpy, by all the CPUs, instead of as '
+                             'anti-aliased paths (for big images); the '
+                             'interiors are the same, but about 2%% of the '
+                             'pixels, on the borders between polygons, '
+                             'differ by up to 100 levels of 255')
+    parser.add_argument('--interactive', action='store_true',
+                        help='in the figure shown, highlight the features '
+                             'under the cursor with a tooltip with their '
+                             'attributes, and print the attributes of the '
+                             'features clicked')
+    parser.add_argument('--profile', metavar='TRACE_FNAME',
+                        help='profile the time and memory of each stage, '
+                             'into a JSON trace of events in TRACE_FNAME')
+    args = parser.parse_args(argv)
+    if args.parallel and args.interactive:
+        parser.error('--interactive needs the figure shown, not only saved '
+                     'by --parallel')
+
+    if args.profile:
+        enable_profiling(args.profile)
+    try:
+        visualize_investment_in_toronto(
+            dpi=args.dpi, parallel=args.parallel,
+            classification=(args.classify, args.classes) if args.classify
+            else None, interactive=args.interactive,
+            raster=args.raster_fill)
+    finally:
+        save_profile()
 
 
 # The following two functions, colorbar_index() and cmap_discretize()
@@ -281,6 +671,7 @@ def main():
 #   http://brandonrose.org/pythonmap
 
 # Convenience functions for working with colour ramps and bars
+@profiled_stage('colorbar_index')
 def colorbar_index(ncolors, cmap, labels=None, **kwargs):
     """
     This is a convenience function to stop you making off-by-one errors
@@ -291,7 +682,13 @@ def colorbar_index(ncolors, cmap, labels=None, **kwargs):
     mappable = cm.ScalarMappable(cmap=cmap)
     mappable.set_array([])
     mappable.set_clim(-0.5, ncolors+0.5)
-    colorbar = plt.colorbar(mappable, **kwargs)
+    # draw it in the figure of the axes given (it can be a figure outside
+    # pyplot, e.g., rendered in a worker process)
+    colorbar_place = kwargs.get('cax') or kwargs.get('ax')
+    if colorbar_place is not None:
+        colorbar = colorbar_place.figure.colorbar(mappable, **kwargs)
+    else:
+        colorbar = plt.colorbar(mappable, **kwargs)
     colorbar.set_ticks(np.linspace(0, ncolors, ncolors))
     colorbar.set_ticklabels(range(ncolors))
     if labels:
@@ -299,6 +696,7 @@ def colorbar_index(ncolors, cmap, labels=None, **kwargs):
     return colorbar
 
 
+@profiled_stage('cmap_discretize')
 def cmap_discretize(cmap, num):
     """
     Return a discrete colormap from the continuous colormap cmap.
@@ -320,7 +718,7 @@ def cmap_discretize(cmap, num):
     cdict = {}
     for c_i, key in enumerate(('red', 'green', 'blue')):
         cdict[key] = [(indices[i], colors_rgba[i - 1, c_i], colors_rgba[i, c_i])
-                      for i in xrange(num + 1)]
+                      for i in range(num + 1)]
     return LinearSegmentedColormap(cmap.name + "_%d" % num, cdict, 1024)
 
 
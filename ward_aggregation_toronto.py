@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""Aggregation per ward of the values of the polygons of a layer of Toronto
+which are finer than the wards, like the Current Value Assessment (CVA) Tax
+Impact per sub-ward, whose field 'avgtaximpa' varies among the sub-polygons
+of a same ward, and which has the ward of each polygon in its field 'ward'.
+
+The statistics of each ward are weighted by the area of its polygons. These
+areas are computed by the shoelace formula over the whole vertex buffer of
+the LayerGeometry at once, and the statistics are grouped reductions over
+the ward of each polygon (numpy.bincount() and ufunc.reduceat()), so there
+is no loop per polygon or per ward, and finer layers (e.g., the assessment
+parcels) can be aggregated the same way.
+
+The statistics per ward can then be joined with the total budget per ward
+from the ETL of the budget spreadsheet, to compare the budget with the tax
+impact of each ward.
+"""
+
+import numpy as np
+
+from spatial_index_toronto import ring_areas
+
+
+# The CVA Tax Impact Shapefile, and its fields with the tax impact and with
+# the ward of each polygon
+CVA_TAX_IMPACT_SHAPEFILE = 'shp_dir/CVA_2011_Tax_Impact_WGS84'
+CVA_TAX_IMPACT_FIELD = 'avgtaximpa'
+CVA_WARD_FIELD = 'ward'
+
+
+def polygon_areas(layer):
+    """Return the area of each ring of the LayerGeometry 'layer', positive
+    for its outer rings and negative for its holes, so that the sum of the
+    areas of the rings of a polygon is its area.
+
+    In a Shapefile, the outer rings go clockwise and the holes
+    counter-clockwise; if a layer has them the other way around, as the
+    total area of a layer can't be negative, all the areas are reversed.
+    """
+
+    areas = -ring_areas(layer, signed=True)
+    if areas.sum() < 0.0:
+        areas = -areas
+    return areas
+
+
+class WardStatistics(object):
+
+    """The area-weighted statistics per ward of a value of the polygons of a
+    layer.
+
+    Fields (all of them arrays with an element per ward, in the order of
+    'ward_numbers'):
+
+       ward_numbers: the ward numbers, in increasing order
+
+       num_polygons: the number of rings of the layer in each ward
+
+       areas: the total area of the polygons of each ward (in the projected
+              units of the layer)
+
+       means: the mean of the value in each ward, weighted by the area of
+              its polygons
+
+       stds: the standard deviation of the value in each ward, weighted by
+             the area of its polygons
+
+       minimums, maximums: the minimum and maximum of the value among the
+                           polygons of each ward (its holes excluded)
+    """
+
+    def __init__(self, ward_numbers, num_polygons, areas, means, stds,
+                 minimums, maximums):
+        self.ward_numbers = ward_numbers
+        self.num_polygons = num_polygons
+        self.areas = areas
+        self.means = means
+        self.stds = stds
+        self.minimums = minimums
+        self.maximums = maximums
+
+    def __len__(self):
+        return len(self.ward_numbers)
+
+    def join_total_budget(self, total_budget_per_ward):
+        """Join these statistics with the total budget per ward, a
+        dictionary indexed by ward number (as the '_total_budget_per_ward'
+        of a TorontoBudgetForecastPerCityWard).
+
+        :returns: a dictionary with an array per column ('ward_numbers',
+                  'total_budget', 'areas', 'means', 'stds', and
+                  'budget_per_area'), with a row per ward with both
+                  statistics and budget
+        """
+
+        budget_wards = np.fromiter(total_budget_per_ward.keys(),
+                                   dtype=np.int64,
+                                   count=len(total_budget_per_ward))
+        budgets = np.fromiter(total_budget_per_ward.values(),
+                              dtype=np.float64,
+                              count=len(total_budget_per_ward))
+
+        ward_numbers, stats_idx, budget_idx = np.intersect1d(
+            self.ward_numbers, budget_wards, assume_unique=True,
+            return_indices=True)
+
+        areas = self.areas[stats_idx]
+        total_budget = budgets[budget_idx]
+        return dict(ward_numbers=ward_numbers,
+                    total_budget=total_budget,
+                    areas=areas,
+                    means=self.means[stats_idx],
+                    stds=self.stds[stats_idx],
+                    budget_per_area=total_budget /
+                    np.where(areas > 0.0, areas, np.nan))
+
+
+def area_weighted_ward_statistics(layer, value_field=CVA_TAX_IMPACT_FIELD,
+                                  ward_field=CVA_WARD_FIELD):
+    """Return the WardStatistics of the attribute 'value_field' of the rings
+    of the LayerGeometry 'layer', grouped by their attribute 'ward_field'
+    (the rings without a finite value or ward are ignored).
+    """
+
+    values = layer.attributes[value_field].astype(np.float64)
+    wards = layer.attributes[ward_field].astype(np.float64)
+    areas = polygon_areas(layer)
+
+    valid = np.isfinite(values) & np.isfinite(wards)
+    values = values[valid]
+    areas = areas[valid]
+    ward_numbers, ward_idx = np.unique(np.round(wards[valid]).astype(np.int64),
+                                       return_inverse=True)
+    ward_idx = ward_idx.reshape(-1)
+    num_wards = len(ward_numbers)
+
+    num_polygons = np.bincount(ward_idx, minlength=num_wards)
+    ward_areas = np.bincount(ward_idx, weights=areas, minlength=num_wards)
+    weights = np.where(ward_areas > 0.0, ward_areas, np.nan)
+
+    means = np.bincount(ward_idx, weights=areas * values,
+                        minlength=num_wards) / weights
+    deviations = values - means[ward_idx]
+    variances = np.bincount(ward_idx, weights=areas * deviations ** 2,
+                            minlength=num_wards) / weights
+    stds = np.sqrt(np.maximum(variances, 0.0))
+
+    # the minimum and maximum per ward, of its outer rings, by sorting the
+    # rings by ward and reducing each ward's run of rings
+    minimums = np.empty(num_wards)
+    maximums = np.empty(num_wards)
+    minimums.fill(np.nan)
+    maximums.fill(np.nan)
+    outer = np.flatnonzero(areas > 0.0)
+    if len(outer):
+        outer = outer[np.argsort(ward_idx[outer], kind='mergesort')]
+        outer_wards = ward_idx[outer]
+        run_starts = np.flatnonzero(np.r_[True, outer_wards[1:] !=
+                                          outer_wards[:-1]])
+        minimums[outer_wards[run_starts]] = \
+            np.minimum.reduceat(values[outer], run_starts)
+        maximums[outer_wards[run_starts]] = \
+            np.maximum.reduceat(values[outer], run_starts)
+
+    return WardStatistics(ward_numbers, num_polygons, ward_areas, means,
+                          stds, minimums, maximums)
+
+
+def main():
+    """Print, per ward, the total budget from the budget spreadsheet next
+    to the area-weighted CVA Tax Impact of the ward.
+    """
+
+    # imported here because the Basemap and the budget ETL are only needed
+    # by this report, not by the aggregation itself
+    from basemap_cache_toronto import toronto_basemap
+    from geometry_cache_toronto import load_layer_geometry
+    from plot_excel_budget_toronto_neighborhoods import \
+        TorontoBudgetForecastPerCityWard
+
+    to_map = toronto_basemap()
+    tax_impact = load_layer_geometry(to_map, CVA_TAX_IMPACT_SHAPEFILE,
+                                     'tax_assesm_impact')
+    ward_stats = area_weighted_ward_statistics(tax_impact)
+
+    budget = TorontoBudgetForecastPerCityWard()
+    budget.etl_excel_spreadsheet_cached('shp_dir/budget_per_city_ward.xlsx')
+    joined = ward_stats.join_total_budget(budget._total_budget_per_ward)
+
+    # the areas are in the projected units of the map, so they are printed
+    # as the percentage of the area of the whole layer
+    area_percents = 100.0 * joined['areas'] / ward_stats.areas.sum()
+
+    print('%5s %16s %10s %12s %10s' % ('ward', 'total budget', 'area (%)',
+                                        'tax impact', 'std'))
+    for row in zip(joined['ward_numbers'], joined['total_budget'],
+                   area_percents, joined['means'], joined['stds']):
+        print('%5d %16.2f %10.3f %12.4f %10.4f' % row)
+
+    if len(joined['ward_numbers']) > 1:
+        print('Correlation of the total budget and the tax impact: %.4f' %
+              np.corrcoef(joined['total_budget'], joined['means'])[0, 1])
+
+
+if __name__ == '__main__':
+    main()